@@ -5,10 +5,11 @@ from psycopg2 import sql
 from datetime import datetime, timedelta, timezone, date
 from dotenv import load_dotenv
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
-from telegram.ext import Application, CommandHandler, MessageHandler, ConversationHandler, ContextTypes, filters
+from telegram.ext import Application, CommandHandler, MessageHandler, ConversationHandler, ContextTypes, TypeHandler, filters
 import matplotlib.pyplot as plt
 import io
 import re
+import asyncio
 import schedule
 import time
 import pandas as pd
@@ -25,6 +26,26 @@ from config.settings import settings
 from utils.cache import cached, get_cache_stats, clear_cache
 from utils.monitoring import monitor_performance, get_metrics, get_summary
 from utils.retry import retry, circuit_breaker
+from utils.ledger import (
+    append_expense, count_expenses, find_expense, iter_expenses, ledger_version, list_partitions,
+    partition_file, partition_key, read_partition, remove_expense, update_expense
+)
+from utils.request_context import begin_request, invalidate_request_context, request_scoped
+from utils.group_index import group_index
+from utils.auth_registry import AuthRegistry
+from utils.keyword_matcher import KeywordMatcher, TrigramIndex, trigram_set
+from utils.model_store import model_store, training_fingerprint
+from utils.training_worker import fit_models, model_trainer
+from utils.training_loader import training_loader
+from utils.report_renderer import report_renderer, summarize as summarize_report
+from utils.report_cache import ReportArtifact, report_cache
+from utils.rollups import expense_rollups
+from utils.columnar import columnar_store
+from utils.folder_locks import folder_locks, write_json_atomic
+from utils.write_coalescer import write_coalescer
+from utils.db_pool import db_pool
+from utils.sync_spool import sync_spool
+from utils.migrations import schema_migrations
 # from utils.validators import Validator  # Не используется в текущей версии
 
 # Настройки matplotlib для высокого качества
@@ -57,6 +78,14 @@ logger = logging.getLogger(__name__)
 BOT_TOKEN = settings.bot.token
 DATABASE_URL = settings.get_database_url()
 
+# Соединения с PostgreSQL выдаются из общего пула
+db_pool.configure(
+    DATABASE_URL,
+    max_size=settings.database.pool_size,
+    acquire_timeout=settings.database.pool_timeout,
+    max_idle=settings.database.pool_max_idle
+)
+
 # Совместимость со старым кодом
 DATABASE_HOST = settings.database.host
 DATABASE_PORT = settings.database.port
@@ -172,45 +201,60 @@ def normalize(text: str) -> str:
     return t
 
 # 3) Быстрый словарный матч (по подстроке любого ключа)
+# Словарь компилируется в автомат Ахо–Корасик, который перестраивается
+# при пополнении CATEGORIES; выигрывает первая по порядку категория.
+category_matcher = KeywordMatcher(CATEGORIES)
+
 def dict_match_category(text_norm: str) -> str | None:
-    for cat, words in CATEGORIES.items():
-        for w in words:
-            if w in text_norm:
-                return cat
-    return None
+    return category_matcher.match(text_norm)
 
 # 4) Простой фуззи-матч (char trigram overlap) без внешних зависимостей
-def trigram_set(s: str) -> set[str]:
-    s = f"  {s}  "
-    return {s[i:i+3] for i in range(len(s)-2)}
+# Инвертированный индекс триграмм: Жаккар считается только для слов,
+# у которых есть общие триграммы с текстом (trigram_set — из utils.keyword_matcher)
+category_trigram_index = TrigramIndex(CATEGORIES)
 
 def fuzzy_category(text_norm: str, threshold: float = 0.45) -> str | None:
-    if not text_norm:
-        return None
-    best_cat, best_score = None, 0.0
-    tset = trigram_set(text_norm)
-    for cat, words in CATEGORIES.items():
-        for w in words:
-            wset = trigram_set(w)
-            inter = len(tset & wset)
-            union = len(tset | wset)
-            score = inter / union if union else 0.0
-            if score > best_score:
-                best_score, best_cat = score, cat
-    return best_cat if best_score >= threshold else None
+    return category_trigram_index.match(text_norm, threshold)
 
 # 5) ML-модель (char n-grams устойчивы к опечаткам)
-vectorizer = TfidfVectorizer(
+VECTORIZER_PARAMS = dict(
     analyzer="char_wb",
     ngram_range=(3,5),
     min_df=1,
     max_features=40000
 )
-classifier = LogisticRegression(
+CLASSIFIER_PARAMS = dict(
     max_iter=2000,
     class_weight="balanced"
 )
 
+def new_vectorizer() -> TfidfVectorizer:
+    return TfidfVectorizer(**VECTORIZER_PARAMS)
+
+def new_classifier() -> LogisticRegression:
+    return LogisticRegression(**CLASSIFIER_PARAMS)
+
+vectorizer = new_vectorizer()
+classifier = new_classifier()
+
+# Пара (vectorizer, classifier), которой пользуется classify_expense.
+# Заменяется одним присваиванием, поэтому классификация всегда видит
+# согласованную пару: старую до замены и новую после.
+active_model = (vectorizer, classifier)
+
+# Онлайн-модель (hashing + SGD): обучается вместе с основной и дообучается
+# на каждом исправлении категории до следующего полного переобучения
+online_model = None
+
+# Сколько исправлений учтено онлайн с последнего полного переобучения
+corrections_since_refit = 0
+
+# Полное переобучение запускается после стольких исправлений
+FULL_REFIT_EVERY_CORRECTIONS = 20
+
+# Отпечаток данных, на которых обучена текущая модель
+model_fingerprint = None
+
 # Генерация обучающего набора из словаря + (опционально) TRAINING_DATA
 BASE_TRAIN = []
 for cat, words in CATEGORIES.items():
@@ -223,46 +267,139 @@ try:
 except NameError:
     pass
 
-def train_model(data):
+def prepare_training(data):
     """
-    Совместимость с существующим вызовом train_model(TRAINING_DATA):
-    если data пустой — обучаемся на BASE_TRAIN.
+    Подготавливает данные для обучения.
+    Элементы data — пары (описание, категория) или тройки
+    (описание, категория, количество); количество становится весом примера.
+    Возвращает (use_data, descriptions, categories, weights, online_classes, fingerprint)
+    или None, если обучать не на чем.
     """
     use_data = data if (isinstance(data, list) and len(data) > 0) else BASE_TRAIN
     if not use_data:
         logger.warning("Нет данных для обучения модели. Модель не будет обучена.")
-        return
+        return None
+    
+    descriptions = [normalize(item[0]) for item in use_data]
+    categories = [item[1] for item in use_data]
+    weights = [item[2] if len(item) > 2 else 1 for item in use_data]
     
+    # Проверяем количество уникальных категорий
+    unique_categories = set(categories)
+    if len(unique_categories) < 2:
+        logger.warning(f"Недостаточно категорий для обучения модели: найдено {len(unique_categories)} категорий {unique_categories}. Нужно минимум 2.")
+        return None
+    
+    # Онлайн-модель не умеет добавлять классы, поэтому знает сразу все категории
+    online_classes = sorted(set(CATEGORIES.keys()) | unique_categories)
+    
+    fingerprint = training_fingerprint(zip(descriptions, categories), VECTORIZER_PARAMS, CLASSIFIER_PARAMS, online_classes, weights)
+    return use_data, descriptions, categories, weights, online_classes, fingerprint
+
+def install_model(new_vec, new_clf, new_online, fingerprint, use_data):
+    """Атомарно подменяет активную модель и пополняет словарь категорий"""
+    global vectorizer, classifier, active_model, online_model, corrections_since_refit, model_fingerprint
+    active_model = (new_vec, new_clf)
+    vectorizer, classifier = new_vec, new_clf
+    online_model = new_online
+    corrections_since_refit = 0
+    model_fingerprint = fingerprint
+    update_categories_from_training(use_data)
+
+def update_categories_from_training(use_data):
+    """Обновляет словарь категорий новыми примерами"""
+    known_words = {category: {w.lower() for w in words} for category, words in CATEGORIES.items()}
+    for item in use_data:
+        description, category = item[0], item[1]
+        if category in CATEGORIES:
+            desc_lower = description.lower().strip()
+            if desc_lower and desc_lower not in known_words[category]:
+                CATEGORIES[category].append(desc_lower)
+                known_words[category].add(desc_lower)
+                logger.info(f"Добавлено в категорию '{category}': {desc_lower}")
+
+def train_model(data):
+    """
+    Совместимость с существующим вызовом train_model(TRAINING_DATA):
+    если data пустой — обучаемся на BASE_TRAIN.
+
+    Если модель с тем же отпечатком данных уже сохранена, она загружается
+    из model_store вместо обучения. Обучение выполняется в текущем потоке,
+    поэтому из обработчиков бота нужно вызывать train_model_async.
+    """
     try:
-        descriptions = [normalize(item[0]) for item in use_data]
-        categories = [item[1] for item in use_data]
+        prepared = prepare_training(data)
+        if not prepared:
+            return
+        use_data, descriptions, categories, weights, online_classes, fingerprint = prepared
         
-        # Проверяем количество уникальных категорий
-        unique_categories = set(categories)
-        if len(unique_categories) < 2:
-            logger.warning(f"Недостаточно категорий для обучения модели: найдено {len(unique_categories)} категорий {unique_categories}. Нужно минимум 2.")
+        if fingerprint == model_fingerprint:
+            logger.info("Модель уже обучена на этих данных, обучение пропущено")
+            update_categories_from_training(use_data)
             return
         
-        logger.info(f"Обучение модели на {len(use_data)} записях с {len(unique_categories)} категориями: {unique_categories}")
-
-        # Обучаем модель
-        X = vectorizer.fit_transform(descriptions)
-        classifier.fit(X, categories)
-
-        # Обновляем словарь категорий новыми примерами
-        for description, category in use_data:
-            if category in CATEGORIES:
-                desc_lower = description.lower().strip()
-                if desc_lower and desc_lower not in [w.lower() for w in CATEGORIES[category]]:
-                    CATEGORIES[category].append(desc_lower)
-                    logger.info(f"Добавлено в категорию '{category}': {desc_lower}")
-
+        loaded = model_store.load(fingerprint)
+        if loaded:
+            install_model(*loaded, fingerprint, use_data)
+            return
+        
+        logger.info(f"Обучение модели на {len(use_data)} записях с {len(set(categories))} категориями")
+        new_vec, new_clf, new_online = fit_models(descriptions, categories, VECTORIZER_PARAMS, CLASSIFIER_PARAMS, online_classes, weights)
+        model_store.save(fingerprint, new_vec, new_clf, samples=len(use_data), online_model=new_online)
+        install_model(new_vec, new_clf, new_online, fingerprint, use_data)
         logger.info(f"Модель классификации (гибрид) успешно обучена на {len(use_data)} записях.")
     except Exception as e:
         logger.error(f"Ошибка при обучении модели: {e}")
         raise
 
-# Обучаем (main() позже всё равно вызовет train_model(TRAINING_DATA))
+async def train_model_async(data) -> bool:
+    """
+    Обучает модель в пуле процессов, не блокируя event loop.
+    Пока идет обучение, classify_expense пользуется прежней моделью.
+    Возвращает True, если после вызова активна модель для этих данных.
+    """
+    prepared = prepare_training(data)
+    if not prepared:
+        return False
+    use_data, descriptions, categories, weights, online_classes, fingerprint = prepared
+    
+    if fingerprint == model_fingerprint:
+        logger.info("Модель уже обучена на этих данных, обучение пропущено")
+        update_categories_from_training(use_data)
+        return True
+    
+    loaded = await asyncio.to_thread(model_store.load, fingerprint)
+    if loaded:
+        install_model(*loaded, fingerprint, use_data)
+        return True
+    
+    logger.info(f"Фоновое обучение модели на {len(use_data)} записях с {len(set(categories))} категориями")
+    new_vec, new_clf, new_online = await model_trainer.fit(descriptions, categories, VECTORIZER_PARAMS, CLASSIFIER_PARAMS, online_classes, weights)
+    await asyncio.to_thread(model_store.save, fingerprint, new_vec, new_clf, len(use_data), new_online)
+    install_model(new_vec, new_clf, new_online, fingerprint, use_data)
+    logger.info(f"Модель классификации (гибрид) переобучена в фоне на {len(use_data)} записях.")
+    return True
+
+def learn_correction(description: str, category: str) -> bool:
+    """
+    Учитывает исправление категории без полного переобучения:
+    пополняет словарь и дообучает онлайн-модель (partial_fit).
+    Возвращает True, если пора запустить полное переобучение в фоне.
+    """
+    global corrections_since_refit
+    update_categories_from_training([(description, category)])
+    
+    learned = online_model is not None and online_model.learn(normalize(description), category)
+    if not learned:
+        # Новая категория или онлайн-модели нет — нужно полное переобучение
+        return True
+    
+    corrections_since_refit += 1
+    logger.info(f"Онлайн-модель дообучена: '{description}' -> {category} ({corrections_since_refit} исправлений с последнего переобучения)")
+    return corrections_since_refit >= FULL_REFIT_EVERY_CORRECTIONS
+
+# Обучаем или загружаем сохраненную модель (повторный вызов train_model(TRAINING_DATA)
+# в main() с теми же данными обучение не запускает)
 train_model(BASE_TRAIN)
 
 def is_legacy_user(user_id: int) -> bool:
@@ -436,9 +573,17 @@ def classify_expense(description: str, user_id: Optional[int] = None) -> str:
             return cat
         
         # 4) ML
-        if hasattr(classifier, "classes_") and len(getattr(classifier, "classes_", [])) > 0:
-            vec = vectorizer.transform([text_norm])
-            pred = classifier.predict(vec)[0]
+        # После исправлений онлайн-модель точнее основной до ее переобучения,
+        # но только на похожих текстах или там, где она уверена
+        if corrections_since_refit > 0 and online_model is not None and online_model.is_fitted:
+            pred = online_model.trusted_prediction(text_norm)
+            if pred is not None:
+                return pred
+        
+        model_vectorizer, model_classifier = active_model
+        if hasattr(model_classifier, "classes_") and len(getattr(model_classifier, "classes_", [])) > 0:
+            vec = model_vectorizer.transform([text_norm])
+            pred = model_classifier.predict(vec)[0]
             return pred
 
         # 5) fallback
@@ -451,10 +596,10 @@ def classify_expense(description: str, user_id: Optional[int] = None) -> str:
 @retry(max_attempts=3, delay=1.0, exceptions=(psycopg2.OperationalError, psycopg2.InterfaceError))
 @monitor_performance
 def get_db_connection():
+    """Соединение из пула; conn.close() возвращает его в пул"""
     try:
         if DATABASE_URL:
-            conn = psycopg2.connect(DATABASE_URL)
-            return conn
+            return db_pool.acquire()
         else:
             logger.error("DATABASE_URL не настроен")
             return None
@@ -462,207 +607,169 @@ def get_db_connection():
         logger.error(f"Ошибка подключения к БД: {e}")
         return None
 
-def init_new_database_schema():
-    """Инициализация новой схемы базы данных"""
-    try:
-        # Проверяем, есть ли файл схемы
-        if not os.path.exists('database_schema.sql'):
-            logger.error("Файл database_schema.sql не найден")
-            return False
-        
-        # Читаем SQL файл со схемой
-        with open('database_schema.sql', 'r', encoding='utf-8') as f:
-            schema_sql = f.read()
-        
-        conn = get_db_connection()
-        if conn:
-            cursor = conn.cursor()
-            # Выполняем SQL по частям (разделяем по ;)
-            sql_commands = [cmd.strip() for cmd in schema_sql.split(';') if cmd.strip()]
-            
-            for sql_command in sql_commands:
-                if sql_command:
-                    try:
-                        cursor.execute(sql_command)
-                        logger.info(f"Выполнена команда: {sql_command[:50]}...")
-                    except Exception as e:
-                        logger.error(f"Ошибка выполнения команды: {e}")
-                        logger.error(f"Команда: {sql_command}")
-            
-            conn.commit()
-            conn.close()
-            logger.info("Новая схема базы данных инициализирована")
-            return True
-        return False
-    except Exception as e:
-        logger.error(f"Ошибка инициализации новой схемы БД: {e}")
-        return False
+@schema_migrations.register(1, "Таблицы бота: расходы, напоминания, бюджет, группы, данные пользователей")
+def migrate_bot_tables(cursor):
+    """Исходная схема бота (раньше создавалась init_db при каждом запуске)"""
+    # Удаляем user_id и family_id, если остались от старой схемы
+    for col in ['user_id', 'family_id']:
+        cursor.execute(f"ALTER TABLE IF EXISTS expenses DROP COLUMN IF EXISTS {col};")
+    
+    # Создаем таблицу расходов
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS expenses (
+            id SERIAL PRIMARY KEY,
+            amount NUMERIC(10, 2) NOT NULL,
+            description TEXT,
+            category VARCHAR(100) NOT NULL,
+            transaction_date TIMESTAMP WITH TIME ZONE NOT NULL
+        );
+    ''')
+    
+    # Создаем таблицу напоминаний
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS payment_reminders (
+            id SERIAL PRIMARY KEY,
+            title VARCHAR(200) NOT NULL,
+            description TEXT,
+            amount NUMERIC(10, 2) NOT NULL,
+            start_date DATE NOT NULL,
+            end_date DATE NOT NULL,
+            reminder_10_days BOOLEAN DEFAULT FALSE,
+            reminder_3_days BOOLEAN DEFAULT FALSE,
+            is_active BOOLEAN DEFAULT TRUE,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+        );
+    ''')
+    
+    # Создаем таблицы для планирования бюджета
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS budget_plans (
+            id SERIAL PRIMARY KEY,
+            plan_month DATE NOT NULL UNIQUE,
+            total_amount NUMERIC(12,2) NOT NULL,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+            group_id INTEGER DEFAULT 1
+        );
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS budget_plan_items (
+            id SERIAL PRIMARY KEY,
+            plan_id INTEGER NOT NULL REFERENCES budget_plans(id) ON DELETE CASCADE,
+            category VARCHAR(100) NOT NULL,
+            amount NUMERIC(12,2) NOT NULL,
+            comment TEXT,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+        );
+    ''')
+    
+    # Создаем таблицы для управления группами
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS groups (
+            id SERIAL PRIMARY KEY,
+            name VARCHAR(100) UNIQUE NOT NULL,
+            admin_user_id INTEGER NOT NULL,
+            max_members INTEGER DEFAULT 5,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+            invitation_code VARCHAR(20) UNIQUE NOT NULL
+        );
+    ''')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS group_members (
+            id SERIAL PRIMARY KEY,
+            group_id INTEGER NOT NULL REFERENCES groups(id) ON DELETE CASCADE,
+            user_id INTEGER NOT NULL,
+            phone VARCHAR(20) NOT NULL,
+            role VARCHAR(20) DEFAULT 'member',
+            joined_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+        );
+    ''')
+    
+    # Добавляем group_id в существующие таблицы
+    cursor.execute('ALTER TABLE expenses ADD COLUMN IF NOT EXISTS group_id INTEGER DEFAULT 1')
+    cursor.execute('ALTER TABLE payment_reminders ADD COLUMN IF NOT EXISTS group_id INTEGER DEFAULT 1')
+    
+    # Создаем таблицы для системы управления пользователями (Railway/Cloud)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_folders (
+            id SERIAL PRIMARY KEY,
+            username VARCHAR(100) NOT NULL,
+            user_id BIGINT,
+            folder_name VARCHAR(100) NOT NULL,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+            role VARCHAR(20) DEFAULT 'user',
+            settings JSONB DEFAULT '{}',
+            permissions JSONB DEFAULT '{}',
+            UNIQUE(username, user_id)
+        )
+    ''')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_categories (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT,
+            category_name VARCHAR(100) NOT NULL,
+            keywords TEXT[] DEFAULT '{}',
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(user_id, category_name)
+        )
+    ''')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_settings (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT,
+            setting_key VARCHAR(100) NOT NULL,
+            setting_value JSONB,
+            updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(user_id, setting_key)
+        )
+    ''')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_logs (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT,
+            log_level VARCHAR(20) NOT NULL,
+            message TEXT NOT NULL,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_data (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            data_type VARCHAR(50) NOT NULL,
+            data_content JSONB NOT NULL,
+            updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(user_id, data_type)
+        )
+    ''')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_backups (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            backup_name VARCHAR(100) NOT NULL,
+            backup_data JSONB NOT NULL,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
 
-def init_db():
+def run_schema_migrations() -> int:
+    """Применяет недостающие миграции схемы один раз при запуске"""
     conn = get_db_connection()
-    if conn:
-        cursor = conn.cursor()
-        # Удаляем user_id и family_id если есть
-        for col in ['user_id', 'family_id']:
-            try:
-                cursor.execute(f"ALTER TABLE expenses DROP COLUMN {col};")
-                conn.commit()
-                logger.info(f"Столбец {col} успешно удален из таблицы expenses.")
-            except psycopg2.errors.UndefinedColumn:
-                conn.rollback()
-            except Exception as e:
-                conn.rollback()
-                logger.error(f"Ошибка при удалении столбца {col}: {e}")
-        
-        # Создаем таблицу расходов
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS expenses (
-                id SERIAL PRIMARY KEY,
-                amount NUMERIC(10, 2) NOT NULL,
-                description TEXT,
-                category VARCHAR(100) NOT NULL,
-                transaction_date TIMESTAMP WITH TIME ZONE NOT NULL
-            );
-        ''')
-        
-        # Создаем таблицу напоминаний
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS payment_reminders (
-                id SERIAL PRIMARY KEY,
-                title VARCHAR(200) NOT NULL,
-                description TEXT,
-                amount NUMERIC(10, 2) NOT NULL,
-                start_date DATE NOT NULL,
-                end_date DATE NOT NULL,
-                reminder_10_days BOOLEAN DEFAULT FALSE,
-                reminder_3_days BOOLEAN DEFAULT FALSE,
-                is_active BOOLEAN DEFAULT TRUE,
-                created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-            );
-        ''')
-        
-        # Создаем таблицы для планирования бюджета
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS budget_plans (
-                id SERIAL PRIMARY KEY,
-                plan_month DATE NOT NULL UNIQUE,
-                total_amount NUMERIC(12,2) NOT NULL,
-                created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-                group_id INTEGER DEFAULT 1
-            );
-        ''')
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS budget_plan_items (
-                id SERIAL PRIMARY KEY,
-                plan_id INTEGER NOT NULL REFERENCES budget_plans(id) ON DELETE CASCADE,
-                category VARCHAR(100) NOT NULL,
-                amount NUMERIC(12,2) NOT NULL,
-                comment TEXT,
-                created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-            );
-        ''')
-        
-        # Создаем таблицы для управления группами
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS groups (
-                id SERIAL PRIMARY KEY,
-                name VARCHAR(100) UNIQUE NOT NULL,
-                admin_user_id INTEGER NOT NULL,
-                max_members INTEGER DEFAULT 5,
-                created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-                invitation_code VARCHAR(20) UNIQUE NOT NULL
-            );
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS group_members (
-                id SERIAL PRIMARY KEY,
-                group_id INTEGER NOT NULL REFERENCES groups(id) ON DELETE CASCADE,
-                user_id INTEGER NOT NULL,
-                phone VARCHAR(20) NOT NULL,
-                role VARCHAR(20) DEFAULT 'member',
-                joined_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-            );
-        ''')
-        
-        # Добавляем group_id в существующие таблицы
-        try:
-            cursor.execute('ALTER TABLE expenses ADD COLUMN IF NOT EXISTS group_id INTEGER DEFAULT 1')
-            cursor.execute('ALTER TABLE payment_reminders ADD COLUMN IF NOT EXISTS group_id INTEGER DEFAULT 1')
-        except Exception as e:
-            logger.info(f"Столбцы group_id уже существуют или не могут быть добавлены: {e}")
-        
-        # Создаем таблицы для системы управления пользователями (Railway/Cloud)
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_folders (
-                id SERIAL PRIMARY KEY,
-                username VARCHAR(100) NOT NULL,
-                user_id BIGINT,
-                folder_name VARCHAR(100) NOT NULL,
-                created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-                role VARCHAR(20) DEFAULT 'user',
-                settings JSONB DEFAULT '{}',
-                permissions JSONB DEFAULT '{}',
-                UNIQUE(username, user_id)
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_categories (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT,
-                category_name VARCHAR(100) NOT NULL,
-                keywords TEXT[] DEFAULT '{}',
-                created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(user_id, category_name)
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_settings (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT,
-                setting_key VARCHAR(100) NOT NULL,
-                setting_value JSONB,
-                updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(user_id, setting_key)
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_logs (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT,
-                log_level VARCHAR(20) NOT NULL,
-                message TEXT NOT NULL,
-                created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_data (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT NOT NULL,
-                data_type VARCHAR(50) NOT NULL,
-                data_content JSONB NOT NULL,
-                updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(user_id, data_type)
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_backups (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT NOT NULL,
-                backup_name VARCHAR(100) NOT NULL,
-                backup_data JSONB NOT NULL,
-                created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        conn.commit()
+    if not conn:
+        logger.info("PostgreSQL недоступен, миграции схемы пропущены")
+        return 0
+    try:
+        return schema_migrations.run(conn)
+    except Exception as e:
+        logger.error(f"Миграции схемы не применены: {e}")
+        return 0
+    finally:
         conn.close()
-        logger.info("База данных инициализирована (все таблицы проверены/созданы).")
 
 @monitor_performance
 def add_expense_old(amount, category, description, transaction_date, user_id=None):
@@ -740,35 +847,14 @@ def add_expense_old(amount, category, description, transaction_date, user_id=Non
                         return False
                     
                 expenses_file = f"{folder_path}/expenses.csv"
-                
-                # Читаем существующие расходы
-                expenses = []
-                if os.path.exists(expenses_file):
-                    with open(expenses_file, 'r', encoding='utf-8') as f:
-                        reader = csv.DictReader(f)
-                        expenses = list(reader)
-                
-                # Генерируем новый ID
-                new_id = max([int(exp.get('id', 0)) for exp in expenses if exp.get('id', '').isdigit()], default=0) + 1
-                
-                # Добавляем новый расход
-                new_expense = {
-                    'id': str(new_id),
-                    'amount': str(amount),
-                    'description': description,
-                    'category': category,
-                    'transaction_date': transaction_date.isoformat()
-                }
-                expenses.append(new_expense)
-                
-                # Записываем обратно в файл
-                with open(expenses_file, 'w', newline='', encoding='utf-8') as f:
-                    fieldnames = ['id', 'amount', 'description', 'category', 'transaction_date']
-                    writer = csv.DictWriter(f, fieldnames=fieldnames)
-                    writer.writeheader()
-                    writer.writerows(expenses)
-                
-                logger.info(f"Расход успешно добавлен в файл {expenses_file}")
+
+                # Дописываем расход в конец файла, ID берем из файла-счетчика;
+                # участники группы пишут в один журнал, поэтому под блокировкой папки
+                with folder_locks.lock(folder_path):
+                    new_expense = append_expense(expenses_file, amount, description, category, transaction_date)
+                    expense_rollups.record_change(expenses_file, None, new_expense)
+
+                logger.info(f"Расход #{new_expense['id']} успешно добавлен в файл {expenses_file}")
                 
                 # Синхронизируем в PostgreSQL
                 sync_to_database(user_id, "expense", "add", {
@@ -820,8 +906,45 @@ def add_expense(amount, category, description, transaction_date, user_id=None):
         logger.error(f"Ошибка при добавлении расхода: {e}")
         return False
 
-def get_expense_by_id(expense_id):
+async def add_expense_batched(amount, category, description, transaction_date, user_id) -> bool:
+    """
+    Добавляет расход из обработчика бота
+
+    Расходы файловых журналов одной папки, пришедшие почти одновременно,
+    записываются одной пачкой; PostgreSQL-пользователи и первая запись
+    в новую папку идут обычным путем add_expense.
+    """
+    folder_path = get_user_folder_path(user_id)
+    if is_legacy_user(user_id) or not os.path.exists(folder_path):
+        return await folder_locks.run(folder_path, add_expense, amount, category, description, transaction_date, user_id)
+    try:
+        row = await write_coalescer.append(folder_path, user_id, amount, description, category, transaction_date)
+        logger.info(f"Расход #{row['id']} успешно добавлен в папку {folder_path}")
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка при добавлении расхода для пользователя {user_id}: {e}")
+        return False
+
+def get_expense_by_id(expense_id, user_id: int = None):
     """Получить расход по ID"""
+    if user_id is not None:
+        # Файловый журнал: одно чтение индекса смещений и разбор одной строки
+        try:
+            expenses_file = f"{get_user_folder_path(user_id)}/expenses.csv"
+            row = find_expense(expenses_file, int(expense_id))
+            if not row:
+                return None
+            return (
+                int(row['id']),
+                float(row['amount']),
+                row['description'],
+                row['category'],
+                datetime.fromisoformat(row['transaction_date'].replace('Z', '+00:00'))
+            )
+        except Exception as e:
+            logger.error(f"Ошибка при получении расхода из файла для пользователя {user_id}: {e}")
+            return None
+    
     conn = get_db_connection()
     if not conn:
         return None
@@ -860,9 +983,6 @@ def update_expense_category(expense_id, new_category, user_id: int = None):
     else:
         # Используем файловую систему для новых пользователей
         try:
-            import csv
-            import os
-            
             folder_path = get_user_folder_path(user_id)
             expenses_file = f"{folder_path}/expenses.csv"
             
@@ -870,30 +990,21 @@ def update_expense_category(expense_id, new_category, user_id: int = None):
                 logger.warning(f"Файл расходов не найден: {expenses_file}")
                 return False
             
-            # Читаем все расходы
-            expenses = []
-            with open(expenses_file, 'r', encoding='utf-8') as f:
-                reader = csv.DictReader(f)
-                expenses = list(reader)
-            
-            # Находим и обновляем расход с указанным ID
-            updated = False
-            for exp in expenses:
-                if int(exp.get('id', 0)) == expense_id:
-                    exp['category'] = new_category
-                    updated = True
-                    break
-            
-            if not updated:
-                logger.warning(f"Расход с ID {expense_id} не найден")
-                return False
-            
-            # Записываем обновленный список обратно в файл
-            with open(expenses_file, 'w', newline='', encoding='utf-8') as f:
-                fieldnames = ['id', 'amount', 'description', 'category', 'transaction_date']
-                writer = csv.DictWriter(f, fieldnames=fieldnames)
-                writer.writeheader()
-                writer.writerows(expenses)
+            # Изменение дописывается в журнал изменений месяца, файл не переписывается;
+            # участники группы правят один журнал, поэтому под блокировкой папки
+            with folder_locks.lock(folder_path):
+                result = update_expense(expenses_file, expense_id, category=new_category)
+                if not result:
+                    logger.warning(f"Расход с ID {expense_id} не найден")
+                    return False
+                old_row, new_row = result
+
+                expense_rollups.record_change(expenses_file, old_row, new_row)
+                # Уже прочитанная загрузчиком строка изменилась — поправляем счетчики
+                training_loader.apply_change(
+                    partition_file(expenses_file, partition_key(old_row['transaction_date'])), expense_id,
+                    (old_row['description'], old_row['category']), (old_row['description'], new_category)
+                )
             
             logger.info(f"Категория расхода с ID {expense_id} успешно обновлена в файле {expenses_file}")
             return True
@@ -924,9 +1035,6 @@ def update_expense_amount(expense_id: int, new_amount: float, user_id: int = Non
     else:
         # Используем файловую систему для новых пользователей
         try:
-            import csv
-            import os
-            
             folder_path = get_user_folder_path(user_id)
             expenses_file = f"{folder_path}/expenses.csv"
             
@@ -934,31 +1042,14 @@ def update_expense_amount(expense_id: int, new_amount: float, user_id: int = Non
                 logger.warning(f"Файл расходов не найден: {expenses_file}")
                 return False
             
-            # Читаем все расходы
-            expenses = []
-            with open(expenses_file, 'r', encoding='utf-8') as f:
-                reader = csv.DictReader(f)
-                expenses = list(reader)
-            
-            # Находим и обновляем расход с указанным ID
-            updated = False
-            for exp in expenses:
-                if int(exp.get('id', 0)) == expense_id:
-                    exp['amount'] = str(new_amount)
-                    updated = True
-                    break
-            
-            if not updated:
-                logger.warning(f"Расход с ID {expense_id} не найден")
-                return False
-            
-            # Записываем обновленный список обратно в файл
-            with open(expenses_file, 'w', newline='', encoding='utf-8') as f:
-                fieldnames = ['id', 'amount', 'description', 'category', 'transaction_date']
-                writer = csv.DictWriter(f, fieldnames=fieldnames)
-                writer.writeheader()
-                writer.writerows(expenses)
-            
+            # Изменение дописывается в журнал изменений месяца, файл не переписывается
+            with folder_locks.lock(folder_path):
+                result = update_expense(expenses_file, expense_id, amount=new_amount)
+                if not result:
+                    logger.warning(f"Расход с ID {expense_id} не найден")
+                    return False
+
+                expense_rollups.record_change(expenses_file, *result)
             logger.info(f"Сумма расхода с ID {expense_id} успешно обновлена в файле {expenses_file}")
             return True
             
@@ -1000,10 +1091,10 @@ def get_recent_expenses(limit=10, user_id=None):
             if not os.path.exists(expenses_file):
                 return []
             
+            # Месяцы читаются от новых к старым, пока не наберется limit расходов
             expenses = []
-            with open(expenses_file, 'r', encoding='utf-8') as f:
-                reader = csv.DictReader(f)
-                for row in reader:
+            for key in reversed(list_partitions(expenses_file)):
+                for row in read_partition(expenses_file, key):
                     try:
                         exp_id = int(row.get('id', 0))
                         amount = float(row.get('amount', 0))
@@ -1015,6 +1106,8 @@ def get_recent_expenses(limit=10, user_id=None):
                     except (ValueError, TypeError) as e:
                         logger.warning(f"Ошибка парсинга строки расхода: {e}")
                         continue
+                if len(expenses) >= limit:
+                    break
             
             # Сортируем по дате (новые сначала) и ограничиваем количество
             expenses.sort(key=lambda x: x[4], reverse=True)
@@ -1024,67 +1117,32 @@ def get_recent_expenses(limit=10, user_id=None):
             logger.error(f"Ошибка при получении расходов из файлов для пользователя {user_id}: {e}")
             return []
 
+def fetch_training_rows_from_database(last_id: int) -> list:
+    """Новые пары (описание, категория, количество, max_id) из PostgreSQL после last_id"""
+    conn = get_db_connection()
+    if not conn:
+        return []
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT description, category, COUNT(*), MAX(id) FROM expenses
+            WHERE id > %s
+            GROUP BY description, category
+        ''', (last_id,))
+        return cursor.fetchall()
+    finally:
+        conn.close()
+
 def get_all_expenses_for_training():
-    """Получить все расходы для обучения модели из всех источников"""
-    training_data = []
-    
+    """
+    Получить все расходы для обучения модели из всех источников.
+    Возвращает уникальные тройки (описание, категория, количество);
+    источники дочитываются только с места прошлой загрузки.
+    """
     try:
-        # Получаем данные из PostgreSQL (для старых пользователей)
-        conn = get_db_connection()
-        if conn:
-            try:
-                cursor = conn.cursor()
-                cursor.execute('''
-                    SELECT description, category FROM expenses
-                ''')
-                db_data = cursor.fetchall()
-                training_data.extend(db_data)
-                logger.info(f"Добавлено {len(db_data)} записей из PostgreSQL для обучения")
-            except Exception as e:
-                logger.error(f"Ошибка при получении данных из PostgreSQL для обучения: {e}")
-            finally:
-                conn.close()
-        
-        # Получаем данные из файловой системы (для новых пользователей и групп)
-        import os
-        import csv
-        
-        # Проверяем папки пользователей
-        users_dir = "users"
-        if os.path.exists(users_dir):
-            for user_folder in os.listdir(users_dir):
-                user_path = os.path.join(users_dir, user_folder)
-                if os.path.isdir(user_path):
-                    expenses_file = os.path.join(user_path, "expenses.csv")
-                    if os.path.exists(expenses_file):
-                        try:
-                            with open(expenses_file, 'r', encoding='utf-8') as f:
-                                reader = csv.DictReader(f)
-                                for row in reader:
-                                    if row.get('description') and row.get('category'):
-                                        training_data.append((row['description'], row['category']))
-                        except Exception as e:
-                            logger.error(f"Ошибка при чтении файла расходов {expenses_file}: {e}")
-        
-        # Проверяем папки групп
-        group_data_dir = "group_data"
-        if os.path.exists(group_data_dir):
-            for item in os.listdir(group_data_dir):
-                if item.startswith("group_"):
-                    group_folder = os.path.join(group_data_dir, item)
-                    if os.path.isdir(group_folder):
-                        expenses_file = os.path.join(group_folder, "expenses.csv")
-                        if os.path.exists(expenses_file):
-                            try:
-                                with open(expenses_file, 'r', encoding='utf-8') as f:
-                                    reader = csv.DictReader(f)
-                                    for row in reader:
-                                        if row.get('description') and row.get('category'):
-                                            training_data.append((row['description'], row['category']))
-                            except Exception as e:
-                                logger.error(f"Ошибка при чтении файла расходов группы {expenses_file}: {e}")
-        
-        logger.info(f"Всего собрано {len(training_data)} записей для обучения модели")
+        training_loader.refresh(fetch_training_rows_from_database)
+        training_data = list(training_loader.iter_pairs())
+        logger.info(f"Всего собрано {len(training_data)} уникальных пар ({training_loader.total_count()} записей) для обучения модели")
         return training_data
         
     except Exception as e:
@@ -1117,9 +1175,6 @@ def delete_expense(expense_id: int, user_id: int = None) -> bool:
     else:
         # Используем файловую систему для новых пользователей
         try:
-            import csv
-            import os
-            
             folder_path = get_user_folder_path(user_id)
             expenses_file = f"{folder_path}/expenses.csv"
             
@@ -1127,32 +1182,18 @@ def delete_expense(expense_id: int, user_id: int = None) -> bool:
                 logger.warning(f"Файл расходов не найден: {expenses_file}")
                 return False
             
-            # Читаем все расходы
-            expenses = []
-            with open(expenses_file, 'r', encoding='utf-8') as f:
-                reader = csv.DictReader(f)
-                expenses = list(reader)
-            
-            # Находим и удаляем расход с указанным ID
-            original_count = len(expenses)
-            expenses = [exp for exp in expenses if int(exp.get('id', 0)) != expense_id]
-            
-            if len(expenses) == original_count:
-                logger.warning(f"Расход с ID {expense_id} не найден")
-                return False
-            
-            # Записываем обновленный список обратно в файл
-            with open(expenses_file, 'w', newline='', encoding='utf-8') as f:
-                if expenses:
-                    fieldnames = ['id', 'amount', 'description', 'category', 'transaction_date']
-                    writer = csv.DictWriter(f, fieldnames=fieldnames)
-                    writer.writeheader()
-                    writer.writerows(expenses)
-                else:
-                    # Если файл пустой, создаем только заголовки
-                    fieldnames = ['id', 'amount', 'description', 'category', 'transaction_date']
-                    writer = csv.DictWriter(f, fieldnames=fieldnames)
-                    writer.writeheader()
+            # Изменение дописывается в журнал изменений месяца, файл не переписывается
+            with folder_locks.lock(folder_path):
+                removed = remove_expense(expenses_file, expense_id)
+                if not removed:
+                    logger.warning(f"Расход с ID {expense_id} не найден")
+                    return False
+
+                expense_rollups.record_change(expenses_file, removed, None)
+                training_loader.apply_change(
+                    partition_file(expenses_file, partition_key(removed['transaction_date'])), expense_id,
+                    (removed['description'], removed['category']), None
+                )
             
             logger.info(f"Расход с ID {expense_id} успешно удален из файла {expenses_file}")
             
@@ -1261,8 +1302,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     username = update.effective_user.username or update.effective_user.first_name
     
     # Проверяем, является ли пользователь администратором
-    users_data = load_authorized_users()
-    is_admin = user_id == users_data.get("admin")
+    is_admin = user_id == auth_registry.get_admin()
     
     if is_admin:
         # Показываем админ-меню
@@ -1275,6 +1315,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # Проверяем, авторизован ли пользователь
     if not is_user_authorized(user_id):
         # Проверяем, есть ли пользователь в списке по username
+        users_data = load_authorized_users()
         found_user = None
         for user in users_data.get("users", []):
             if user.get("username") == username:
@@ -1340,9 +1381,7 @@ async def debug_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
             expenses_file = f"{folder_path}/expenses.csv"
             if os.path.exists(expenses_file):
                 message += "✅ Файл расходов существует\n"
-                with open(expenses_file, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                    message += f"📊 Размер файла: {len(content)} символов\n"
+                message += f"📊 Месяцев: {len(list_partitions(expenses_file))}, расходов: {count_expenses(expenses_file)}\n"
             else:
                 message += "❌ Файл расходов не существует\n"
         
@@ -1875,9 +1914,7 @@ async def admin_system_stats(update: Update, context: ContextTypes.DEFAULT_TYPE)
                     expenses_file = os.path.join(folder_path, "expenses.csv")
                     if os.path.exists(expenses_file):
                         try:
-                            with open(expenses_file, 'r', encoding='utf-8') as f:
-                                reader = csv.DictReader(f)
-                                total_expenses += len(list(reader))
+                            total_expenses += count_expenses(expenses_file)
                         except:
                             pass
                     
@@ -2421,8 +2458,14 @@ async def expense_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             )
             return ConversationHandler.END
         
-        # Сохраняем выбранный расход
-        selected_expense = expenses[choice - 1]
+        # Сохраняем выбранный расход в актуальном виде (список мог устареть)
+        selected_expense = get_expense_by_id(expenses[choice - 1][0], update.effective_user.id)
+        if not selected_expense:
+            await update.message.reply_text(
+                "Ошибка: расход не найден. Попробуйте снова.",
+                reply_markup=get_main_menu_keyboard()
+            )
+            return ConversationHandler.END
         context.user_data['selected_expense'] = selected_expense
         
         exp_id, amount, desc, cat, date = selected_expense
@@ -2487,7 +2530,7 @@ async def category_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     user_id = update.effective_user.id
     
     # Обновляем категорию в базе данных
-    if update_expense_category(exp_id, new_category, user_id):
+    if await folder_locks.run(get_user_folder_path(user_id), update_expense_category, exp_id, new_category, user_id):
         context.user_data['selected_expense'] = (exp_id, amount, desc, new_category, date)
         await update.message.reply_text(
             f"✅ Категория обновлена!\n\n"
@@ -2527,7 +2570,7 @@ async def amount_edit(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
     # Обновляем сумму, если изменилась
     if abs(float(new_amount) - float(old_amount)) > 1e-9:
         user_id = update.effective_user.id
-        if not update_expense_amount(exp_id, new_amount, user_id):
+        if not await folder_locks.run(get_user_folder_path(user_id), update_expense_amount, exp_id, new_amount, user_id):
             await update.message.reply_text(
                 "❌ Не удалось обновить сумму.",
                 reply_markup=get_main_menu_keyboard()
@@ -2538,33 +2581,49 @@ async def amount_edit(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
         f"✅ Обновлено!\n"
         f"📝 {desc}\n"
         f"🏷️ Категория: {new_category}\n"
-        f"💰 Сумма: {float(new_amount):.2f} Тг\n\n"
-        f"Переобучаю модель...",
+        f"💰 Сумма: {float(new_amount):.2f} Тг",
         reply_markup=get_main_menu_keyboard()
     )
 
-    # Автоматически переобучаем модель на исправленных данных
-    await retrain_model_on_corrected_data(update, context)
+    # Дообучаем модель на исправлении; полное переобучение — периодически в фоне
+    if learn_correction(desc, new_category):
+        await retrain_model_on_corrected_data(update, context)
+    else:
+        await update.message.reply_text(
+            "🤖 Модель учла исправление. Похожие товары будут классифицироваться правильно."
+        )
     return ConversationHandler.END
 
+async def run_background_training(update: Update, context: ContextTypes.DEFAULT_TYPE, training_data, done_text: str) -> None:
+    """Обучает модель в пуле процессов и сообщает пользователю о завершении"""
+    try:
+        if await train_model_async(training_data):
+            await update.message.reply_text(done_text)
+        else:
+            await update.message.reply_text("⚠️ Недостаточно данных для обучения модели.")
+    except Exception as e:
+        logger.error(f"Ошибка при фоновом обучении модели: {e}")
+        await update.message.reply_text(f"⚠️ Ошибка при переобучении модели: {e}")
+
 async def retrain_model_on_corrected_data(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Переобучение модели на исправленных данных"""
     try:
-        # Получаем все расходы из базы данных
-        training_data = get_all_expenses_for_training()
+        # Получаем все расходы (чтение БД и файлов — вне event loop)
+        training_data = await asyncio.to_thread(get_all_expenses_for_training)
         
         if training_data:
-            # Обучаем модель на исправленных данных
-            train_model(training_data)
-            
-            # Также добавляем исправленные данные в словарь категорий
-            for description, category in training_data:
-                if category in CATEGORIES and description.lower() not in [w.lower() for w in CATEGORIES[category]]:
-                    CATEGORIES[category].append(description.lower())
-            
             await update.message.reply_text(
-                "🤖 Модель успешно переобучена на исправленных данных!\n"
-                "Теперь похожие товары будут автоматически классифицироваться правильно."
+                "🤖 Переобучение модели запущено. Бот продолжает работать, "
+                "я сообщу, когда модель обновится."
+            )
+            # Обучение идет в фоне; до его окончания используется прежняя модель
+            context.application.create_task(
+                run_background_training(
+                    update, context, training_data,
+                    "🤖 Модель успешно переобучена на исправленных данных!\n"
+                    "Теперь похожие товары будут автоматически классифицироваться правильно."
+                ),
+                update=update
             )
         else:
             await update.message.reply_text(
@@ -2589,11 +2648,11 @@ async def manual_training(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
     
     try:
-        training_data = get_all_expenses_for_training()
+        training_data = await asyncio.to_thread(get_all_expenses_for_training)
         
         if training_data:
             # Проверяем количество уникальных категорий
-            unique_categories = set(category for _, category in training_data)
+            unique_categories = set(item[1] for item in training_data)
             
             if len(unique_categories) < 2:
                 categories_list = list(unique_categories)
@@ -2606,22 +2665,24 @@ async def manual_training(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                 return
             
             # Сохраняем количество записей до обучения
-            records_count = len(training_data)
-            
-            # Обучаем модель
-            train_model(training_data)
-            
-            # Обновляем словарь категорий
-            for description, category in training_data:
-                if category in CATEGORIES and description.lower() not in [w.lower() for w in CATEGORIES[category]]:
-                    CATEGORIES[category].append(description.lower())
+            records_count = sum(item[2] for item in training_data)
             
             await update.message.reply_text(
-                f"🤖 Модель успешно обучена на {records_count} записях!\n"
-                f"Категории: {', '.join(unique_categories)}\n"
-                "Теперь классификация будет более точной.",
+                f"🤖 Обучение модели на {records_count} записях запущено.\n"
+                "Бот продолжает работать, я сообщу, когда модель обновится.",
                 reply_markup=get_main_menu_keyboard()
             )
+            
+            # Обучаем модель в фоне
+            context.application.create_task(
+                run_background_training(
+                    update, context, training_data,
+                    f"🤖 Модель успешно обучена на {records_count} записях!\n"
+                    f"Категории: {', '.join(unique_categories)}\n"
+                    "Теперь классификация будет более точной."
+                ),
+                update=update
+            )
         else:
             await update.message.reply_text(
                 "⚠️ Нет данных для обучения модели. Сначала добавьте несколько расходов.",
@@ -2635,6 +2696,50 @@ async def manual_training(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         )
 
 
+def load_db_report(start_date: datetime, end_date: datetime):
+    """
+    Строки и итоги отчета из PostgreSQL (выполняется в потоке)
+
+    Returns:
+        (строки, итоги) или (None, None), если нет соединения с БД
+    """
+    conn = get_db_connection()
+    if not conn:
+        return None, None
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT description, category, amount, transaction_date
+            FROM expenses
+            WHERE DATE(transaction_date) >= %s AND DATE(transaction_date) <= %s
+            ORDER BY transaction_date DESC
+        ''', (start_date, end_date))
+        
+        data = []
+        for row in cursor.fetchall():
+            description, category, amount, transaction_date = row
+            data.append((
+                description,
+                category,
+                float(amount),
+                transaction_date
+            ))
+    finally:
+        conn.close()
+    return data, summarize_report(data)
+
+def load_file_report(expenses_file: str, start: date, end: date):
+    """
+    Итоги и агрегаты графика из файлового журнала (выполняется в потоке)
+
+    Итоги и топ категорий берутся из агрегатов, данные графика — из
+    колоночного представления журнала; строки CSV не разбираются.
+    """
+    summary = expense_rollups.period_summary(expenses_file, start, end)
+    if summary['transactions'] == 0:
+        return summary, None
+    return summary, columnar_store.aggregate(expenses_file, start, end)
+
 async def period_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     period_text = update.message.text.lower()
     start_date, end_date = parse_date_period(period_text)
@@ -2643,121 +2748,66 @@ async def period_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         return ConversationHandler.END
 
     user_id = update.effective_user.id
+    # Ключ кэша отчета: только для файловых журналов, где известна версия
+    cache_folder = None
+    period_key = (period_text, start_date.date(), end_date.date())
+    version = None
+    summary = None
+    aggregates = None
     
     # Проверяем, является ли пользователь "старым" (использует PostgreSQL)
     if is_legacy_user(user_id):
         logger.info(f"Пользователь {user_id} - старый, используем PostgreSQL для отчета")
-        # Используем PostgreSQL для старых пользователей
-        conn = get_db_connection()
-        if not conn:
-            await update.message.reply_text("Проблема с подключением к базе данных.", reply_markup=get_main_menu_keyboard())
-            return ConversationHandler.END
-
+        # Используем PostgreSQL для старых пользователей (запрос — вне event loop)
         try:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT description, category, amount, transaction_date
-                FROM expenses
-                WHERE DATE(transaction_date) >= %s AND DATE(transaction_date) <= %s
-                ORDER BY transaction_date DESC
-            ''', (start_date, end_date))
-            
-            data = []
-            for row in cursor.fetchall():
-                description, category, amount, transaction_date = row
-                data.append((
-                    description,
-                    category,
-                    float(amount),
-                    transaction_date
-                ))
-            conn.close()
+            data, summary = await asyncio.to_thread(load_db_report, start_date, end_date)
         except Exception as e:
             await update.message.reply_text(f"Произошла ошибка при получении отчета из PostgreSQL: {e}", reply_markup=get_main_menu_keyboard())
             return ConversationHandler.END
+        if data is None:
+            await update.message.reply_text("Проблема с подключением к базе данных.", reply_markup=get_main_menu_keyboard())
+            return ConversationHandler.END
+        ledger = None
     else:
         # Используем файлы для новых пользователей
         try:
             folder_path = get_user_folder_path(user_id)
             expenses_file = f"{folder_path}/expenses.csv"
             
-            data = []
-            if os.path.exists(expenses_file):
-                import csv
-                with open(expenses_file, 'r', encoding='utf-8') as f:
-                    reader = csv.DictReader(f)
-                    for row in reader:
-                        transaction_date = datetime.fromisoformat(row['transaction_date'].replace('Z', '+00:00'))
-                        if start_date.date() <= transaction_date.date() <= end_date.date():
-                            data.append((
-                                row['description'],
-                                row['category'],
-                                float(row['amount']),
-                                transaction_date
-                            ))
+            # Версию берем до чтения: запись во время чтения сделает кэш устаревшим
+            cache_folder = folder_path
+            version = ledger_version(expenses_file)
+            cached_report = report_cache.get(cache_folder, period_key, version)
+            if cached_report:
+                await send_period_report(update, period_text, cached_report)
+                return ConversationHandler.END
+            
+            # Итоги и агрегаты — в потоке: пересборка агрегатов не останавливает другие чаты
+            summary, aggregates = await asyncio.to_thread(load_file_report, expenses_file, start_date.date(), end_date.date())
         except Exception as e:
             await update.message.reply_text(f"Произошла ошибка при получении отчета из файлов: {e}", reply_markup=get_main_menu_keyboard())
             return ConversationHandler.END
+        # Строки CSV нужны только для Excel и читаются в процессе пула
+        data = None
+        ledger = (expenses_file, start_date.date(), end_date.date())
 
-    if not data:
+    if summary['transactions'] == 0:
         await update.message.reply_text("За выбранный период нет расходов.", reply_markup=get_main_menu_keyboard())
         return ConversationHandler.END
 
-    # Создание DataFrame с полными данными
+    # График и Excel строятся параллельно в пуле процессов
     try:
-        df = pd.DataFrame(data, columns=['Описание', 'Категория', 'Сумма', 'Дата транзакции'])
-        df['Месяц'] = pd.to_datetime(df['Дата транзакции']).dt.strftime('%b')
-        df['День недели'] = pd.to_datetime(df['Дата транзакции']).dt.strftime('%a')
-        df['Неделя'] = pd.to_datetime(df['Дата транзакции']).dt.isocalendar().week
-        
-        # Группировка данных для различных графиков
-        grouped_by_category = df.groupby('Категория', as_index=False)['Сумма'].sum().sort_values(by='Сумма', ascending=False)
-        grouped_by_month = df.groupby('Месяц', as_index=False)['Сумма'].sum()
-        grouped_by_week = df.groupby('Неделя', as_index=False)['Сумма'].sum()
-        
-        categories = grouped_by_category['Категория'].tolist()
-        amounts = grouped_by_category['Сумма'].tolist()
-        total = df['Сумма'].sum()
-        
-        # Статистика
-        avg_expense = df['Сумма'].mean()
-        max_expense = df['Сумма'].max()
-        min_expense = df['Сумма'].min()
-        total_transactions = len(df)
-        
+        chart_png, excel_bytes = await report_renderer.render(data, period_text, aggregates, ledger=ledger)
     except Exception as e:
-        logger.error(f"Ошибка при создании DataFrame: {e}")
+        logger.error(f"Ошибка при построении отчета: {e}")
+        await update.message.reply_text("Не удалось построить отчет, попробуйте позже.", reply_markup=get_main_menu_keyboard())
         return ConversationHandler.END
-
-    # Создание Excel файла
-    excel_buf = io.BytesIO()
-    # Убираем timezone из datetime для совместимости с Excel
-    df_copy = df.copy()
-    if 'Дата транзакции' in df_copy.columns:
-        # Конвертируем в строку для совместимости с Excel
-        df_copy['Дата транзакции'] = pd.to_datetime(df_copy['Дата транзакции']).dt.strftime('%Y-%m-%d %H:%M:%S')
-    df_copy.to_excel(excel_buf, index=False, engine='xlsxwriter')
-    excel_buf.seek(0)
-
-    # Создание отчета в зависимости от периода
-    if 'сегодня' in period_text:
-        fig = create_today_report(df, grouped_by_category, categories, amounts, total)
-    elif 'неделя' in period_text:
-        fig = create_week_report(df, grouped_by_category, categories, amounts, total)
-    elif 'месяц' in period_text:
-        fig = create_month_report(df, grouped_by_category, grouped_by_week, categories, amounts, total)
-    elif 'год' in period_text:
-        fig = create_year_report(df, grouped_by_category, grouped_by_month, categories, amounts, total)
-    else:
-        # Fallback для неизвестных периодов
-        fig = create_today_report(df, grouped_by_category, categories, amounts, total)
-
-    # Сохранение графика
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', bbox_inches='tight', dpi=150, 
-                facecolor='#1a1a1a', edgecolor='none')
-    buf.seek(0)
-    plt.close(fig)
+    
+    total = summary['total']
+    avg_expense = summary['average']
+    total_transactions = summary['transactions']
+    categories = summary['categories']
+    amounts = summary['amounts']
 
     # Текстовая сводка
     summary_text = f"📊 ОТЧЕТ ЗА {period_text.upper()}\n\n"
@@ -2769,183 +2819,20 @@ async def period_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     for i, (cat, amt) in enumerate(zip(categories[:5], amounts[:5]), 1):
         summary_text += f"{i}. {cat}: {amt:.2f} Тг\n"
     
+    report = ReportArtifact(chart_png, excel_bytes, summary_text)
+    if cache_folder:
+        report_cache.put(cache_folder, period_key, version, report)
     
-    # Отправка отчета и сводки
-    await update.message.reply_photo(photo=buf, caption=summary_text, reply_markup=get_main_menu_keyboard())
-
-    # Отправка Excel файла
-    await update.message.reply_document(document=excel_buf, filename=f"Отчет_{period_text}.xlsx")
+    await send_period_report(update, period_text, report)
     return ConversationHandler.END
 
-def create_today_report(df, grouped_by_category, categories, amounts, total):
-    """Создание отчета за сегодня - красивый пирог с понятными тегами"""
-    fig, ax = plt.subplots(figsize=(12, 8))
-    fig.patch.set_facecolor('#1a1a1a')
-    
-    # Цветовая палитра
-    colors = ['#6B8E23', '#4682B4', '#CD853F', '#20B2AA', '#8A2BE2', '#32CD32', '#FF8C00', '#DC143C', '#1E90FF', '#9370DB']
-    
-    # Создаем красивый пирог
-    wedges, texts, autotexts = ax.pie(amounts, labels=categories, autopct='%1.1f%%', 
-                                      startangle=90, colors=colors[:len(amounts)],
-                                      textprops={'fontsize': 14, 'fontweight': 'bold', 'color': 'white'},
-                                      shadow=True, explode=[0.05] * len(amounts))
-    
-    # Настройка процентов
-    for autotext in autotexts:
-        autotext.set_color('white')
-        autotext.set_fontweight('bold')
-        autotext.set_fontsize(13)
-    
-    # Центральный текст
-    ax.text(0, 0, f'ОБЩИЕ\nРАСХОДЫ\n{total:.0f} Тг', ha='center', va='center', 
-            fontsize=20, fontweight='bold', color='white')
-    
-    ax.set_title('РАСХОДЫ ЗА СЕГОДНЯ', color='white', fontsize=22, fontweight='bold', pad=30)
-    
-    # Легенда справа
-    legend_labels = [f"{cat} — {amt:.0f} Тг" for cat, amt in zip(categories, amounts)]
-    ax.legend(wedges, legend_labels, title="Категории", loc="center left", 
-             bbox_to_anchor=(1.1, 0.5), fontsize=13, title_fontsize=15)
-    
-    return fig
-
-def create_week_report(df, grouped_by_category, categories, amounts, total):
-    """Создание отчета за неделю - только пирог категорий"""
-    fig = plt.figure(figsize=(12, 8))
-    fig.patch.set_facecolor('#1a1a1a')
-    
-    # Цветовая палитра
-    colors = ['#6B8E23', '#4682B4', '#CD853F', '#20B2AA', '#8A2BE2', '#32CD32', '#FF8C00', '#DC143C', '#1E90FF', '#9370DB']
-    
-    # Пирог категорий (полная ширина)
-    ax1 = fig.add_subplot(1, 1, 1)
-    wedges, texts, autotexts = ax1.pie(amounts, labels=None, autopct='%1.1f%%', 
-                                       startangle=90, colors=colors[:len(amounts)],
-                                       shadow=True, explode=[0.05] * len(amounts))
-    
-    # Настройка процентов
-    for autotext in autotexts:
-        autotext.set_color('white')
-        autotext.set_fontweight('bold')
-        autotext.set_fontsize(13)
-    
-    # Центральный текст
-    ax1.text(0, 0, f'ОБЩИЕ\nРАСХОДЫ\n{total:.0f} Тг', ha='center', va='center', 
-            fontsize=18, fontweight='bold', color='white')
-    
-    ax1.set_title('РАСХОДЫ ПО КАТЕГОРИЯМ', color='white', fontsize=18, fontweight='bold', pad=20)
-    
-    # Легенда для пирога
-    legend_labels = [f"{cat} — {amt:.0f} Тг" for cat, amt in zip(categories, amounts)]
-    ax1.legend(wedges, legend_labels, title="Категории", loc="center left", 
-              bbox_to_anchor=(1.0, 0.5), fontsize=12, title_fontsize=14)
-    
-    fig.suptitle('ОТЧЕТ ЗА НЕДЕЛЮ', color='white', fontsize=22, fontweight='bold', y=0.95)
-    
-    return fig
-
-def create_month_report(df, grouped_by_category, grouped_by_week, categories, amounts, total):
-    """Создание отчета за месяц - пирог и сравнение недель"""
-    fig = plt.figure(figsize=(16, 8))
-    fig.patch.set_facecolor('#1a1a1a')
-    
-    # Цветовая палитра
-    colors = ['#6B8E23', '#4682B4', '#CD853F', '#20B2AA', '#8A2BE2', '#32CD32', '#FF8C00', '#DC143C', '#1E90FF', '#9370DB']
-    
-    # 1. Пирог категорий (левая часть)
-    ax1 = fig.add_subplot(1, 2, 1)
-    wedges, texts, autotexts = ax1.pie(amounts, labels=None, autopct='%1.1f%%', 
-                                       startangle=90, colors=colors[:len(amounts)],
-                                       shadow=True, explode=[0.05] * len(amounts))
-    
-    for autotext in autotexts:
-        autotext.set_color('white')
-        autotext.set_fontweight('bold')
-        autotext.set_fontsize(13)
-    
-    ax1.text(0, 0, f'ОБЩИЕ\nРАСХОДЫ\n{total:.0f} Тг', ha='center', va='center', 
-            fontsize=16, fontweight='bold', color='white')
-    
-    ax1.set_title('РАСХОДЫ ПО КАТЕГОРИЯМ', color='white', fontsize=16, fontweight='bold', pad=20)
-    
-    # 2. Сравнение недель (правая часть)
-    ax2 = fig.add_subplot(1, 2, 2)
-    weeks = grouped_by_week['Неделя'].tolist()
-    week_amounts = grouped_by_week['Сумма'].tolist()
-    
-    bars = ax2.bar(weeks, week_amounts, color=colors[:len(weeks)], alpha=0.8)
-    ax2.set_title('СРАВНЕНИЕ НЕДЕЛЬ', color='white', fontsize=16, fontweight='bold', pad=20)
-    ax2.set_ylabel('Сумма (Тг)', color='white', fontsize=14)
-    ax2.set_xlabel('Номер недели', color='white', fontsize=14)
-    ax2.tick_params(colors='white')
-    ax2.grid(True, alpha=0.2, linestyle='--', linewidth=0.5)
-    
-    # Добавляем значения на столбцы
-    for bar, amount in zip(bars, week_amounts):
-        height = bar.get_height()
-        ax2.text(bar.get_x() + bar.get_width()/2., height + max(week_amounts)*0.01,
-                 f'{amount:.0f}', ha='center', va='bottom', color='white', fontweight='bold', fontsize=12)
-    
-    # Легенда для пирога
-    legend_labels = [f"{cat} — {amt:.0f} Тг" for cat, amt in zip(categories, amounts)]
-    ax1.legend(wedges, legend_labels, title="Категории", loc="upper left", 
-              bbox_to_anchor=(-0.1, 1.0), fontsize=11, title_fontsize=13)
-    
-    fig.suptitle('ОТЧЕТ ЗА МЕСЯЦ', color='white', fontsize=22, fontweight='bold', y=0.95)
-    
-    return fig
+async def send_period_report(update: Update, period_text: str, report: ReportArtifact):
+    """Отправляет график со сводкой и Excel-файл отчета"""
+    # Отправка отчета и сводки
+    await update.message.reply_photo(photo=io.BytesIO(report.chart), caption=report.summary_text, reply_markup=get_main_menu_keyboard())
 
-def create_year_report(df, grouped_by_category, grouped_by_month, categories, amounts, total):
-    """Создание отчета за год - пирог и сравнение месяцев"""
-    fig = plt.figure(figsize=(16, 8))
-    fig.patch.set_facecolor('#1a1a1a')
-    
-    # Цветовая палитра
-    colors = ['#6B8E23', '#4682B4', '#CD853F', '#20B2AA', '#8A2BE2', '#32CD32', '#FF8C00', '#DC143C', '#1E90FF', '#9370DB']
-    
-    # 1. Пирог категорий (левая часть)
-    ax1 = fig.add_subplot(1, 2, 1)
-    wedges, texts, autotexts = ax1.pie(amounts, labels=None, autopct='%1.1f%%', 
-                                       startangle=90, colors=colors[:len(amounts)],
-                                       shadow=True, explode=[0.05] * len(amounts))
-    
-    for autotext in autotexts:
-        autotext.set_color('white')
-        autotext.set_fontweight('bold')
-        autotext.set_fontsize(13)
-    
-    ax1.text(0, 0, f'ОБЩИЕ\nРАСХОДЫ\n{total:.0f} Тг', ha='center', va='center', 
-            fontsize=16, fontweight='bold', color='white')
-    
-    ax1.set_title('РАСХОДЫ ПО КАТЕГОРИЯМ', color='white', fontsize=16, fontweight='bold', pad=20)
-    
-    # 2. Сравнение месяцев (правая часть)
-    ax2 = fig.add_subplot(1, 2, 2)
-    months = grouped_by_month['Месяц'].tolist()
-    month_amounts = grouped_by_month['Сумма'].tolist()
-    
-    bars = ax2.bar(months, month_amounts, color=colors[:len(months)], alpha=0.8)
-    ax2.set_title('СРАВНЕНИЕ МЕСЯЦЕВ', color='white', fontsize=16, fontweight='bold', pad=20)
-    ax2.set_ylabel('Сумма (Тг)', color='white', fontsize=14)
-    ax2.set_xlabel('Месяц', color='white', fontsize=14)
-    ax2.tick_params(colors='white')
-    ax2.grid(True, alpha=0.2, linestyle='--', linewidth=0.5)
-    
-    # Добавляем значения на столбцы
-    for bar, amount in zip(bars, month_amounts):
-        height = bar.get_height()
-        ax2.text(bar.get_x() + bar.get_width()/2., height + max(month_amounts)*0.01,
-                 f'{amount:.0f}', ha='center', va='bottom', color='white', fontweight='bold', fontsize=12)
-    
-    # Легенда для пирога
-    legend_labels = [f"{cat} — {amt:.0f} Тг" for cat, amt in zip(categories, amounts)]
-    ax1.legend(wedges, legend_labels, title="Категории", loc="upper left", 
-              bbox_to_anchor=(-0.1, 1.0), fontsize=11, title_fontsize=13)
-    
-    fig.suptitle('ОТЧЕТ ЗА ГОД', color='white', fontsize=22, fontweight='bold', y=0.95)
-    
-    return fig
+    # Отправка Excel файла
+    await update.message.reply_document(document=io.BytesIO(report.excel), filename=f"Отчет_{period_text}.xlsx")
 
 def parse_expense_input(text: str) -> Tuple[Optional[float], Optional[str]]:
     """
@@ -3382,7 +3269,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     try:
         category = classify_expense(description, user_id)
         transaction_date = datetime.now(timezone.utc)
-        if add_expense(amount, category, description, transaction_date, user_id): 
+        added = await add_expense_batched(amount, category, description, transaction_date, user_id)
+        if added:
             await update.message.reply_text(
                 f"✅ Расход '{description}' ({amount:.2f}) записан в категорию '{category}'!\n\n"
                 f"💡 Если категория неправильная, используйте '🔧 Исправить категории' для исправления.",
@@ -3731,135 +3619,6 @@ async def create_analytics_chart(update: Update, context: ContextTypes.DEFAULT_T
         
 
 
-def ensure_tables_exist():
-    """Проверяет и создает таблицы, если их нет"""
-    try:
-        conn = get_db_connection()
-        if not conn:
-            logger.error("Не удалось подключиться к БД для создания таблиц")
-            return False
-        
-        cursor = conn.cursor()
-        
-        # Проверяем, существует ли таблица users
-        try:
-            cursor.execute("""
-                SELECT EXISTS (
-                    SELECT FROM information_schema.tables 
-                    WHERE table_name = 'users'
-                );
-            """)
-            
-            users_exists = cursor.fetchone()[0]
-            logger.info(f"Таблица users существует: {users_exists}")
-            
-        except Exception as e:
-            logger.error(f"Ошибка проверки существования таблицы users: {e}")
-            users_exists = False
-        
-        if not users_exists:
-            logger.info("Таблица users не существует, создаем все таблицы...")
-            
-            # Создаем таблицы по одной
-            tables_sql = [
-                """
-                CREATE TABLE IF NOT EXISTS users (
-                    id SERIAL PRIMARY KEY,
-                    telegram_id BIGINT UNIQUE NOT NULL,
-                    username VARCHAR(255),
-                    folder_name VARCHAR(255),
-                    role VARCHAR(50) DEFAULT 'user',
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    is_active BOOLEAN DEFAULT TRUE
-                );
-                """,
-                """
-                CREATE TABLE IF NOT EXISTS user_categories (
-                    id SERIAL PRIMARY KEY,
-                    user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
-                    category_name VARCHAR(255) NOT NULL,
-                    category_type VARCHAR(50) DEFAULT 'expense',
-                    color VARCHAR(7) DEFAULT '#3498db',
-                    icon VARCHAR(50),
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    UNIQUE(user_id, category_name)
-                );
-                """,
-                """
-                CREATE TABLE IF NOT EXISTS expenses (
-                    id SERIAL PRIMARY KEY,
-                    user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
-                    category_id INTEGER REFERENCES user_categories(id) ON DELETE SET NULL,
-                    amount DECIMAL(10,2) NOT NULL,
-                    description TEXT,
-                    date DATE NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-                """,
-                """
-                CREATE TABLE IF NOT EXISTS budget_plans (
-                    id SERIAL PRIMARY KEY,
-                    user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
-                    plan_name VARCHAR(255) NOT NULL,
-                    total_amount DECIMAL(10,2) NOT NULL,
-                    spent_amount DECIMAL(10,2) DEFAULT 0.00,
-                    start_date DATE NOT NULL,
-                    end_date DATE NOT NULL,
-                    categories JSONB,
-                    is_active BOOLEAN DEFAULT TRUE,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-                """,
-                """
-                CREATE TABLE IF NOT EXISTS reminders (
-                    id SERIAL PRIMARY KEY,
-                    user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
-                    title VARCHAR(255) NOT NULL,
-                    description TEXT,
-                    reminder_date DATE NOT NULL,
-                    reminder_time TIME,
-                    is_recurring BOOLEAN DEFAULT FALSE,
-                    recurring_pattern VARCHAR(50),
-                    is_completed BOOLEAN DEFAULT FALSE,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-                """,
-                """
-                CREATE TABLE IF NOT EXISTS user_settings (
-                    id SERIAL PRIMARY KEY,
-                    user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
-                    setting_key VARCHAR(255) NOT NULL,
-                    setting_value TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    UNIQUE(user_id, setting_key)
-                );
-                """
-            ]
-            
-            for i, table_sql in enumerate(tables_sql):
-                try:
-                    cursor.execute(table_sql)
-                    logger.info(f"Таблица {i+1}/6 создана успешно")
-                except Exception as e:
-                    logger.error(f"Ошибка создания таблицы {i+1}: {e}")
-            
-            conn.commit()
-            logger.info("✅ Все таблицы созданы успешно")
-        else:
-            logger.info("✅ Таблицы уже существуют")
-        
-        conn.close()
-        return True
-        
-    except Exception as e:
-        logger.error(f"❌ Ошибка создания таблиц: {e}")
-        return False
-
 def migrate_existing_data():
     """Автоматическая миграция существующих данных в новую схему БД"""
     try:
@@ -3900,25 +3659,51 @@ def reset_migration_flags():
     except Exception as e:
         logger.error(f"Ошибка сброса флагов: {e}")
 
+async def bind_request_context(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Создает контекст разрешения пользователя для текущего апдейта"""
+    user = update.effective_user if isinstance(update, Update) else None
+    begin_request(user.id if user else None, getattr(update, "update_id", None))
+
+async def start_background_workers(application: Application) -> None:
+    """Запускает фоновые задачи в event loop бота"""
+    if DATABASE_URL:
+        sync_spool.start(apply_sync_batch)
+
+async def shutdown_background_workers(application: Application) -> None:
+    """Останавливает фоновые пулы при завершении бота"""
+    await sync_spool.stop()
+    training_loader.flush()
+    model_trainer.shutdown()
+    report_renderer.shutdown()
+    db_pool.close_all()
+
 def main():
-    train_model(TRAINING_DATA)
-    init_db()  # Старая инициализация для совместимости
-    
-    # Принудительно создаем таблицы новой архитектуры
-    logger.info("Инициализация новой архитектуры БД...")
-    if ensure_tables_exist():
-        logger.info("✅ Таблицы новой архитектуры созданы")
-    else:
-        logger.error("❌ Ошибка создания таблиц новой архитектуры")
+    train_model(TRAINING_DATA)
     
-    init_new_database_schema()  # Новая схема БД
+    # Схема БД: недостающие миграции применяются один раз под advisory lock
+    run_schema_migrations()
     migrate_existing_data()  # Миграция данных
     
     # Синхронизируем группы из PostgreSQL в файловую систему
     logger.info("Синхронизация групп из PostgreSQL...")
     sync_groups_from_database()
     
-    application = Application.builder().token(BOT_TOKEN).build()
+    # Строим индекс участников групп после синхронизации файлов
+    group_index.build()
+    
+    # Пачки расходов синхронизируются в PostgreSQL одной транзакцией
+    write_coalescer.set_batch_sync(sync_expenses_batch)
+
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .post_init(start_background_workers)
+        .post_shutdown(shutdown_background_workers)
+        .build()
+    )
+
+    # Контекст апдейта создается до всех остальных обработчиков
+    application.add_handler(TypeHandler(Update, bind_request_context), group=-1)
 
     # Обработчик для отчетов
     report_conv_handler = ConversationHandler(
@@ -4151,38 +3936,36 @@ def upsert_budget_plan(plan_month: date, total_amount: float, user_id: int = Non
 		else:
 			# Работаем с файлами для новых пользователей
 			try:
-				plans = get_user_budget_plans(user_id)
-				
-				# Ищем существующий план на этот месяц
-				plan_id = None
-				for i, plan in enumerate(plans):
-					if plan.get('plan_month') == plan_month.isoformat():
-						# Обновляем существующий план
-						plans[i]['total_amount'] = total_amount
-						plan_id = plan.get('id', i + 1)
-						break
-				
-				if plan_id is None:
-					# Создаем новый план
-					plan_id = len(plans) + 1
-					new_plan = {
-						'id': plan_id,
-						'plan_month': plan_month.isoformat(),
-						'total_amount': total_amount,
-						'items': [],
-						'created_at': datetime.now().isoformat()
-					}
-					plans.append(new_plan)
-				
-				# Сохраняем планы обратно в файл
 				folder_path = get_user_folder_path(user_id)
 				budget_plans_file = f"{folder_path}/budget_plans.json"
 				
-				# Создаем папку, если её нет
-				os.makedirs(folder_path, exist_ok=True)
-				
-				with open(budget_plans_file, 'w', encoding='utf-8') as f:
-					json.dump(plans, f, ensure_ascii=False, indent=2)
+				# Чтение и запись планов — под блокировкой папки (общий файл группы)
+				with folder_locks.lock(folder_path):
+					plans = get_user_budget_plans(user_id)
+					
+					# Ищем существующий план на этот месяц
+					plan_id = None
+					for i, plan in enumerate(plans):
+						if plan.get('plan_month') == plan_month.isoformat():
+							# Обновляем существующий план
+							plans[i]['total_amount'] = total_amount
+							plan_id = plan.get('id', i + 1)
+							break
+					
+					if plan_id is None:
+						# Создаем новый план
+						plan_id = len(plans) + 1
+						new_plan = {
+							'id': plan_id,
+							'plan_month': plan_month.isoformat(),
+							'total_amount': total_amount,
+							'items': [],
+							'created_at': datetime.now().isoformat()
+						}
+						plans.append(new_plan)
+					
+					# Сохраняем планы обратно в файл
+					write_json_atomic(budget_plans_file, plans)
 				
 				return plan_id
 			except Exception as e:
@@ -4246,34 +4029,32 @@ def add_budget_item(plan_id: int, category: str, amount: float, comment: str | N
 		else:
 			# Работаем с файлами для новых пользователей
 			try:
-				plans = get_user_budget_plans(user_id)
-				
-				# Находим план с нужным ID
-				for plan in plans:
-					if plan.get('id') == plan_id:
-						# Добавляем статью в план
-						if 'items' not in plan:
-							plan['items'] = []
-						
-						new_item = {
-							'id': len(plan['items']) + 1,
-							'category': category,
-							'amount': amount,
-							'comment': comment,
-							'created_at': datetime.now().isoformat()
-						}
-						plan['items'].append(new_item)
-						break
-				
-				# Сохраняем планы обратно в файл
 				folder_path = get_user_folder_path(user_id)
 				budget_plans_file = f"{folder_path}/budget_plans.json"
 				
-				# Создаем папку, если её нет
-				os.makedirs(folder_path, exist_ok=True)
-				
-				with open(budget_plans_file, 'w', encoding='utf-8') as f:
-					json.dump(plans, f, ensure_ascii=False, indent=2)
+				# Чтение и запись планов — под блокировкой папки (общий файл группы)
+				with folder_locks.lock(folder_path):
+					plans = get_user_budget_plans(user_id)
+					
+					# Находим план с нужным ID
+					for plan in plans:
+						if plan.get('id') == plan_id:
+							# Добавляем статью в план
+							if 'items' not in plan:
+								plan['items'] = []
+							
+							new_item = {
+								'id': len(plan['items']) + 1,
+								'category': category,
+								'amount': amount,
+								'comment': comment,
+								'created_at': datetime.now().isoformat()
+							}
+							plan['items'].append(new_item)
+							break
+					
+					# Сохраняем планы обратно в файл
+					write_json_atomic(budget_plans_file, plans)
 				
 				# Синхронизируем в PostgreSQL
 				sync_to_database(user_id, "budget_item", "add", {
@@ -4531,10 +4312,17 @@ async def planning_summary(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 	
 	# Сохраняем в БД
 	user_id = update.effective_user.id
-	plan_id = upsert_budget_plan(plan_month, plan_total, user_id)
-	if plan_id:
-		for i in items:
-			add_budget_item(plan_id, i['category'], i['amount'], i['comment'], user_id)
+	folder_path = get_user_folder_path(user_id)
+	
+	def save_plan():
+		with folder_locks.lock(folder_path):
+			plan_id = upsert_budget_plan(plan_month, plan_total, user_id)
+			if plan_id:
+				for i in items:
+					add_budget_item(plan_id, i['category'], i['amount'], i['comment'], user_id)
+	
+	# План и его статьи записываются одной операцией под блокировкой папки
+	await folder_locks.run(folder_path, save_plan)
 	
 	summary_lines = [f"📅 Месяц: {plan_month.strftime('%m.%Y')}", f"💰 Общий бюджет: {plan_total:.2f}", "", "📦 Распределение:"]
 	for i in items:
@@ -4769,16 +4557,16 @@ def delete_budget_plan(plan_id, user_id=None):
             if not os.path.exists(budget_plans_file):
                 return False
             
-            # Читаем планы
-            with open(budget_plans_file, 'r', encoding='utf-8') as f:
-                plans = json.load(f)
-            
-            # Удаляем план с указанным ID
-            plans = [plan for plan in plans if plan.get('id') != plan_id]
-            
-            # Записываем обратно в файл
-            with open(budget_plans_file, 'w', encoding='utf-8') as f:
-                json.dump(plans, f, ensure_ascii=False, indent=2)
+            # Чтение и запись планов — под блокировкой папки (общий файл группы)
+            with folder_locks.lock(folder_path):
+                with open(budget_plans_file, 'r', encoding='utf-8') as f:
+                    plans = json.load(f)
+                
+                # Удаляем план с указанным ID
+                plans = [plan for plan in plans if plan.get('id') != plan_id]
+                
+                # Записываем обратно в файл
+                write_json_atomic(budget_plans_file, plans)
             
             return True
         except Exception as e:
@@ -4850,7 +4638,7 @@ async def custom_category_input(update: Update, context: ContextTypes.DEFAULT_TY
         user_id = update.effective_user.id
         
         # Обновляем категорию в базе данных
-        if update_expense_category(exp_id, new_category, user_id):
+        if await folder_locks.run(get_user_folder_path(user_id), update_expense_category, exp_id, new_category, user_id):
             context.user_data['selected_expense'] = (exp_id, amount, desc, new_category, date)
             await update.message.reply_text(
                 f"✅ Создана новая категория '{new_category}' и применена к расходу!\n\n"
@@ -5007,44 +4795,42 @@ def add_payment_reminder(title, description, amount, start_date, end_date, user_
             folder_path = get_user_folder_path(user_id)
             reminders_file = f"{folder_path}/reminders.json"
             
-            # Создаем папку, если её нет
-            os.makedirs(folder_path, exist_ok=True)
-            
-            # Читаем существующие напоминания
-            reminders = []
-            if os.path.exists(reminders_file):
-                with open(reminders_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    # Проверяем формат данных
-                    if isinstance(data, list):
-                        reminders = data
-                    elif isinstance(data, dict) and 'reminders' in data:
-                        reminders = data['reminders']
-                    else:
-                        logger.warning(f"Неожиданный формат данных в {reminders_file}: {type(data)}")
-                        reminders = []
+            # Чтение и запись напоминаний — под блокировкой папки (общий файл группы)
+            with folder_locks.lock(folder_path):
+                # Читаем существующие напоминания
+                reminders = []
+                if os.path.exists(reminders_file):
+                    with open(reminders_file, 'r', encoding='utf-8') as f:
+                        data = json.load(f)
+                        # Проверяем формат данных
+                        if isinstance(data, list):
+                            reminders = data
+                        elif isinstance(data, dict) and 'reminders' in data:
+                            reminders = data['reminders']
+                        else:
+                            logger.warning(f"Неожиданный формат данных в {reminders_file}: {type(data)}")
+                            reminders = []
             
-            # Генерируем новый ID
-            new_id = max([rem.get('id', 0) for rem in reminders], default=0) + 1
+                # Генерируем новый ID
+                new_id = max([rem.get('id', 0) for rem in reminders], default=0) + 1
             
-            # Добавляем новое напоминание
-            new_reminder = {
-                'id': new_id,
-                'title': title,
-                'description': description,
-                'amount': amount,
-                'start_date': start_date.isoformat(),
-                'end_date': end_date.isoformat(),
-                'reminder_10_days': False,
-                'reminder_3_days': False,
-                'is_active': True,
-                'created_at': datetime.now().isoformat()
-            }
-            reminders.append(new_reminder)
+                # Добавляем новое напоминание
+                new_reminder = {
+                    'id': new_id,
+                    'title': title,
+                    'description': description,
+                    'amount': amount,
+                    'start_date': start_date.isoformat(),
+                    'end_date': end_date.isoformat(),
+                    'reminder_10_days': False,
+                    'reminder_3_days': False,
+                    'is_active': True,
+                    'created_at': datetime.now().isoformat()
+                }
+                reminders.append(new_reminder)
             
-            # Записываем обратно в файл
-            with open(reminders_file, 'w', encoding='utf-8') as f:
-                json.dump(reminders, f, ensure_ascii=False, indent=2)
+                # Записываем обратно в файл
+                write_json_atomic(reminders_file, reminders)
             
             # Синхронизируем в PostgreSQL
             sync_to_database(user_id, "reminder", "add", {
@@ -5172,25 +4958,25 @@ def delete_reminder(reminder_id, user_id=None):
             if not os.path.exists(reminders_file):
                 return False
             
-            # Читаем существующие напоминания
-            with open(reminders_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
-            # Проверяем формат данных
-            if isinstance(data, list):
-                reminders = data
-            elif isinstance(data, dict) and 'reminders' in data:
-                reminders = data['reminders']
-            else:
-                logger.warning(f"Неожиданный формат данных в {reminders_file}: {type(data)}")
-                return False
-            
-            # Удаляем напоминание с указанным ID
-            reminders = [rem for rem in reminders if rem['id'] != reminder_id]
-            
-            # Записываем обратно в файл
-            with open(reminders_file, 'w', encoding='utf-8') as f:
-                json.dump(reminders, f, ensure_ascii=False, indent=2)
+            # Чтение и запись напоминаний — под блокировкой папки (общий файл группы)
+            with folder_locks.lock(folder_path):
+                with open(reminders_file, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                
+                # Проверяем формат данных
+                if isinstance(data, list):
+                    reminders = data
+                elif isinstance(data, dict) and 'reminders' in data:
+                    reminders = data['reminders']
+                else:
+                    logger.warning(f"Неожиданный формат данных в {reminders_file}: {type(data)}")
+                    return False
+                
+                # Удаляем напоминание с указанным ID
+                reminders = [rem for rem in reminders if rem['id'] != reminder_id]
+                
+                # Записываем обратно в файл
+                write_json_atomic(reminders_file, reminders)
             
             # Синхронизируем в PostgreSQL
             sync_to_database(user_id, "reminder", "delete", {'reminder_id': reminder_id})
@@ -5469,7 +5255,10 @@ async def reminder_end_date_input(update: Update, context: ContextTypes.DEFAULT_
     start_date = context.user_data['reminder_start_date']
     user_id = update.effective_user.id
     
-    if add_payment_reminder(title, desc, amount, start_date, end_date, user_id):
+    added = await folder_locks.run(
+        get_user_folder_path(user_id), add_payment_reminder, title, desc, amount, start_date, end_date, user_id
+    )
+    if added:
         # Правильный расчет: общее количество дней в периоде
         total_days = (end_date - start_date).days + 1  # +1 чтобы включить оба дня
         
@@ -5652,25 +5441,30 @@ async def budget_item_delete_confirm(update: Update, context: ContextTypes.DEFAU
                     folder_path = get_user_folder_path(user_id)
                     budget_plans_file = f"{folder_path}/budget_plans.json"
                     
-                    if os.path.exists(budget_plans_file):
-                        # Читаем планы
-                        with open(budget_plans_file, 'r', encoding='utf-8') as f:
-                            plans = json.load(f)
-                        
-                        # Находим план и удаляем статью
-                        for plan in plans:
-                            if plan.get('id') == context.user_data['current_plan_id']:
-                                items_list = plan.get('items', [])
-                                # Удаляем статью по категории и сумме
-                                plan['items'] = [item for item in items_list 
-                                                if not (item.get('category') == cat and item.get('amount') == amt)]
-                                break
-                        
-                        # Записываем обратно
-                        with open(budget_plans_file, 'w', encoding='utf-8') as f:
-                            json.dump(plans, f, ensure_ascii=False, indent=2)
-                        
-                        success = True
+                    plan_id = context.user_data['current_plan_id']
+                    
+                    def remove_item() -> bool:
+                        # Чтение и запись планов — под блокировкой папки (общий файл группы)
+                        with folder_locks.lock(folder_path):
+                            if not os.path.exists(budget_plans_file):
+                                return False
+                            with open(budget_plans_file, 'r', encoding='utf-8') as f:
+                                plans = json.load(f)
+                            
+                            # Находим план и удаляем статью
+                            for plan in plans:
+                                if plan.get('id') == plan_id:
+                                    items_list = plan.get('items', [])
+                                    # Удаляем статью по категории и сумме
+                                    plan['items'] = [item for item in items_list 
+                                                    if not (item.get('category') == cat and item.get('amount') == amt)]
+                                    break
+                            
+                            # Записываем обратно
+                            write_json_atomic(budget_plans_file, plans)
+                            return True
+                    
+                    success = await folder_locks.run(folder_path, remove_item)
                     
                     if success:
                         await update.message.reply_text(
@@ -5858,8 +5652,14 @@ async def expense_delete_choice(update: Update, context: ContextTypes.DEFAULT_TY
             )
             return ConversationHandler.END
         
-        # Сохраняем выбранный расход для удаления
-        selected_expense = expenses[choice - 1]
+        # Сохраняем выбранный расход для удаления в актуальном виде
+        selected_expense = get_expense_by_id(expenses[choice - 1][0], update.effective_user.id)
+        if not selected_expense:
+            await update.message.reply_text(
+                "Ошибка: расход не найден. Попробуйте снова.",
+                reply_markup=get_main_menu_keyboard()
+            )
+            return ConversationHandler.END
         context.user_data['expense_to_delete'] = selected_expense
         
         exp_id, amount, desc, cat, date = selected_expense
@@ -5907,7 +5707,7 @@ async def expense_delete_confirm(update: Update, context: ContextTypes.DEFAULT_T
         user_id = update.effective_user.id
         
         # Удаляем расход из базы данных
-        if delete_expense(exp_id, user_id):
+        if await folder_locks.run(get_user_folder_path(user_id), delete_expense, exp_id, user_id):
             await update.message.reply_text(
                 f"✅ Расход успешно удален!\n\n"
                 f"📝 {desc}\n"
@@ -5942,10 +5742,6 @@ def get_monthly_expenses(month: int, year: int, user_id: int = None):
     if user_id:
         # Работаем с файлами пользователя/группы
         try:
-            import csv
-            import os
-            from datetime import datetime
-            
             folder_path = get_user_folder_path(user_id)
             expenses_file = f"{folder_path}/expenses.csv"
             
@@ -5955,23 +5751,11 @@ def get_monthly_expenses(month: int, year: int, user_id: int = None):
             if not os.path.exists(expenses_file):
                 return []
             
-            expenses_by_category = {}
-            
-            with open(expenses_file, 'r', encoding='utf-8') as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    try:
-                        transaction_date = datetime.strptime(row['transaction_date'], '%Y-%m-%d').date()
-                        if transaction_date.month == month and transaction_date.year == year:
-                            category = row['category']
-                            amount = float(row['amount'])
-                            expenses_by_category[category] = expenses_by_category.get(category, 0) + amount
-                    except (ValueError, KeyError) as e:
-                        logger.warning(f"Ошибка при обработке строки расходов: {e}")
-                        continue
-            
-            # Сортируем по сумме (убывание)
-            return sorted(expenses_by_category.items(), key=lambda x: x[1], reverse=True)
+            # Итоги месяца из агрегатов (уже отсортированы по сумме, по убыванию)
+            first_day = date(year, month, 1)
+            last_day = date(year + month // 12, month % 12 + 1, 1) - timedelta(days=1)
+            totals = expense_rollups.category_totals(expenses_file, first_day, last_day)
+            return [(category, amount) for category, amount, _ in totals]
         except Exception as e:
             logger.error(f"Ошибка при получении расходов за месяц из файла: {e}")
             return []
@@ -6066,6 +5850,9 @@ def get_budget_plan_items(plan_id: int, user_id: int = None):
 ADMIN_USER_ID = 498410375  # Замените на ваш Telegram ID
 USERS_FILE = "authorized_users.json"
 
+# Реестр авторизованных пользователей с индексами по telegram_id и username
+auth_registry = AuthRegistry(USERS_FILE, ADMIN_USER_ID)
+
 # Роли пользователей
 USER_ROLES = {
     "admin": "Администратор",
@@ -6073,15 +5860,11 @@ USER_ROLES = {
     "user": "Пользователь"
 }
 
-@cached(ttl=60, key_prefix="users")
 @monitor_performance
 def load_authorized_users():
-    """Загружает список авторизованных пользователей из файла"""
+    """Загружает список авторизованных пользователей (копия данных реестра)"""
     try:
-        if os.path.exists(USERS_FILE):
-            with open(USERS_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        return {"users": [], "admin": ADMIN_USER_ID}
+        return auth_registry.load()
     except Exception as e:
         logger.error(f"Ошибка при загрузке пользователей: {e}")
         return {"users": [], "admin": ADMIN_USER_ID}
@@ -6089,8 +5872,8 @@ def load_authorized_users():
 def save_authorized_users(users_data):
     """Сохраняет список авторизованных пользователей в файл"""
     try:
-        with open(USERS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(users_data, f, ensure_ascii=False, indent=2)
+        auth_registry.save(users_data)
+        invalidate_request_context()
         logger.info(f"Пользователи успешно сохранены в файл {USERS_FILE}")
         return True
     except Exception as e:
@@ -6165,26 +5948,15 @@ def update_user_telegram_id(username: str, user_id: int) -> bool:
         logger.error(f"Ошибка при обновлении telegram_id для {username}: {e}")
         return False
 
+@request_scoped
 def is_user_authorized(user_id: int) -> bool:
     """Проверяет, авторизован ли пользователь"""
-    users_data = load_authorized_users()
-    
-    logger.info(f"Проверка авторизации для user_id: {user_id}")
-    
-    # Проверяем, является ли пользователь админом
-    if user_id == users_data.get("admin"):
-        logger.info(f"Пользователь {user_id} является админом")
+    # Админ и список авторизованных проверяются по индексу реестра
+    if auth_registry.is_listed(user_id):
         return True
     
-    # Проверяем, есть ли пользователь в списке авторизованных
-    for user in users_data.get("users", []):
-        if user.get("telegram_id") == user_id:
-            logger.info(f"Пользователь {user_id} найден в списке авторизованных")
-            return True
-    
     # Проверяем, состоит ли пользователь в какой-либо группе
     if is_user_in_group(user_id):
-        logger.info(f"Пользователь {user_id} состоит в группе - авторизован")
         return True
     
     logger.info(f"Пользователь {user_id} не авторизован")
@@ -6192,19 +5964,9 @@ def is_user_authorized(user_id: int) -> bool:
 
 def is_username_authorized(username: str) -> bool:
     """Проверяет, авторизован ли пользователь по имени"""
-    users_data = load_authorized_users()
-    
-    logger.info(f"Проверка username '{username}' в списке авторизованных")
-    logger.info(f"Данные пользователей: {users_data}")
-    
-    # Проверяем, есть ли пользователь с таким именем в списке авторизованных
-    for user in users_data.get("users", []):
-        if user.get("username") == username:
-            logger.info(f"Username '{username}' найден в списке авторизованных")
-            return True
-    
-    logger.info(f"Username '{username}' не найден в списке авторизованных")
-    return False
+    found = auth_registry.get_by_username(username) is not None
+    logger.info(f"Username '{username}' {'найден' if found else 'не найден'} в списке авторизованных")
+    return found
 
 def add_authorized_user(username: str, user_id: int = None, folder_name: str = None, role: str = "user") -> tuple[bool, str]:
     """Добавляет нового авторизованного пользователя в базу данных"""
@@ -6247,12 +6009,11 @@ def add_authorized_user(username: str, user_id: int = None, folder_name: str = N
 def add_user_to_authorized_list(username: str, folder_name: str, role: str) -> tuple[bool, str]:
     """Добавляет нового пользователя в authorized_users.json"""
     try:
-        users_data = load_authorized_users()
-        
         # Проверяем, не существует ли уже пользователь с таким именем
-        for user in users_data.get("users", []):
-            if user.get("username") == username:
-                return False, f"Пользователь с именем '{username}' уже существует"
+        if auth_registry.get_by_username(username) is not None:
+            return False, f"Пользователь с именем '{username}' уже существует"
+        
+        users_data = load_authorized_users()
         
         # Создаем нового пользователя
         new_user = {
@@ -6469,6 +6230,7 @@ def create_user_folder(username: str, folder_name: str, user_id: int) -> tuple[b
 
 # Функция create_user_config_files удалена - теперь используется база данных
 
+@request_scoped
 def get_user_folder_path(user_id: int) -> str:
     """Получает путь к папке пользователя или группы"""
     try:
@@ -6480,15 +6242,8 @@ def get_user_folder_path(user_id: int) -> str:
             logger.info(f"Пользователь {user_id} использует папку группы: {group_folder}")
             return group_folder
         
-        # Если не в группе, проверяем авторизованных пользователей
-        users_data = load_authorized_users()
-        for user in users_data.get("users", []):
-            if user.get("telegram_id") == user_id:
-                folder_name = user.get("folder_name", f"user_{user_id}")
-                # Используем user_id для избежания проблем с кодировкой
-                return f"user_data/user_{user_id}"
-        
-        # Если пользователь не найден, создаем папку по умолчанию
+        # Если не в группе, используем личную папку (по user_id, чтобы избежать
+        # проблем с кодировкой имени папки)
         return f"user_data/user_{user_id}"
     except Exception as e:
         logger.error(f"Ошибка получения пути к папке пользователя: {e}")
@@ -6547,24 +6302,20 @@ def get_user_config(username: str, user_id: int) -> dict:
 def save_user_data(username: str, user_id: int, data_type: str, data: dict) -> bool:
     """Сохраняет данные пользователя в базе данных"""
     try:
-        conn = get_db_connection()
-        if not conn:
+        if not DATABASE_URL:
             return False
         
-        cursor = conn.cursor()
-        
-        # Таблица user_data уже создана в init_db()
-        
-        # Сохраняем данные
-        cursor.execute('''
-            INSERT INTO user_data (user_id, data_type, data_content)
-            VALUES (%s, %s, %s)
-            ON CONFLICT (user_id, data_type) 
-            DO UPDATE SET data_content = EXCLUDED.data_content, updated_at = CURRENT_TIMESTAMP
-        ''', (user_id, data_type, json.dumps(data)))
-        
-        conn.commit()
-        conn.close()
+        # Таблица user_data создается миграцией схемы
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            # Сохраняем данные
+            cursor.execute('''
+                INSERT INTO user_data (user_id, data_type, data_content)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (user_id, data_type) 
+                DO UPDATE SET data_content = EXCLUDED.data_content, updated_at = CURRENT_TIMESTAMP
+            ''', (user_id, data_type, json.dumps(data)))
+            conn.commit()
         
         logger.info(f"Данные {data_type} сохранены для пользователя {username} в БД")
         return True
@@ -6576,18 +6327,16 @@ def save_user_data(username: str, user_id: int, data_type: str, data: dict) -> b
 def load_user_data(username: str, user_id: int, data_type: str) -> dict:
     """Загружает данные пользователя из базы данных"""
     try:
-        conn = get_db_connection()
-        if not conn:
+        if not DATABASE_URL:
             return {}
         
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT data_content FROM user_data 
-            WHERE user_id = %s AND data_type = %s
-        ''', (user_id, data_type))
-        
-        result = cursor.fetchone()
-        conn.close()
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT data_content FROM user_data 
+                WHERE user_id = %s AND data_type = %s
+            ''', (user_id, data_type))
+            result = cursor.fetchone()
         
         if result and result[0]:
             return result[0]
@@ -6606,7 +6355,7 @@ def create_user_backup(username: str, user_id: int) -> bool:
         
         cursor = conn.cursor()
         
-        # Таблица user_backups уже создана в init_db()
+        # Таблица user_backups создается миграцией схемы
         
         # Собираем все данные пользователя
         backup_data = {
@@ -6678,18 +6427,16 @@ def restore_user_backup(username: str, user_id: int, backup_id: int) -> bool:
 def log_user_action(user_id: int, action: str, details: str = "") -> None:
     """Логирует действие пользователя в базу данных"""
     try:
-        conn = get_db_connection()
-        if not conn:
+        if not DATABASE_URL:
             return
         
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO user_logs (user_id, log_level, message)
-            VALUES (%s, %s, %s)
-        ''', (user_id, "INFO", f"{action}: {details}"))
-        
-        conn.commit()
-        conn.close()
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO user_logs (user_id, log_level, message)
+                VALUES (%s, %s, %s)
+            ''', (user_id, "INFO", f"{action}: {details}"))
+            conn.commit()
         
     except Exception as e:
         logger.error(f"Ошибка при логировании действия пользователя {user_id}: {e}")
@@ -6836,6 +6583,7 @@ def create_group_file_fallback(name: str, admin_user_id: int) -> tuple[bool, str
         
         with open(groups_registry_file, 'w', encoding='utf-8') as f:
             json.dump(groups_registry, f, ensure_ascii=False, indent=2)
+        group_index.add_group(new_group)
         logger.info(f"Fallback: реестр групп сохранен")
         
         # Создаем файл участников группы
@@ -6851,6 +6599,8 @@ def create_group_file_fallback(name: str, admin_user_id: int) -> tuple[bool, str
         }
         with open(members_file, 'w', encoding='utf-8') as f:
             json.dump(members_data, f, ensure_ascii=False, indent=2)
+        group_index.add_member(group_id, members_data["members"][0])
+        invalidate_request_context()
         
         # Убеждаемся, что админ добавлен в authorized_users.json
         if not is_user_authorized(admin_user_id):
@@ -6880,11 +6630,11 @@ def create_group_file_fallback(name: str, admin_user_id: int) -> tuple[bool, str
         return False, f"Ошибка при создании группы: {str(e)}", ""
 
 
+@request_scoped
 def get_user_group(user_id: int) -> dict:
     """Получает информацию о группе пользователя"""
     try:
         # Всегда используем файловую систему как основное хранилище
-        logger.info(f"Поиск группы для пользователя {user_id} в файловой системе")
         return get_user_group_file_fallback(user_id)
         
     except Exception as e:
@@ -6894,75 +6644,11 @@ def get_user_group(user_id: int) -> dict:
 def get_user_group_file_fallback(user_id: int) -> dict:
     """Fallback функция для поиска группы пользователя в файловой системе"""
     try:
-        import os
-        import json
-        
-        logger.info(f"Fallback: поиск группы для пользователя {user_id}")
-        
-        # Ищем в папках групп
-        group_data_dir = "group_data"
-        if not os.path.exists(group_data_dir):
-            logger.warning(f"Fallback: папка групп не найдена: {group_data_dir}")
-            return None
-        
-        logger.info(f"Fallback: ищем в папке: {group_data_dir}")
-        
-        for item in os.listdir(group_data_dir):
-            if item.startswith("group_"):
-                group_folder = os.path.join(group_data_dir, item)
-                logger.info(f"Fallback: проверяем папку группы: {group_folder}")
-                
-                if os.path.isdir(group_folder):
-                    members_file = os.path.join(group_folder, "members.json")
-                    logger.info(f"Fallback: проверяем файл участников: {members_file}")
-                    
-                    if os.path.exists(members_file):
-                        with open(members_file, 'r', encoding='utf-8') as f:
-                            members_data = json.load(f)
-                        
-                        logger.info(f"Fallback: данные участников группы {item}: {members_data}")
-                        
-                        # Проверяем, есть ли пользователь в этой группе
-                        members_list = members_data.get("members", [])
-                        logger.info(f"Fallback: список участников группы {item}: {members_list}")
-                        
-                        for member in members_list:
-                            logger.info(f"Fallback: проверяем участника {member} (ищем user_id: {user_id})")
-                            if member.get("user_id") == user_id:
-                                logger.info(f"Fallback: найден участник в группе {item}")
-                                group_id = int(item.replace("group_", ""))
-                                
-                                # Получаем информацию о группе из реестра
-                                groups_registry_file = "group_data/groups_registry.json"
-                                group_name = f"Group {group_id}"  # По умолчанию
-                                admin_user_id = user_id
-                                invitation_code = member.get("invitation_code", "")
-                                
-                                if os.path.exists(groups_registry_file):
-                                    with open(groups_registry_file, 'r', encoding='utf-8') as f:
-                                        groups_registry = json.load(f)
-                                    
-                                    for group in groups_registry.get("groups", []):
-                                        if group.get("id") == group_id:
-                                            group_name = group.get("name", group_name)
-                                            admin_user_id = group.get("admin_user_id", admin_user_id)
-                                            invitation_code = group.get("invitation_code", invitation_code)
-                                            break
-                                
-                                group_info = {
-                                    "id": group_id,
-                                    "name": group_name,
-                                    "admin_user_id": admin_user_id,
-                                    "invitation_code": invitation_code,
-                                    "role": member.get("role", "member")
-                                }
-                                logger.info(f"Fallback: найдена группа для пользователя {user_id}: {group_info}")
-                                return group_info
-                    else:
-                        logger.warning(f"Fallback: файл участников не найден: {members_file}")
-        
-        logger.info(f"Fallback: группа для пользователя {user_id} не найдена")
-        return None
+        # Индекс строится из members.json и groups_registry.json один раз
+        # и обновляется при создании группы, вступлении и удалении участников
+        group_info = group_index.get(user_id)
+        logger.debug(f"Fallback: группа пользователя {user_id}: {group_info}")
+        return group_info
         
     except Exception as e:
         logger.error(f"Ошибка в fallback функции поиска группы: {e}")
@@ -6983,7 +6669,9 @@ def join_group_by_invitation(invitation_code: str, user_id: int, phone: str) ->
         
         # Всегда используем файловую систему как основное хранилище
         logger.info("Используем файловую систему для присоединения к группе (основное хранилище)")
-        return join_group_by_invitation_file_fallback(invitation_code, user_id, phone)
+        result = join_group_by_invitation_file_fallback(invitation_code, user_id, phone)
+        invalidate_request_context()
+        return result
         
     except Exception as e:
         logger.error(f"Ошибка при присоединении к группе: {e}")
@@ -7058,6 +6746,7 @@ def join_group_by_invitation_file_fallback(invitation_code: str, user_id: int, p
                 members_data = {"members": existing_members}
                 with open(members_file, 'w', encoding='utf-8') as f:
                     json.dump(members_data, f, ensure_ascii=False, indent=2)
+                group_index.add_member(group_id, new_member)
                 
                 # Убеждаемся, что пользователь добавлен в authorized_users.json
                 if not is_user_authorized(user_id):
@@ -7147,7 +6836,9 @@ def remove_group_member(user_id: int) -> tuple[bool, str]:
     try:
         # Всегда используем файловую систему как основное хранилище
         logger.info(f"Удаление участника {user_id} из группы через файловую систему")
-        return remove_group_member_file_fallback(user_id)
+        result = remove_group_member_file_fallback(user_id)
+        invalidate_request_context()
+        return result
         
     except Exception as e:
         logger.error(f"Ошибка при удалении участника группы: {e}")
@@ -7162,76 +6853,54 @@ def remove_group_member_file_fallback(user_id: int) -> tuple[bool, str]:
         
         logger.info(f"Поиск пользователя {user_id} для удаления из группы")
         
-        # Ищем пользователя в папках групп
-        group_data_dir = "group_data"
-        if not os.path.exists(group_data_dir):
-            logger.warning(f"Папка групп не найдена: {group_data_dir}")
-            return False, "Группы не найдены"
+        group_id = group_index.get_group_id(user_id)
+        if group_id is None:
+            logger.warning(f"Пользователь {user_id} не найден ни в одной группе")
+            return False, "Пользователь не найден ни в одной группе"
         
-        logger.info(f"Поиск в папке: {group_data_dir}")
+        members_file = os.path.join("group_data", f"group_{group_id}", "members.json")
+        if not os.path.exists(members_file):
+            logger.warning(f"Файл участников не найден: {members_file}")
+            group_index.remove_member(user_id)
+            return False, "Пользователь не найден ни в одной группе"
         
-        for item in os.listdir(group_data_dir):
-            if item.startswith("group_"):
-                group_folder = os.path.join(group_data_dir, item)
-                if os.path.isdir(group_folder):
-                    members_file = os.path.join(group_folder, "members.json")
-                    logger.info(f"Проверяем файл участников: {members_file}")
-                    
-                    if os.path.exists(members_file):
-                        with open(members_file, 'r', encoding='utf-8') as f:
-                            members_data = json.load(f)
-                        
-                        logger.info(f"Данные участников группы {item}: {members_data}")
-                        
-                        # Ищем пользователя в этой группе
-                        members = members_data.get("members", [])
-                        logger.info(f"Список участников группы {item}: {members}")
-                        
-                        for i, member in enumerate(members):
-                            logger.info(f"Проверяем участника {i}: {member} (ищем user_id: {user_id})")
-                            if member.get("user_id") == user_id:
-                                logger.info(f"Найден участник для удаления: {member}")
-                                
-                                group_id = int(item.replace("group_", ""))
-                                
-                                # Удаляем пользователя из файловой системы
-                                members.pop(i)
-                                members_data["members"] = members
-                                
-                                # Сохраняем обновленный файл
-                                with open(members_file, 'w', encoding='utf-8') as f:
-                                    json.dump(members_data, f, ensure_ascii=False, indent=2)
-                                
-                                logger.info(f"Файл участников обновлен: {members_data}")
-                                
-                                # Также удаляем из PostgreSQL, если подключение доступно
-                                try:
-                                    conn = get_db_connection()
-                                    if conn:
-                                        cursor = conn.cursor()
-                                        cursor.execute('DELETE FROM group_members WHERE user_id = %s AND group_id = %s', (user_id, group_id))
-                                        conn.commit()
-                                        conn.close()
-                                        logger.info(f"Пользователь {user_id} также удален из PostgreSQL группы {group_id}")
-                                    else:
-                                        logger.info("PostgreSQL недоступен, удаление только из файловой системы")
-                                except Exception as e:
-                                    logger.warning(f"Не удалось удалить пользователя {user_id} из PostgreSQL: {e}")
-                                
-                                # Удаляем пользователя из authorized_users.json
-                                try:
-                                    delete_user_from_authorized_list(f"User_{user_id}")
-                                    logger.info(f"Fallback: пользователь {user_id} удален из authorized_users.json")
-                                except Exception as e:
-                                    logger.warning(f"Не удалось удалить пользователя {user_id} из authorized_users.json: {e}")
-                                
-                                logger.info(f"Fallback: пользователь {user_id} удален из группы {group_id}")
-                                return True, f"Пользователь удален из группы"
-                    else:
-                        logger.warning(f"Файл участников не найден: {members_file}")
+        with open(members_file, 'r', encoding='utf-8') as f:
+            members_data = json.load(f)
+        
+        # Удаляем пользователя из файловой системы
+        members = [member for member in members_data.get("members", []) if member.get("user_id") != user_id]
+        members_data["members"] = members
+        
+        # Сохраняем обновленный файл
+        with open(members_file, 'w', encoding='utf-8') as f:
+            json.dump(members_data, f, ensure_ascii=False, indent=2)
+        group_index.remove_member(user_id)
+        
+        logger.info(f"Файл участников группы {group_id} обновлен, осталось участников: {len(members)}")
+        
+        # Также удаляем из PostgreSQL, если подключение доступно
+        try:
+            conn = get_db_connection()
+            if conn:
+                cursor = conn.cursor()
+                cursor.execute('DELETE FROM group_members WHERE user_id = %s AND group_id = %s', (user_id, group_id))
+                conn.commit()
+                conn.close()
+                logger.info(f"Пользователь {user_id} также удален из PostgreSQL группы {group_id}")
+            else:
+                logger.info("PostgreSQL недоступен, удаление только из файловой системы")
+        except Exception as e:
+            logger.warning(f"Не удалось удалить пользователя {user_id} из PostgreSQL: {e}")
+        
+        # Удаляем пользователя из authorized_users.json
+        try:
+            delete_user_from_authorized_list(f"User_{user_id}")
+            logger.info(f"Fallback: пользователь {user_id} удален из authorized_users.json")
+        except Exception as e:
+            logger.warning(f"Не удалось удалить пользователя {user_id} из authorized_users.json: {e}")
         
-        logger.warning(f"Пользователь {user_id} не найден ни в одной группе")
-        return False, "Пользователь не найден ни в одной группе"
+        logger.info(f"Fallback: пользователь {user_id} удален из группы {group_id}")
+        return True, f"Пользователь удален из группы"
         
     except Exception as e:
         logger.error(f"Ошибка в fallback функции удаления участника группы: {e}")
@@ -7352,71 +7021,117 @@ def sync_groups_from_database():
         logger.error(f"Ошибка при синхронизации групп: {e}")
 
 
-def sync_to_database(user_id: int, data_type: str, action: str, data: dict = None):
-    """Синхронизирует изменения данных в PostgreSQL"""
-    try:
-        conn = get_db_connection()
-        if not conn:
-            logger.info(f"PostgreSQL недоступен, синхронизация {data_type} пропущена")
-            return False
-        
+def _apply_sync_change(cursor, user_id, data_type: str, action: str, data: dict):
+    """Выполняет SQL одного изменения из журнала синхронизации"""
+    if data_type == "expense" and action == "add":
+        # Синхронизируем добавление расхода
+        cursor.execute('''
+            INSERT INTO expenses (user_id, amount, category, description, transaction_date)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT DO NOTHING
+        ''', (user_id, data['amount'], data['category'], data['description'], data['transaction_date']))
+
+    elif data_type == "expense" and action == "delete":
+        # Синхронизируем удаление расхода
+        cursor.execute('DELETE FROM expenses WHERE id = %s AND user_id = %s', (data['expense_id'], user_id))
+
+    elif data_type == "reminder" and action == "add":
+        # Синхронизируем добавление напоминания
+        cursor.execute('''
+            INSERT INTO payment_reminders (user_id, title, description, amount, start_date, end_date)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            ON CONFLICT DO NOTHING
+        ''', (user_id, data['title'], data['description'], data['amount'], data['start_date'], data['end_date']))
+
+    elif data_type == "reminder" and action == "delete":
+        # Синхронизируем удаление напоминания
+        cursor.execute('DELETE FROM payment_reminders WHERE id = %s AND user_id = %s', (data['reminder_id'], user_id))
+
+    elif data_type == "budget_plan" and action == "add":
+        # Синхронизируем план бюджета: план месяца один, повторное сохранение
+        # обновляет сумму (на этом держится схлопывание в sync_spool.entity_key)
+        cursor.execute('''
+            INSERT INTO budget_plans (user_id, plan_month, total_amount)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (plan_month)
+            DO UPDATE SET total_amount = EXCLUDED.total_amount
+        ''', (user_id, data['plan_month'], data['total_amount']))
+
+    elif data_type == "budget_item" and action == "add":
+        # Синхронизируем добавление статьи бюджета
+        cursor.execute('''
+            INSERT INTO budget_plan_items (plan_id, category, amount, comment)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT DO NOTHING
+        ''', (data['plan_id'], data['category'], data['amount'], data['comment']))
+
+    elif data_type == "budget_plan" and action == "delete":
+        # Синхронизируем удаление плана бюджета
+        cursor.execute('DELETE FROM budget_plans WHERE id = %s AND user_id = %s', (data['plan_id'], user_id))
+
+
+def apply_sync_batch(records: list):
+    """
+    Применяет пачку изменений из журнала синхронизации одной транзакцией
+
+    Ошибка соединения пробрасывается — пачка остается в журнале и будет
+    повторена. Запись, которую БД отвергла (например, нарушение ограничения),
+    откатывается до точки сохранения и пропускается, чтобы не блокировать
+    остальные.
+    """
+    with db_pool.connection() as conn:
         cursor = conn.cursor()
-        
-        if data_type == "expense" and action == "add":
-            # Синхронизируем добавление расхода
-            cursor.execute('''
-                INSERT INTO expenses (user_id, amount, category, description, transaction_date)
-                VALUES (%s, %s, %s, %s, %s)
-                ON CONFLICT DO NOTHING
-            ''', (user_id, data['amount'], data['category'], data['description'], data['transaction_date']))
-            
-        elif data_type == "expense" and action == "delete":
-            # Синхронизируем удаление расхода
-            cursor.execute('DELETE FROM expenses WHERE id = %s AND user_id = %s', (data['expense_id'], user_id))
-            
-        elif data_type == "reminder" and action == "add":
-            # Синхронизируем добавление напоминания
-            cursor.execute('''
-                INSERT INTO payment_reminders (user_id, title, description, amount, start_date, end_date)
-                VALUES (%s, %s, %s, %s, %s, %s)
-                ON CONFLICT DO NOTHING
-            ''', (user_id, data['title'], data['description'], data['amount'], data['start_date'], data['end_date']))
-            
-        elif data_type == "reminder" and action == "delete":
-            # Синхронизируем удаление напоминания
-            cursor.execute('DELETE FROM payment_reminders WHERE id = %s AND user_id = %s', (data['reminder_id'], user_id))
-            
-        elif data_type == "budget_plan" and action == "add":
-            # Синхронизируем добавление плана бюджета
-            cursor.execute('''
-                INSERT INTO budget_plans (user_id, plan_month, total_amount)
-                VALUES (%s, %s, %s)
-                ON CONFLICT DO NOTHING
-            ''', (user_id, data['plan_month'], data['total_amount']))
-            
-        elif data_type == "budget_item" and action == "add":
-            # Синхронизируем добавление статьи бюджета
-            cursor.execute('''
-                INSERT INTO budget_plan_items (plan_id, category, amount, comment)
-                VALUES (%s, %s, %s, %s)
-                ON CONFLICT DO NOTHING
-            ''', (data['plan_id'], data['category'], data['amount'], data['comment']))
-            
-        elif data_type == "budget_plan" and action == "delete":
-            # Синхронизируем удаление плана бюджета
-            cursor.execute('DELETE FROM budget_plans WHERE id = %s AND user_id = %s', (data['plan_id'], user_id))
-        
+        for record in records:
+            cursor.execute('SAVEPOINT sync_change')
+            try:
+                _apply_sync_change(cursor, record['user_id'], record['data_type'], record['action'], record['data'])
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                raise
+            except psycopg2.Error as e:
+                cursor.execute('ROLLBACK TO SAVEPOINT sync_change')
+                logger.error(f"PostgreSQL отверг изменение {record['data_type']} {record['action']} "
+                             f"(#{record['seq']}), пропускаем: {e}")
+            cursor.execute('RELEASE SAVEPOINT sync_change')
         conn.commit()
-        conn.close()
-        
-        logger.info(f"Данные синхронизированы в PostgreSQL: {data_type} {action}")
+    logger.info(f"Синхронизировано в PostgreSQL изменений: {len(records)}")
+
+
+def sync_to_database(user_id: int, data_type: str, action: str, data: dict = None):
+    """
+    Ставит изменение данных в очередь синхронизации с PostgreSQL
+
+    Изменение дописывается в локальный журнал и применяется фоновой задачей,
+    поэтому ответ пользователю не ждет базу данных.
+    """
+    if not DATABASE_URL:
+        logger.info(f"PostgreSQL недоступен, синхронизация {data_type} пропущена")
+        return False
+    try:
+        sync_spool.enqueue(user_id, data_type, action, data)
         return True
-        
     except Exception as e:
-        logger.error(f"Ошибка синхронизации в PostgreSQL: {e}")
-        if conn:
-            conn.rollback()
-            conn.close()
+        logger.error(f"Ошибка постановки изменения {data_type} {action} в очередь синхронизации: {e}")
+        return False
+
+
+def sync_expenses_batch(entries: list) -> bool:
+    """Ставит пачку добавленных расходов [(user_id, строка журнала)] в очередь синхронизации"""
+    if not DATABASE_URL:
+        logger.info(f"PostgreSQL недоступен, синхронизация {len(entries)} расходов пропущена")
+        return False
+    try:
+        sync_spool.enqueue_many([
+            (user_id, "expense", "add", {
+                'amount': row['amount'],
+                'category': row['category'],
+                'description': row['description'],
+                'transaction_date': row['transaction_date']
+            })
+            for user_id, row in entries
+        ])
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка постановки пачки расходов в очередь синхронизации: {e}")
         return False
 
 
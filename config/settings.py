@@ -23,6 +23,7 @@ class DatabaseConfig:
     pool_size: int = 10
     max_overflow: int = 20
     pool_timeout: int = 30
+    pool_max_idle: int = 300
     
     @property
     def url(self) -> Optional[str]:
@@ -105,7 +106,10 @@ class Settings:
             port=os.environ.get('DATABASE_PORT', '5432'),
             name=os.environ.get('DATABASE_NAME'),
             user=os.environ.get('DATABASE_USER'),
-            password=os.environ.get('DATABASE_PASSWORD')
+            password=os.environ.get('DATABASE_PASSWORD'),
+            pool_size=int(os.environ.get('DATABASE_POOL_SIZE', '10')),
+            pool_timeout=int(os.environ.get('DATABASE_POOL_TIMEOUT', '30')),
+            pool_max_idle=int(os.environ.get('DATABASE_POOL_MAX_IDLE', '300'))
         )
         
         self.cache = CacheConfig(
@@ -4,28 +4,59 @@
 """
 
 import os
+import functools
+import inspect
+import threading
 import psycopg2
+from psycopg2.extensions import make_dsn
 from psycopg2.extras import RealDictCursor
 import json
+from contextlib import contextmanager
 from datetime import datetime, date, time
 from typing import Dict, List, Optional, Tuple, Any
 import logging
 
+from utils.cache import SimpleCache
+from utils.db_pool import ConnectionPool, PoolTimeoutError
+from utils.migrations import schema_migrations
+from utils.offline_journal import offline_journal
+
+# Операций офлайн-журнала в одной транзакции при повторе
+OFFLINE_REPLAY_BATCH = 200
+
+# Ошибки потери соединения с БД (в отличие от ошибок самого запроса)
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+# Кэш telegram_id -> users.id: размер и время жизни записи (секунды)
+USER_ID_CACHE_SIZE = int(os.getenv('USER_ID_CACHE_SIZE', '10000'))
+USER_ID_CACHE_TTL = int(os.getenv('USER_ID_CACHE_TTL', '3600'))
+
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 class DatabaseManager:
-    """Класс для управления подключением к базе данных"""
+    """Класс для управления подключениями к базе данных через пул"""
     
     def __init__(self):
-        """Инициализация подключения к базе данных"""
-        self.connection = None
+        """Инициализация пула; строка подключения задается при первом обращении"""
+        self.pool = ConnectionPool(
+            max_size=int(os.getenv('DATABASE_POOL_SIZE', '10')),
+            acquire_timeout=float(os.getenv('DATABASE_POOL_TIMEOUT', '30')),
+            max_idle=float(os.getenv('DATABASE_POOL_MAX_IDLE', '300')),
+            connect=lambda dsn: psycopg2.connect(dsn, cursor_factory=RealDictCursor)
+        )
+        # Соединение открытой транзакции (transaction()) — свое у каждого потока
+        self._local = threading.local()
+        # Офлайн-журнал повторяет только один поток
+        self._replay_lock = threading.Lock()
+        # Последняя попытка подключения не удалась: is_available переподключается
+        self._failed = False
         # Не подключаемся сразу, чтобы не падать при импорте
         # self.connect()
     
     def connect(self):
-        """Установка соединения с базой данных"""
+        """Настройка пула по переменным окружения и проверка подключения"""
         try:
             # Проверяем наличие переменных окружения
             required_vars = ['DATABASE_HOST', 'DATABASE_NAME', 'DATABASE_USER', 'DATABASE_PASSWORD']
@@ -37,92 +68,273 @@ class DatabaseManager:
                 return None
             
             # Получаем параметры подключения из переменных окружения
-            self.connection = psycopg2.connect(
+            self.pool.configure(make_dsn(
                 host=os.getenv('DATABASE_HOST'),
                 port=os.getenv('DATABASE_PORT', '5432'),
-                database=os.getenv('DATABASE_NAME'),
+                dbname=os.getenv('DATABASE_NAME'),
                 user=os.getenv('DATABASE_USER'),
-                password=os.getenv('DATABASE_PASSWORD'),
-                cursor_factory=RealDictCursor
-            )
+                password=os.getenv('DATABASE_PASSWORD')
+            ))
+            self.pool.acquire().close()
+            self._failed = False
             logger.info("Успешное подключение к базе данных")
+            return self.pool
         except Exception as e:
+            self._failed = True
             logger.error(f"Ошибка подключения к базе данных: {e}")
             logger.warning("Продолжаем работу без базы данных")
             return None
     
     def get_connection(self):
-        """Получение соединения с базой данных"""
-        if self.connection is None or self.connection.closed:
-            self.connect()
-        return self.connection
+        """
+        Соединение из пула (None, если БД недоступна)
+        
+        close() у полученного соединения возвращает его в пул.
+        """
+        if not self.pool.dsn and self.connect() is None:
+            return None
+        try:
+            conn = self.pool.acquire()
+        except PoolTimeoutError as e:
+            logger.warning(f"Пул соединений с БД исчерпан: {e}")
+            return None
+        except Exception as e:
+            self._failed = True
+            logger.error(f"Ошибка подключения к базе данных: {e}")
+            return None
+        self._failed = False
+        return conn
+    
+    def in_transaction(self) -> bool:
+        """Открыта ли в текущем потоке транзакция transaction()"""
+        return getattr(self._local, 'conn', None) is not None
     
     def is_available(self):
-        """Проверка доступности базы данных"""
-        return self.get_connection() is not None
+        """
+        Проверка доступности базы данных; при появлении БД повторяет офлайн-журнал
+        
+        Проверка дешевая: пул настроен и последнее подключение удалось.
+        Соединение из пула берется только после сбоя подключения и перед
+        повтором офлайн-журнала.
+        """
+        if self.in_transaction():
+            return True
+        if (not self.pool.dsn or self._failed) and self.connect() is None:
+            return False
+        if offline_journal.has_pending():
+            conn = self.get_connection()
+            if conn is None:
+                return False
+            conn.close()
+            self.replay_offline()
+        return True
     
-    def execute_query(self, query: str, params: tuple = None, fetch: bool = False) -> Optional[List[Dict]]:
-        """Выполнение SQL запроса"""
+    @contextmanager
+    def transaction(self):
+        """
+        Транзакция на время блока with
+        
+        Все execute_query этого потока внутри блока идут через одно соединение
+        из пула и фиксируются одним commit при выходе; исключение откатывает
+        их вместе. Вложенный блок входит во внешнюю транзакцию.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            yield conn
+            return
+        conn = self.get_connection()
+        if conn is None:
+            raise psycopg2.OperationalError("База данных недоступна")
+        self._local.conn = conn
         try:
-            conn = self.get_connection()
-            with conn.cursor() as cursor:
-                cursor.execute(query, params)
-                if fetch:
-                    return cursor.fetchall()
-                conn.commit()
-                return cursor.rowcount
+            yield conn
+            conn.commit()
         except Exception as e:
-            logger.error(f"Ошибка выполнения запроса: {e}")
-            conn.rollback()
+            if isinstance(e, CONNECTION_ERRORS):
+                # Соединение оборвалось: is_available переподключится
+                self._failed = True
+            try:
+                conn.rollback()
+            except Exception:
+                pass
             raise
+        finally:
+            self._local.conn = None
+            conn.close()
+    
+    def execute_query(self, query: str, params: tuple = None, fetch: bool = False) -> Optional[List[Dict]]:
+        """Выполнение SQL запроса (вне transaction() — в своей транзакции)"""
+        with self.transaction() as conn:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute(query, params)
+                    if fetch:
+                        return cursor.fetchall()
+                    return cursor.rowcount
+            except Exception as e:
+                logger.error(f"Ошибка выполнения запроса: {e}")
+                raise
+
+    def replay_offline(self) -> int:
+        """
+        Повторяет операции офлайн-журнала по порядку
+        
+        Операции применяются пачками по OFFLINE_REPLAY_BATCH в одной
+        транзакции. Операция, которую БД отвергла, откатывается до точки
+        сохранения и пропускается; при потере соединения пачка остается
+        в журнале до следующего восстановления.
+        
+        Returns:
+            Количество обработанных операций
+        """
+        if not self._replay_lock.acquire(blocking=False):
+            # Журнал уже повторяет другой поток
+            return 0
+        processed = 0
+        try:
+            while True:
+                records = offline_journal.pending(OFFLINE_REPLAY_BATCH)
+                if not records:
+                    break
+                done = 0
+                try:
+                    with self.transaction() as conn, conn.cursor() as cursor:
+                        for record in records:
+                            cursor.execute("SAVEPOINT offline_replay")
+                            try:
+                                applied = OFFLINE_OPERATIONS[record["op"]](**record["args"])
+                            except CONNECTION_ERRORS:
+                                raise
+                            except Exception as e:
+                                logger.error(f"Операция офлайн-журнала #{record['seq']} {record['op']} отвергнута: {e}")
+                                applied = False
+                            if not applied:
+                                # Операция могла сама перехватить ошибку запроса
+                                cursor.execute("ROLLBACK TO SAVEPOINT offline_replay")
+                                logger.warning(f"Операция офлайн-журнала #{record['seq']} {record['op']} пропущена")
+                            done += 1
+                except Exception as e:
+                    logger.warning(f"Повтор офлайн-журнала прерван, осталось {len(records)} операций в пачке: {e}")
+                    break
+                offline_journal.discard(done)
+                processed += done
+        finally:
+            self._replay_lock.release()
+        if processed:
+            logger.info(f"Офлайн-журнал повторен: {processed} операций")
+        return processed
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Статистика пула: занятые соединения, ожидания и время ожидания"""
+        return self.pool.get_stats()
     
     def close(self):
-        """Закрытие соединения с базой данных"""
-        if self.connection:
-            self.connection.close()
+        """Закрытие свободных соединений пула"""
+        self.pool.close_all()
 
 # Глобальный экземпляр менеджера базы данных
 db_manager = DatabaseManager()
 
+
+# Кэш telegram_id -> users.id (см. get_user_id)
+_user_id_cache = SimpleCache(ttl=USER_ID_CACHE_TTL, max_size=USER_ID_CACHE_SIZE)
+_user_id_lock = threading.Lock()
+# Поколение записи кэша: растет при каждом сбросе (invalidate_user_id)
+_user_id_generations: Dict[str, int] = {}
+
+
+def _defer_offline(op: str, **args) -> bool:
+    """Откладывает запись в офлайн-журнал, пока БД недоступна или журнал не повторен"""
+    logger.warning(f"База данных недоступна, операция {op} записана в офлайн-журнал")
+    return offline_journal.record(op, **args)
+
+
+def _defer_on_outage(func):
+    """
+    Запись, у которой оборвалось соединение с БД, уходит в офлайн-журнал
+
+    is_available проверяет только состояние пула, поэтому обрыв после
+    проверки виден лишь как исключение execute_query; без журнала такая
+    запись терялась бы. Внутри открытой transaction() (в том числе при
+    повторе журнала) ошибка пробрасывается: откат решает вызывающий код.
+
+    Пока в журнале остаются операции (его повторяет другой поток или повтор
+    прервался), новая запись тоже встает в журнал, за ними: иначе она
+    попала бы в БД раньше более старых операций.
+    """
+    signature = inspect.signature(func)
+
+    def defer(args, kwargs):
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        return _defer_offline(func.__name__, **bound.arguments)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not db_manager.in_transaction() and db_manager.is_available() and offline_journal.has_pending():
+            return defer(args, kwargs)
+        try:
+            return func(*args, **kwargs)
+        except CONNECTION_ERRORS as e:
+            if db_manager.in_transaction():
+                raise
+            logger.error(f"Соединение с базой данных потеряно при {func.__name__}: {e}")
+            return defer(args, kwargs)
+    return wrapper
+
 # ============ ФУНКЦИИ ДЛЯ РАБОТЫ С ПОЛЬЗОВАТЕЛЯМИ ============
 
 def get_user_by_telegram_id(telegram_id: int) -> Optional[Dict]:
-    """Получение пользователя по Telegram ID"""
+    """Получение пользователя по Telegram ID (id пользователя попадает в кэш get_user_id)"""
     if not db_manager.is_available():
         return None
     
+    key = str(telegram_id)
+    with _user_id_lock:
+        generation = _user_id_generations.get(key, 0)
     query = """
         SELECT * FROM users 
         WHERE telegram_id = %s AND is_active = TRUE
     """
     result = db_manager.execute_query(query, (telegram_id,), fetch=True)
-    return result[0] if result else None
+    if not result:
+        return None
+    # Строку незафиксированной транзакции не кэшируем: ее может откатить
+    if not db_manager.in_transaction():
+        with _user_id_lock:
+            # Сброс кэша во время запроса: строка могла устареть
+            if _user_id_generations.get(key, 0) == generation:
+                _user_id_cache.set(key, result[0]['id'])
+    return result[0]
+
+def get_user_id(telegram_id: int) -> Optional[int]:
+    """
+    Внутренний id пользователя по Telegram ID
+    
+    Почти каждая функция модуля нуждается только в users.id, поэтому id
+    берется из ограниченного кэша, а не отдельным SELECT * на каждую
+    операцию. Кэш сбрасывают create_user, update_user_role и deactivate_user.
+    """
+    with _user_id_lock:
+        user_id = _user_id_cache.get(str(telegram_id))
+    if user_id is not None:
+        return user_id
+    user = get_user_by_telegram_id(telegram_id)
+    return user['id'] if user else None
+
+def invalidate_user_id(telegram_id: int):
+    """Удаляет id пользователя из кэша"""
+    key = str(telegram_id)
+    with _user_id_lock:
+        _user_id_generations[key] = _user_id_generations.get(key, 0) + 1
+        _user_id_cache.delete(key)
 
+@_defer_on_outage
 def create_user(telegram_id: int, username: str = None, folder_name: str = None, role: str = "user") -> bool:
     """Создание нового пользователя"""
     if not db_manager.is_available():
-        return False
-    
-    # Принудительно создаем таблицу users если её нет
-    try:
-        conn = db_manager.get_connection()
-        if conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    id SERIAL PRIMARY KEY,
-                    telegram_id BIGINT UNIQUE NOT NULL,
-                    username VARCHAR(255),
-                    folder_name VARCHAR(255),
-                    role VARCHAR(50) DEFAULT 'user',
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    is_active BOOLEAN DEFAULT TRUE
-                )
-            """)
-            conn.commit()
-    except Exception as e:
-        logger.error(f"Ошибка создания таблицы users: {e}")
+        return _defer_offline("create_user", telegram_id=telegram_id, username=username,
+                              folder_name=folder_name, role=role)
     
     query = """
         INSERT INTO users (telegram_id, username, folder_name, role)
@@ -135,6 +347,7 @@ def create_user(telegram_id: int, username: str = None, folder_name: str = None,
     """
     
     result = db_manager.execute_query(query, (telegram_id, username, folder_name, role))
+    invalidate_user_id(telegram_id)
     return result is not None
 
 def get_all_users() -> List[Dict[str, Any]]:
@@ -156,11 +369,11 @@ def get_all_users() -> List[Dict[str, Any]]:
         logger.error(f"Ошибка получения всех пользователей: {e}")
         return []
 
+@_defer_on_outage
 def update_user_role(telegram_id: int, new_role: str) -> bool:
     """Обновляет роль пользователя"""
     if not db_manager.is_available():
-        logger.warning("База данных недоступна")
-        return False
+        return _defer_offline("update_user_role", telegram_id=telegram_id, new_role=new_role)
     
     try:
         query = """
@@ -169,16 +382,45 @@ def update_user_role(telegram_id: int, new_role: str) -> bool:
             WHERE telegram_id = %s
         """
         result = db_manager.execute_query(query, (new_role, telegram_id))
+        invalidate_user_id(telegram_id)
         if result and result > 0:
             logger.info(f"Роль пользователя {telegram_id} обновлена на {new_role}")
             return True
         else:
             logger.warning(f"Пользователь {telegram_id} не найден")
             return False
+    except CONNECTION_ERRORS:
+        raise
     except Exception as e:
         logger.error(f"Ошибка обновления роли пользователя {telegram_id}: {e}")
         return False
 
+@_defer_on_outage
+def deactivate_user(telegram_id: int) -> bool:
+    """Деактивирует пользователя (is_active = FALSE)"""
+    if not db_manager.is_available():
+        return _defer_offline("deactivate_user", telegram_id=telegram_id)
+    
+    try:
+        query = """
+            UPDATE users 
+            SET is_active = FALSE, updated_at = CURRENT_TIMESTAMP
+            WHERE telegram_id = %s
+        """
+        result = db_manager.execute_query(query, (telegram_id,))
+        invalidate_user_id(telegram_id)
+        if result and result > 0:
+            logger.info(f"Пользователь {telegram_id} деактивирован")
+            return True
+        else:
+            logger.warning(f"Пользователь {telegram_id} не найден")
+            return False
+    except CONNECTION_ERRORS:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка деактивации пользователя {telegram_id}: {e}")
+        return False
+
 # ============ ФУНКЦИИ ДЛЯ РАБОТЫ С КАТЕГОРИЯМИ ============
 
 def get_user_categories(telegram_id: int) -> List[Dict[str, Any]]:
@@ -187,50 +429,29 @@ def get_user_categories(telegram_id: int) -> List[Dict[str, Any]]:
         logger.warning("База данных недоступна")
         return []
     
-    # Получаем пользователя по telegram_id
-    user = get_user_by_telegram_id(telegram_id)
-    if not user:
+    # Получаем id пользователя по telegram_id (из кэша)
+    user_id = get_user_id(telegram_id)
+    if not user_id:
         logger.error(f"Пользователь {telegram_id} не найден")
         return []
     
-    # Принудительно создаем таблицу user_categories если её нет
-    try:
-        conn = db_manager.get_connection()
-        if conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS user_categories (
-                    id SERIAL PRIMARY KEY,
-                    user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
-                    category_name VARCHAR(255) NOT NULL,
-                    category_type VARCHAR(50) DEFAULT 'expense',
-                    color VARCHAR(7) DEFAULT '#3498db',
-                    icon VARCHAR(50),
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    UNIQUE(user_id, category_name)
-                )
-            """)
-            conn.commit()
-    except Exception as e:
-        logger.error(f"Ошибка создания таблицы user_categories: {e}")
-    
     query = """
         SELECT * FROM user_categories 
         WHERE user_id = %s 
         ORDER BY category_name
     """
-    result = db_manager.execute_query(query, (user['id'],), fetch=True)
+    result = db_manager.execute_query(query, (user_id,), fetch=True)
     return result if result else []
 
+@_defer_on_outage
 def create_default_categories(telegram_id: int) -> bool:
     """Создание категорий по умолчанию для пользователя"""
     if not db_manager.is_available():
-        logger.warning("База данных недоступна")
-        return False
+        return _defer_offline("create_default_categories", telegram_id=telegram_id)
     
-    # Получаем пользователя по telegram_id
-    user = get_user_by_telegram_id(telegram_id)
-    if not user:
+    # Получаем id пользователя по telegram_id (из кэша)
+    user_id = get_user_id(telegram_id)
+    if not user_id:
         logger.error(f"Пользователь {telegram_id} не найден")
         return False
     
@@ -245,61 +466,45 @@ def create_default_categories(telegram_id: int) -> bool:
     ]
     
     try:
-        for category_name, category_type, color, icon in default_categories:
-            query = """
-                INSERT INTO user_categories (user_id, category_name, category_type, color, icon)
-                VALUES (%s, %s, %s, %s, %s)
-                ON CONFLICT (user_id, category_name) DO NOTHING
-            """
-            db_manager.execute_query(query, (user['id'], category_name, category_type, color, icon))
+        # Все категории — одной транзакцией
+        with db_manager.transaction():
+            for category_name, category_type, color, icon in default_categories:
+                query = """
+                    INSERT INTO user_categories (user_id, category_name, category_type, color, icon)
+                    VALUES (%s, %s, %s, %s, %s)
+                    ON CONFLICT (user_id, category_name) DO NOTHING
+                """
+                db_manager.execute_query(query, (user_id, category_name, category_type, color, icon))
         
         logger.info(f"Созданы категории по умолчанию для пользователя {telegram_id}")
         return True
+    except CONNECTION_ERRORS:
+        raise
     except Exception as e:
         logger.error(f"Ошибка создания категорий по умолчанию: {e}")
         return False
 
 # ============ ФУНКЦИИ ДЛЯ РАБОТЫ С РАСХОДАМИ ============
 
+@_defer_on_outage
 def add_expense(telegram_id: int, category_id: int, amount: float, description: str, expense_date: date) -> bool:
     """Добавление расхода"""
     if not db_manager.is_available():
-        logger.warning("База данных недоступна")
-        return False
+        return _defer_offline("add_expense", telegram_id=telegram_id, category_id=category_id, amount=amount,
+                              description=description, expense_date=expense_date)
     
-    # Получаем пользователя по telegram_id
-    user = get_user_by_telegram_id(telegram_id)
-    if not user:
+    # Получаем id пользователя по telegram_id (из кэша)
+    user_id = get_user_id(telegram_id)
+    if not user_id:
         logger.error(f"Пользователь {telegram_id} не найден")
         return False
     
-    # Принудительно создаем таблицу expenses если её нет
-    try:
-        conn = db_manager.get_connection()
-        if conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS expenses (
-                    id SERIAL PRIMARY KEY,
-                    user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
-                    category_id INTEGER REFERENCES user_categories(id) ON DELETE SET NULL,
-                    amount DECIMAL(10,2) NOT NULL,
-                    description TEXT,
-                    date DATE NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            conn.commit()
-    except Exception as e:
-        logger.error(f"Ошибка создания таблицы expenses: {e}")
-    
     query = """
         INSERT INTO expenses (user_id, category_id, amount, description, date)
         VALUES (%s, %s, %s, %s, %s)
     """
     
-    result = db_manager.execute_query(query, (user['id'], category_id, amount, description, expense_date))
+    result = db_manager.execute_query(query, (user_id, category_id, amount, description, expense_date))
     return result is not None
 
 # ============ ФУНКЦИИ ДЛЯ РАБОТЫ С ПЛАНАМИ БЮДЖЕТА ============
@@ -310,9 +515,9 @@ def get_user_budget_plans(telegram_id: int) -> List[Dict[str, Any]]:
         logger.warning("База данных недоступна")
         return []
     
-    # Получаем пользователя по telegram_id
-    user = get_user_by_telegram_id(telegram_id)
-    if not user:
+    # Получаем id пользователя по telegram_id (из кэша)
+    user_id = get_user_id(telegram_id)
+    if not user_id:
         logger.error(f"Пользователь {telegram_id} не найден")
         return []
     
@@ -321,53 +526,31 @@ def get_user_budget_plans(telegram_id: int) -> List[Dict[str, Any]]:
         WHERE user_id = %s AND is_active = TRUE
         ORDER BY created_at DESC
     """
-    result = db_manager.execute_query(query, (user['id'],), fetch=True)
+    result = db_manager.execute_query(query, (user_id,), fetch=True)
     return result if result else []
 
+@_defer_on_outage
 def save_user_budget_plan(telegram_id: int, plan_name: str, total_amount: float, 
                          start_date: date, end_date: date, categories: List[str] = None) -> bool:
     """Сохранение плана бюджета пользователя"""
     if not db_manager.is_available():
-        logger.warning("База данных недоступна")
-        return False
+        return _defer_offline("save_user_budget_plan", telegram_id=telegram_id, plan_name=plan_name,
+                              total_amount=total_amount, start_date=start_date, end_date=end_date,
+                              categories=categories)
     
-    # Получаем пользователя по telegram_id
-    user = get_user_by_telegram_id(telegram_id)
-    if not user:
+    # Получаем id пользователя по telegram_id (из кэша)
+    user_id = get_user_id(telegram_id)
+    if not user_id:
         logger.error(f"Пользователь {telegram_id} не найден")
         return False
     
-    # Принудительно создаем таблицу budget_plans если её нет
-    try:
-        conn = db_manager.get_connection()
-        if conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS budget_plans (
-                    id SERIAL PRIMARY KEY,
-                    user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
-                    plan_name VARCHAR(255) NOT NULL,
-                    total_amount DECIMAL(10,2) NOT NULL,
-                    spent_amount DECIMAL(10,2) DEFAULT 0.00,
-                    start_date DATE NOT NULL,
-                    end_date DATE NOT NULL,
-                    categories JSONB,
-                    is_active BOOLEAN DEFAULT TRUE,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            conn.commit()
-    except Exception as e:
-        logger.error(f"Ошибка создания таблицы budget_plans: {e}")
-    
     query = """
         INSERT INTO budget_plans (user_id, plan_name, total_amount, start_date, end_date, categories)
         VALUES (%s, %s, %s, %s, %s, %s)
     """
     
     categories_json = json.dumps(categories) if categories else None
-    result = db_manager.execute_query(query, (user['id'], plan_name, total_amount, start_date, end_date, categories_json))
+    result = db_manager.execute_query(query, (user_id, plan_name, total_amount, start_date, end_date, categories_json))
     return result is not None
 
 # ============ ФУНКЦИИ ДЛЯ РАБОТЫ С НАПОМИНАНИЯМИ ============
@@ -378,9 +561,9 @@ def get_user_reminders(telegram_id: int) -> List[Dict[str, Any]]:
         logger.warning("База данных недоступна")
         return []
     
-    # Получаем пользователя по telegram_id
-    user = get_user_by_telegram_id(telegram_id)
-    if not user:
+    # Получаем id пользователя по telegram_id (из кэша)
+    user_id = get_user_id(telegram_id)
+    if not user_id:
         logger.error(f"Пользователь {telegram_id} не найден")
         return []
     
@@ -389,19 +572,21 @@ def get_user_reminders(telegram_id: int) -> List[Dict[str, Any]]:
         WHERE user_id = %s AND is_completed = FALSE
         ORDER BY reminder_date, reminder_time
     """
-    result = db_manager.execute_query(query, (user['id'],), fetch=True)
+    result = db_manager.execute_query(query, (user_id,), fetch=True)
     return result if result else []
 
+@_defer_on_outage
 def add_reminder(telegram_id: int, title: str, description: str, reminder_date: date, 
                 reminder_time: time = None, is_recurring: bool = False, pattern: str = None) -> bool:
     """Добавление напоминания"""
     if not db_manager.is_available():
-        logger.warning("База данных недоступна")
-        return False
+        return _defer_offline("add_reminder", telegram_id=telegram_id, title=title, description=description,
+                              reminder_date=reminder_date, reminder_time=reminder_time,
+                              is_recurring=is_recurring, pattern=pattern)
     
-    # Получаем пользователя по telegram_id
-    user = get_user_by_telegram_id(telegram_id)
-    if not user:
+    # Получаем id пользователя по telegram_id (из кэша)
+    user_id = get_user_id(telegram_id)
+    if not user_id:
         logger.error(f"Пользователь {telegram_id} не найден")
         return False
     
@@ -410,11 +595,15 @@ def add_reminder(telegram_id: int, title: str, description: str, reminder_date:
         VALUES (%s, %s, %s, %s, %s, %s, %s)
     """
     
-    result = db_manager.execute_query(query, (user['id'], title, description, reminder_date, reminder_time, is_recurring, pattern))
+    result = db_manager.execute_query(query, (user_id, title, description, reminder_date, reminder_time, is_recurring, pattern))
     return result is not None
 
+@_defer_on_outage
 def delete_reminder(reminder_id: int) -> bool:
     """Удаление напоминания"""
+    if not db_manager.is_available():
+        return _defer_offline("delete_reminder", reminder_id=reminder_id)
+
     query = """
         DELETE FROM reminders WHERE id = %s
     """
@@ -430,9 +619,9 @@ def get_user_settings(telegram_id: int) -> Dict[str, Any]:
         logger.warning("База данных недоступна")
         return {}
     
-    # Получаем пользователя по telegram_id
-    user = get_user_by_telegram_id(telegram_id)
-    if not user:
+    # Получаем id пользователя по telegram_id (из кэша)
+    user_id = get_user_id(telegram_id)
+    if not user_id:
         logger.error(f"Пользователь {telegram_id} не найден")
         return {}
     
@@ -440,7 +629,7 @@ def get_user_settings(telegram_id: int) -> Dict[str, Any]:
         SELECT setting_key, setting_value FROM user_settings 
         WHERE user_id = %s
     """
-    result = db_manager.execute_query(query, (user['id'],), fetch=True)
+    result = db_manager.execute_query(query, (user_id,), fetch=True)
     
     settings = {}
     if result:
@@ -449,15 +638,15 @@ def get_user_settings(telegram_id: int) -> Dict[str, Any]:
     
     return settings
 
+@_defer_on_outage
 def save_user_setting(telegram_id: int, key: str, value: str) -> bool:
     """Сохранение настройки пользователя"""
     if not db_manager.is_available():
-        logger.warning("База данных недоступна")
-        return False
+        return _defer_offline("save_user_setting", telegram_id=telegram_id, key=key, value=value)
     
-    # Получаем пользователя по telegram_id
-    user = get_user_by_telegram_id(telegram_id)
-    if not user:
+    # Получаем id пользователя по telegram_id (из кэша)
+    user_id = get_user_id(telegram_id)
+    if not user_id:
         logger.error(f"Пользователь {telegram_id} не найден")
         return False
     
@@ -468,9 +657,22 @@ def save_user_setting(telegram_id: int, key: str, value: str) -> bool:
         DO UPDATE SET setting_value = EXCLUDED.setting_value, updated_at = CURRENT_TIMESTAMP
     """
     
-    result = db_manager.execute_query(query, (user['id'], key, value))
+    result = db_manager.execute_query(query, (user_id, key, value))
     return result is not None
 
+# Операции, которые записываются в офлайн-журнал и повторяются после восстановления БД
+OFFLINE_OPERATIONS = {
+    "create_user": create_user,
+    "update_user_role": update_user_role,
+    "deactivate_user": deactivate_user,
+    "create_default_categories": create_default_categories,
+    "add_expense": add_expense,
+    "save_user_budget_plan": save_user_budget_plan,
+    "add_reminder": add_reminder,
+    "delete_reminder": delete_reminder,
+    "save_user_setting": save_user_setting
+}
+
 # ============ ФУНКЦИИ ИНИЦИАЛИЗАЦИИ ============
 
 def init_db():
@@ -483,101 +685,98 @@ def init_db():
         logger.error(f"Ошибка инициализации базы данных: {e}")
         return False
 
+@schema_migrations.register(2, "Таблицы пользователей, категорий, расходов, планов, напоминаний и настроек")
+def migrate_user_tables(cursor):
+    """Схема database.py (раньше создавалась при каждом запуске и внутри функций записи)"""
+    tables = [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            telegram_id BIGINT UNIQUE NOT NULL,
+            username VARCHAR(255),
+            folder_name VARCHAR(255),
+            role VARCHAR(50) DEFAULT 'user',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            is_active BOOLEAN DEFAULT TRUE
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS user_categories (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+            category_name VARCHAR(255) NOT NULL,
+            category_type VARCHAR(50) DEFAULT 'expense',
+            color VARCHAR(7) DEFAULT '#3498db',
+            icon VARCHAR(50),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(user_id, category_name)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS expenses (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+            category_id INTEGER REFERENCES user_categories(id) ON DELETE SET NULL,
+            amount DECIMAL(10,2) NOT NULL,
+            description TEXT,
+            date DATE NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS budget_plans (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+            plan_name VARCHAR(255) NOT NULL,
+            total_amount DECIMAL(10,2) NOT NULL,
+            spent_amount DECIMAL(10,2) DEFAULT 0.00,
+            start_date DATE NOT NULL,
+            end_date DATE NOT NULL,
+            categories JSONB,
+            is_active BOOLEAN DEFAULT TRUE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS reminders (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+            title VARCHAR(255) NOT NULL,
+            description TEXT,
+            reminder_date DATE NOT NULL,
+            reminder_time TIME,
+            is_recurring BOOLEAN DEFAULT FALSE,
+            recurring_pattern VARCHAR(50),
+            is_completed BOOLEAN DEFAULT FALSE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS user_settings (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+            setting_key VARCHAR(255) NOT NULL,
+            setting_value TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(user_id, setting_key)
+        )
+        """
+    ]
+    
+    for table_sql in tables:
+        cursor.execute(table_sql)
+
 def ensure_tables_exist():
-    """Создание таблиц если их нет"""
+    """Применяет недостающие миграции схемы"""
     try:
         if db_manager.is_available():
-            conn = db_manager.get_connection()
-            if conn:
-                cursor = conn.cursor()
-                
-                # Создаем все таблицы
-                tables = [
-                    """
-                    CREATE TABLE IF NOT EXISTS users (
-                        id SERIAL PRIMARY KEY,
-                        telegram_id BIGINT UNIQUE NOT NULL,
-                        username VARCHAR(255),
-                        folder_name VARCHAR(255),
-                        role VARCHAR(50) DEFAULT 'user',
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        is_active BOOLEAN DEFAULT TRUE
-                    )
-                    """,
-                    """
-                    CREATE TABLE IF NOT EXISTS user_categories (
-                        id SERIAL PRIMARY KEY,
-                        user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
-                        category_name VARCHAR(255) NOT NULL,
-                        category_type VARCHAR(50) DEFAULT 'expense',
-                        color VARCHAR(7) DEFAULT '#3498db',
-                        icon VARCHAR(50),
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        UNIQUE(user_id, category_name)
-                    )
-                    """,
-                    """
-                    CREATE TABLE IF NOT EXISTS expenses (
-                        id SERIAL PRIMARY KEY,
-                        user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
-                        category_id INTEGER REFERENCES user_categories(id) ON DELETE SET NULL,
-                        amount DECIMAL(10,2) NOT NULL,
-                        description TEXT,
-                        date DATE NOT NULL,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                    """,
-                    """
-                    CREATE TABLE IF NOT EXISTS budget_plans (
-                        id SERIAL PRIMARY KEY,
-                        user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
-                        plan_name VARCHAR(255) NOT NULL,
-                        total_amount DECIMAL(10,2) NOT NULL,
-                        spent_amount DECIMAL(10,2) DEFAULT 0.00,
-                        start_date DATE NOT NULL,
-                        end_date DATE NOT NULL,
-                        categories JSONB,
-                        is_active BOOLEAN DEFAULT TRUE,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                    """,
-                    """
-                    CREATE TABLE IF NOT EXISTS reminders (
-                        id SERIAL PRIMARY KEY,
-                        user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
-                        title VARCHAR(255) NOT NULL,
-                        description TEXT,
-                        reminder_date DATE NOT NULL,
-                        reminder_time TIME,
-                        is_recurring BOOLEAN DEFAULT FALSE,
-                        recurring_pattern VARCHAR(50),
-                        is_completed BOOLEAN DEFAULT FALSE,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                    """,
-                    """
-                    CREATE TABLE IF NOT EXISTS user_settings (
-                        id SERIAL PRIMARY KEY,
-                        user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
-                        setting_key VARCHAR(255) NOT NULL,
-                        setting_value TEXT,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        UNIQUE(user_id, setting_key)
-                    )
-                    """
-                ]
-                
-                for table_sql in tables:
-                    cursor.execute(table_sql)
-                
-                conn.commit()
-                logger.info("Таблицы созданы/проверены")
-        
+            with db_manager.transaction() as conn:
+                schema_migrations.run(conn)
         return True
     except Exception as e:
         logger.error(f"Ошибка создания таблиц: {e}")
@@ -589,99 +788,101 @@ def migrate_user_data(telegram_id: int, user_folder_path: str) -> bool:
         logger.warning("База данных недоступна")
         return False
     
-    # Получаем пользователя по telegram_id
-    user = get_user_by_telegram_id(telegram_id)
-    if not user:
+    # Получаем id пользователя по telegram_id (из кэша)
+    user_id = get_user_id(telegram_id)
+    if not user_id:
         logger.error(f"Пользователь {telegram_id} не найден")
         return False
     
     try:
-        # Мигрируем категории
-        categories_file = os.path.join(user_folder_path, "user_categories.json")
-        if os.path.exists(categories_file):
-            with open(categories_file, 'r', encoding='utf-8') as f:
-                categories_data = json.load(f)
-                for category in categories_data:
-                    query = """
-                        INSERT INTO user_categories (user_id, category_name, category_type, color, icon)
-                        VALUES (%s, %s, %s, %s, %s)
-                        ON CONFLICT (user_id, category_name) DO NOTHING
-                    """
-                    db_manager.execute_query(query, (
-                        user['id'], 
-                        category['name'], 
-                        category.get('type', 'expense'),
-                        category.get('color', '#3498db'),
-                        category.get('icon', '📦')
-                    ))
+        # Все данные пользователя переносятся одной транзакцией
+        with db_manager.transaction():
+            # Мигрируем категории
+            categories_file = os.path.join(user_folder_path, "user_categories.json")
+            if os.path.exists(categories_file):
+                with open(categories_file, 'r', encoding='utf-8') as f:
+                    categories_data = json.load(f)
+                    for category in categories_data:
+                        query = """
+                            INSERT INTO user_categories (user_id, category_name, category_type, color, icon)
+                            VALUES (%s, %s, %s, %s, %s)
+                            ON CONFLICT (user_id, category_name) DO NOTHING
+                        """
+                        db_manager.execute_query(query, (
+                            user_id, 
+                            category['name'], 
+                            category.get('type', 'expense'),
+                            category.get('color', '#3498db'),
+                            category.get('icon', '📦')
+                        ))
         
-        # Мигрируем расходы
-        expenses_file = os.path.join(user_folder_path, "data", "expenses.json")
-        if os.path.exists(expenses_file):
-            with open(expenses_file, 'r', encoding='utf-8') as f:
-                expenses_data = json.load(f)
-                for expense in expenses_data:
-                    # Находим ID категории
-                    category_query = """
-                        SELECT id FROM user_categories 
-                        WHERE user_id = %s AND category_name = %s
-                    """
-                    category_result = db_manager.execute_query(category_query, (user['id'], expense['category']), fetch=True)
-                    category_id = category_result[0]['id'] if category_result else None
+            # Мигрируем расходы
+            expenses_file = os.path.join(user_folder_path, "data", "expenses.json")
+            if os.path.exists(expenses_file):
+                with open(expenses_file, 'r', encoding='utf-8') as f:
+                    expenses_data = json.load(f)
+                    for expense in expenses_data:
+                        # Находим ID категории
+                        category_query = """
+                            SELECT id FROM user_categories 
+                            WHERE user_id = %s AND category_name = %s
+                        """
+                        category_result = db_manager.execute_query(category_query, (user_id, expense['category']), fetch=True)
+                        category_id = category_result[0]['id'] if category_result else None
                     
-                    expense_date = datetime.strptime(expense['date'], '%Y-%m-%d').date()
-                    query = """
-                        INSERT INTO expenses (user_id, category_id, amount, description, date)
-                        VALUES (%s, %s, %s, %s, %s)
-                    """
-                    db_manager.execute_query(query, (
-                        user['id'], 
-                        category_id, 
-                        expense['amount'], 
-                        expense.get('description', ''), 
-                        expense_date
-                    ))
+                        expense_date = datetime.strptime(expense['date'], '%Y-%m-%d').date()
+                        query = """
+                            INSERT INTO expenses (user_id, category_id, amount, description, date)
+                            VALUES (%s, %s, %s, %s, %s)
+                        """
+                        db_manager.execute_query(query, (
+                            user_id, 
+                            category_id, 
+                            expense['amount'], 
+                            expense.get('description', ''), 
+                            expense_date
+                        ))
         
-        # Мигрируем планы бюджета
-        budget_file = os.path.join(user_folder_path, "budget_plans.json")
-        if os.path.exists(budget_file):
-            with open(budget_file, 'r', encoding='utf-8') as f:
-                budget_data = json.load(f)
-                for plan in budget_data:
-                    start_date = datetime.strptime(plan['start_date'], '%Y-%m-%d').date()
-                    end_date = datetime.strptime(plan['end_date'], '%Y-%m-%d').date()
-                    categories_json = json.dumps(plan.get('categories', []))
+            # Мигрируем планы бюджета
+            budget_file = os.path.join(user_folder_path, "budget_plans.json")
+            if os.path.exists(budget_file):
+                with open(budget_file, 'r', encoding='utf-8') as f:
+                    budget_data = json.load(f)
+                    for plan in budget_data:
+                        start_date = datetime.strptime(plan['start_date'], '%Y-%m-%d').date()
+                        end_date = datetime.strptime(plan['end_date'], '%Y-%m-%d').date()
+                        categories_json = json.dumps(plan.get('categories', []))
                     
-                    query = """
-                        INSERT INTO budget_plans (user_id, plan_name, total_amount, start_date, end_date, categories)
-                        VALUES (%s, %s, %s, %s, %s, %s)
-                    """
-                    db_manager.execute_query(query, (
-                        user['id'], 
-                        plan['name'], 
-                        plan['total_amount'], 
-                        start_date, 
-                        end_date, 
-                        categories_json
-                    ))
+                        query = """
+                            INSERT INTO budget_plans (user_id, plan_name, total_amount, start_date, end_date, categories)
+                            VALUES (%s, %s, %s, %s, %s, %s)
+                        """
+                        db_manager.execute_query(query, (
+                            user_id, 
+                            plan['name'], 
+                            plan['total_amount'], 
+                            start_date, 
+                            end_date, 
+                            categories_json
+                        ))
         
-        # Мигрируем напоминания
-        reminders_file = os.path.join(user_folder_path, "reminders.json")
-        if os.path.exists(reminders_file):
-            with open(reminders_file, 'r', encoding='utf-8') as f:
-                reminders_data = json.load(f)
-                for reminder in reminders_data:
-                    reminder_date = datetime.strptime(reminder['date'], '%Y-%m-%d').date()
-                    reminder_time = datetime.strptime(reminder.get('time', '00:00'), '%H:%M').time()
-                    add_reminder(
-                        telegram_id,
-                        reminder['title'],
-                        reminder.get('description'),
-                        reminder_date,
-                        reminder_time,
-                        reminder.get('recurring', False),
-                        reminder.get('pattern')
-                    )
+            # Мигрируем напоминания
+            reminders_file = os.path.join(user_folder_path, "reminders.json")
+            if os.path.exists(reminders_file):
+                with open(reminders_file, 'r', encoding='utf-8') as f:
+                    reminders_data = json.load(f)
+                    for reminder in reminders_data:
+                        reminder_date = datetime.strptime(reminder['date'], '%Y-%m-%d').date()
+                        reminder_time = datetime.strptime(reminder.get('time', '00:00'), '%H:%M').time()
+                        add_reminder(
+                            telegram_id,
+                            reminder['title'],
+                            reminder.get('description'),
+                            reminder_date,
+                            reminder_time,
+                            reminder.get('recurring', False),
+                            reminder.get('pattern')
+                        )
         
         return True
         
@@ -3,12 +3,18 @@
 """
 import re
 import unicodedata
-from typing import Dict, List, Optional, Tuple
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.linear_model import LogisticRegression
 import pickle
 import os
+import threading
 from utils import logger, DatabaseError
+from utils.online_classifier import OnlineClassifier
+
+# Сколько последних исправлений хранится для полного переобучения
+MAX_FEEDBACK = 5000
 
 class ClassificationService:
     """Сервис для классификации расходов"""
@@ -20,6 +26,17 @@ class ClassificationService:
         self.is_trained = False
         self.model_path = "models/classification_model.pkl"
         self.vectorizer_path = "models/vectorizer.pkl"
+        self.online_model_path = "models/online_model.pkl"
+        # Онлайн-модель дообучается на каждом исправлении (partial_fit)
+        self.online_model = OnlineClassifier()
+        # Последние исправления пользователей; учитываются при полном переобучении
+        self.feedback: Deque[Tuple[str, str]] = deque(maxlen=MAX_FEEDBACK)
+        self.feedback_count = 0
+        # deque нельзя копировать во время добавления из другого потока
+        self._feedback_lock = threading.Lock()
+        # Полное переобучение в фоне после стольких исправлений
+        self.full_refit_every = 50
+        self._refit_lock = threading.Lock()
     
     def _normalize_text(self, text: str) -> str:
         """Нормализация текста для классификации"""
@@ -106,15 +123,18 @@ class ClassificationService:
                 logger.warning("Нет данных для обучения модели")
                 return
             
-            # Обучаем векторизатор
-            self.vectorizer.fit(texts)
-            
-            # Преобразуем тексты в векторы
-            X = self.vectorizer.transform(texts)
+            # Обучаем новые экземпляры, чтобы классификация во время
+            # фонового переобучения пользовалась прежней моделью
+            vectorizer = TfidfVectorizer(max_features=1000, stop_words=None)
+            model = LogisticRegression(random_state=42, max_iter=1000)
+            X = vectorizer.fit_transform(texts)
+            model.fit(X, labels)
             
-            # Обучаем модель
-            self.model.fit(X, labels)
+            # Онлайн-модель обучается на тех же данных и знает все категории
+            online_model = OnlineClassifier()
+            online_model.fit(texts, labels, classes=list(self.categories.keys()))
             
+            self.vectorizer, self.model, self.online_model = vectorizer, model, online_model
             self.is_trained = True
             
             # Сохраняем модель
@@ -137,6 +157,9 @@ class ClassificationService:
             with open(self.vectorizer_path, 'wb') as f:
                 pickle.dump(self.vectorizer, f)
             
+            with open(self.online_model_path, 'wb') as f:
+                pickle.dump(self.online_model, f)
+            
             logger.info("Модель и векторизатор сохранены")
             
         except Exception as e:
@@ -152,6 +175,10 @@ class ClassificationService:
                 with open(self.vectorizer_path, 'rb') as f:
                     self.vectorizer = pickle.load(f)
                 
+                if os.path.exists(self.online_model_path):
+                    with open(self.online_model_path, 'rb') as f:
+                        self.online_model = pickle.load(f)
+                
                 self.is_trained = True
                 logger.info("Модель и векторизатор загружены")
                 
@@ -175,6 +202,12 @@ class ClassificationService:
             if not normalized_text:
                 return "Прочее"
             
+            # После исправлений онлайн-модель актуальнее основной
+            if self.online_model.updates > 0:
+                prediction, max_probability = self.online_model.predict_with_confidence(normalized_text)
+                if prediction is not None and max_probability >= 0.3:
+                    return prediction
+            
             # Преобразуем в вектор
             X = self.vectorizer.transform([normalized_text])
             
@@ -234,33 +267,54 @@ class ClassificationService:
             return 0.5
     
     def retrain_with_feedback(self, description: str, correct_category: str):
-        """Переобучение модели с обратной связью"""
+        """
+        Дообучение модели на исправлении пользователя
+
+        Онлайн-модель обновляется сразу за O(число признаков); полное
+        переобучение запускается в фоне раз в full_refit_every исправлений
+        или когда категория неизвестна онлайн-модели.
+        """
         try:
-            # Добавляем новый пример
             normalized_text = self._normalize_text(description)
             
             if not normalized_text:
                 return
             
-            # Получаем текущие данные
-            texts, labels = self._prepare_training_data()
-            
-            # Добавляем новый пример
-            texts.append(normalized_text)
-            labels.append(correct_category)
+            with self._feedback_lock:
+                self.feedback.append((normalized_text, correct_category))
+                self.feedback_count += 1
             
-            # Переобучаем модель
-            self.vectorizer.fit(texts)
-            X = self.vectorizer.transform(texts)
-            self.model.fit(X, labels)
+            if not self.online_model.is_fitted and self.is_trained is False:
+                self._load_model()
             
-            # Сохраняем модель
-            self._save_model()
+            learned = self.online_model.learn(normalized_text, correct_category)
+            if learned:
+                logger.info(f"Онлайн-модель дообучена: {description} -> {correct_category}")
             
-            logger.info(f"Модель переобучена с новым примером: {description} -> {correct_category}")
+            if not learned or self.feedback_count % self.full_refit_every == 0:
+                self.schedule_full_refit()
             
         except Exception as e:
             logger.error(f"Ошибка переобучения модели: {e}")
+    
+    def schedule_full_refit(self):
+        """Запускает полное переобучение с учетом исправлений в фоновом потоке"""
+        if not self._refit_lock.acquire(blocking=False):
+            logger.info("Полное переобучение уже выполняется")
+            return
+        
+        def run():
+            try:
+                with self._feedback_lock:
+                    feedback = list(self.feedback)
+                self.train_model(additional_data=feedback)
+                logger.info(f"Полное переобучение завершено ({len(feedback)} исправлений)")
+            except Exception as e:
+                logger.error(f"Ошибка полного переобучения модели: {e}")
+            finally:
+                self._refit_lock.release()
+        
+        threading.Thread(target=run, name="classification-refit", daemon=True).start()
 
 # Глобальный экземпляр сервиса
 classification_service = ClassificationService()
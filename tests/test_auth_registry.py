@@ -0,0 +1,28 @@
+"""
+Тесты для реестра авторизованных пользователей
+"""
+import json
+from utils.auth_registry import AuthRegistry
+
+def test_auth_registry_indexes_and_save(tmp_path):
+    """Тест поиска по индексам и обновления после сохранения"""
+    users_file = tmp_path / "authorized_users.json"
+    users_file.write_text(json.dumps({
+        "admin": 1,
+        "users": [{"username": "anna", "telegram_id": 2, "role": "user"}]
+    }), encoding='utf-8')
+
+    registry = AuthRegistry(str(users_file), default_admin=1)
+    assert registry.is_listed(1)
+    assert registry.is_listed(2)
+    assert not registry.is_listed(3)
+    assert registry.get_by_username("anna")["telegram_id"] == 2
+
+    data = registry.load()
+    data["users"].append({"username": "boris", "telegram_id": 3, "role": "user"})
+    # Изменение копии не влияет на реестр до сохранения
+    assert not registry.is_listed(3)
+
+    registry.save(data)
+    assert registry.is_listed(3)
+    assert json.loads(users_file.read_text(encoding='utf-8'))["users"][1]["username"] == "boris"
@@ -0,0 +1,193 @@
+"""
+Тесты для пула и транзакций DatabaseManager и кэша id пользователей
+"""
+import threading
+
+import psycopg2
+import pytest
+from psycopg2 import extensions
+
+import database
+from database import DatabaseManager
+from utils.cache import SimpleCache
+from utils.db_pool import ConnectionPool
+from utils.offline_journal import OfflineJournal
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.rowcount = 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def execute(self, query, params=None):
+        if query == "FAIL":
+            raise ValueError("ошибка запроса")
+        if self.conn.lost:
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+        self.conn.pending.append(query)
+
+    def fetchall(self):
+        return [{"id": 1}]
+
+class FakeConnection:
+    """Соединение без сервера: зафиксированные запросы попадают в committed"""
+
+    # Сервер пропал: любой запрос падает с ошибкой соединения
+    lost = False
+
+    def __init__(self, dsn):
+        self.closed = 0
+        self.pending = []
+        self.commits = []
+
+    def cursor(self, cursor_factory=None):
+        return FakeCursor(self)
+
+    def get_transaction_status(self):
+        return extensions.TRANSACTION_STATUS_INTRANS if self.pending else extensions.TRANSACTION_STATUS_IDLE
+
+    def commit(self):
+        self.commits.append(list(self.pending))
+        self.pending = []
+
+    def rollback(self):
+        self.pending = []
+
+    def close(self):
+        self.closed = 1
+
+def make_manager():
+    manager = DatabaseManager()
+    manager.pool = ConnectionPool("postgresql://test", max_size=2, connect=FakeConnection)
+    return manager
+
+def test_transaction_shares_one_commit_and_rolls_back_on_error():
+    """Тест: запросы в transaction() фиксируются одним commit, ошибка откатывает все"""
+    manager = make_manager()
+    with manager.transaction():
+        manager.execute_query("INSERT 1")
+        with manager.transaction():
+            manager.execute_query("INSERT 2")
+        assert manager.get_stats()["in_use"] == 1
+    raw = manager.pool._idle[0][0]
+    assert raw.commits == [["INSERT 1", "INSERT 2"]]
+
+    with pytest.raises(ValueError):
+        with manager.transaction():
+            manager.execute_query("INSERT 3")
+            manager.execute_query("FAIL")
+    assert raw.commits == [["INSERT 1", "INSERT 2"]]
+
+    assert manager.execute_query("SELECT 1", fetch=True) == [{"id": 1}]
+    stats = manager.get_stats()
+    assert stats["in_use"] == 0 and stats["connects"] == 1
+
+def test_is_available_does_not_check_out_connections():
+    """Тест: проверка доступности не берет соединение из пула"""
+    manager = make_manager()
+    assert manager.is_available() is True
+    assert manager.get_stats()["connects"] == 0
+
+    manager.execute_query("INSERT 1")
+    assert manager.is_available() is True
+    stats = manager.get_stats()
+    assert stats["connects"] == 1 and stats["reuses"] == 0
+
+def test_transactions_are_per_thread():
+    """Тест: транзакция одного потока не захватывает запросы другого"""
+    manager = make_manager()
+    inside = threading.Event()
+    release = threading.Event()
+
+    def worker():
+        with manager.transaction():
+            manager.execute_query("INSERT worker")
+            inside.set()
+            release.wait(1)
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    inside.wait(1)
+    assert not manager.in_transaction()
+    manager.execute_query("INSERT main")
+    assert manager.get_stats()["in_use"] == 1
+    release.set()
+    thread.join()
+    assert manager.get_stats()["connects"] == 2
+
+def test_user_id_is_resolved_once_and_invalidated(monkeypatch):
+    """Тест: повторные операции не читают users, а смена роли сбрасывает кэш"""
+    manager = make_manager()
+    monkeypatch.setattr(database, "db_manager", manager)
+    monkeypatch.setattr(database, "_user_id_cache", SimpleCache(ttl=60, max_size=10))
+
+    def user_lookups():
+        return sum(query.lstrip().startswith("SELECT * FROM users")
+                   for commit in manager.pool._idle[0][0].commits for query in commit)
+
+    assert database.get_user_id(42) == 1
+    assert database.get_user_categories(42) == [{"id": 1}]
+    assert database.save_user_setting(42, "currency", "RUB") is True
+    assert user_lookups() == 1
+
+    assert database.update_user_role(42, "admin") is True
+    assert database.get_user_id(42) == 1
+    assert user_lookups() == 2
+
+def test_stale_lookup_does_not_refill_cache(monkeypatch):
+    """Тест: поиск, с которым разминулся сброс кэша, не кладет в кэш старый id"""
+    manager = make_manager()
+    monkeypatch.setattr(database, "db_manager", manager)
+    monkeypatch.setattr(database, "_user_id_cache", SimpleCache(ttl=60, max_size=10))
+    execute_query = manager.execute_query
+
+    def deactivated_during_select(query, params=None, fetch=False):
+        result = execute_query(query, params, fetch)
+        if query.lstrip().startswith("SELECT * FROM users"):
+            database.invalidate_user_id(42)
+        return result
+
+    monkeypatch.setattr(manager, "execute_query", deactivated_during_select)
+    assert database.get_user_by_telegram_id(42) == {"id": 1}
+    assert database._user_id_cache.get("42") is None
+
+def test_write_is_journaled_when_connection_drops(monkeypatch, tmp_path):
+    """Тест: запись, у которой оборвалось соединение, попадает в офлайн-журнал"""
+    manager = make_manager()
+    journal = OfflineJournal(str(tmp_path))
+    monkeypatch.setattr(database, "db_manager", manager)
+    monkeypatch.setattr(database, "offline_journal", journal)
+    monkeypatch.setattr(database, "_user_id_cache", SimpleCache(ttl=60, max_size=10))
+    assert database.get_user_id(42) == 1
+
+    monkeypatch.setattr(FakeConnection, "lost", True)
+    assert manager.is_available() is True
+    assert database.add_expense(42, 3, 150.0, "обед", None) is True
+    assert [(record["op"], record["args"]["amount"]) for record in journal.pending()] == [("add_expense", 150.0)]
+    # Следующая проверка доступности переподключается, а не отвечает True по старому состоянию
+    assert manager._failed is True
+
+def test_writes_queue_behind_journal_during_replay(monkeypatch, tmp_path):
+    """Тест: пока журнал повторяет другой поток, новая запись встает в журнал за ним"""
+    manager = make_manager()
+    journal = OfflineJournal(str(tmp_path))
+    monkeypatch.setattr(database, "db_manager", manager)
+    monkeypatch.setattr(database, "offline_journal", journal)
+    monkeypatch.setattr(database, "_user_id_cache", SimpleCache(ttl=60, max_size=10))
+    journal.record("delete_reminder", reminder_id=7)
+
+    # Повтор журнала уже идет в другом потоке
+    with manager._replay_lock:
+        assert database.save_user_setting(42, "currency", "RUB") is True
+    assert [record["op"] for record in journal.pending()] == ["delete_reminder", "save_user_setting"]
+
+    assert manager.is_available() is True
+    assert not journal.has_pending()
+    queries = [query.split()[0] for commit in manager.pool._idle[0][0].commits for query in commit
+               if "SAVEPOINT" not in query]
+    assert queries == ["DELETE", "SELECT", "INSERT"]
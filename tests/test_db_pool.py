@@ -0,0 +1,60 @@
+"""
+Тесты для пула соединений PostgreSQL
+"""
+import pytest
+from psycopg2 import extensions
+
+from utils.db_pool import ConnectionPool, PoolTimeoutError
+
+class FakeConnection:
+    """Соединение без сервера: считает откаты и закрытия"""
+
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self.closed = 0
+        self.rollbacks = 0
+        self.in_transaction = False
+
+    def get_transaction_status(self):
+        return extensions.TRANSACTION_STATUS_INTRANS if self.in_transaction else extensions.TRANSACTION_STATUS_IDLE
+
+    def commit(self):
+        self.in_transaction = False
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.in_transaction = False
+
+    def close(self):
+        self.closed = 1
+
+def test_pool_reuses_and_bounds_connections():
+    """Тест: close() возвращает соединение в пул, размер пула ограничен"""
+    pool = ConnectionPool("postgresql://test", max_size=2, acquire_timeout=0.05, connect=FakeConnection)
+
+    first = pool.acquire()
+    raw = first._conn
+    raw.in_transaction = True
+    first.close()
+    assert raw.rollbacks == 1 and not raw.closed
+
+    with pool.connection() as conn:
+        assert conn._conn is raw
+        with pool.connection():
+            with pytest.raises(PoolTimeoutError):
+                pool.acquire()
+
+    stats = pool.get_stats()
+    assert stats["connects"] == 2 and stats["reuses"] == 1
+    assert stats["size"] == 2 and stats["in_use"] == 0
+
+def test_pool_recycles_idle_connections():
+    """Тест: соединение, простоявшее дольше max_idle, закрывается и заменяется"""
+    pool = ConnectionPool("postgresql://test", max_idle=0, connect=FakeConnection)
+    conn = pool.acquire()
+    raw = conn._conn
+    conn.close()
+
+    replacement = pool.acquire()
+    assert raw.closed and replacement._conn is not raw
+    assert pool.get_stats()["recycled"] == 1
@@ -0,0 +1,45 @@
+"""
+Тесты для блокировок папок
+"""
+import asyncio
+import json
+import threading
+
+from utils.folder_locks import FolderLockManager, write_json_atomic
+
+def test_lock_serializes_read_modify_write(tmp_path):
+    """Тест: параллельные дописывания в общий файл не теряются"""
+    locks = FolderLockManager()
+    folder = str(tmp_path / "group_1")
+    path = tmp_path / "group_1" / "reminders.json"
+
+    def add_reminder(i):
+        with locks.lock(folder):
+            reminders = json.loads(path.read_text(encoding='utf-8')) if path.exists() else []
+            reminders.append({"id": len(reminders) + 1, "title": f"платеж {i}"})
+            write_json_atomic(str(path), reminders)
+
+    threads = [threading.Thread(target=add_reminder, args=(i,)) for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    reminders = json.loads(path.read_text(encoding='utf-8'))
+    assert [item["id"] for item in reminders] == list(range(1, 21))
+    assert not list((tmp_path / "group_1").glob("*.tmp"))
+
+def test_lock_is_reentrant_and_async_run(tmp_path):
+    """Тест вложенного захвата и выполнения записи через run()"""
+    locks = FolderLockManager()
+    folder = str(tmp_path / "user_1")
+
+    def nested():
+        with locks.lock(folder):
+            with locks.lock(folder):
+                return "ok"
+
+    async def main():
+        return await asyncio.gather(*(locks.run(folder, nested) for _ in range(3)))
+
+    assert asyncio.run(main()) == ["ok", "ok", "ok"]
@@ -0,0 +1,32 @@
+"""
+Тесты для индекса участников групп
+"""
+import json
+import os
+from utils.group_index import GroupIndex
+
+def _write_group(root, group_id, members):
+    folder = os.path.join(root, f"group_{group_id}")
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, "members.json"), 'w', encoding='utf-8') as f:
+        json.dump({"members": members}, f)
+
+def test_group_index_lookup_and_updates(tmp_path):
+    """Тест построения индекса и его обновления"""
+    root = str(tmp_path)
+    with open(os.path.join(root, "groups_registry.json"), 'w', encoding='utf-8') as f:
+        json.dump({"groups": [{"id": 1, "name": "Семья", "admin_user_id": 10, "invitation_code": "ABC"}]}, f)
+    _write_group(root, 1, [{"user_id": 10, "role": "admin"}, {"user_id": 11, "role": "member"}])
+
+    index = GroupIndex(root)
+    info = index.get(11)
+    assert info == {"id": 1, "name": "Семья", "admin_user_id": 10, "invitation_code": "ABC", "role": "member"}
+    assert index.get(12) is None
+
+    index.add_group({"id": 2, "name": "Друзья", "admin_user_id": 12, "invitation_code": "XYZ"})
+    index.add_member(2, {"user_id": 12, "role": "admin"})
+    assert index.get(12)["name"] == "Друзья"
+
+    index.remove_member(11)
+    assert index.get(11) is None
+    assert index.get_stats() == {'groups': 2, 'members': 2}
@@ -0,0 +1,40 @@
+"""
+Тесты для словарного поиска категорий
+"""
+from utils.keyword_matcher import KeywordMatcher, TrigramIndex
+
+def test_keyword_matcher_first_category_wins():
+    """Тест порядка категорий и перестроения автомата"""
+    categories = {
+        "Продукты": ["хлеб", "молоко"],
+        "Транспорт": ["такси", "бензин"],
+        "Дом": ["дом", "молоток"],
+    }
+    matcher = KeywordMatcher(categories)
+
+    assert matcher.match("такси и хлеб") == "Продукты"
+    assert matcher.match("новый молоток") == "Дом"
+    assert matcher.match("такси домой") == "Транспорт"
+    assert matcher.match("кино") is None
+
+    categories["Транспорт"].append("кино")
+    assert matcher.match("кино") == "Транспорт"
+
+    categories["Развлечения"] = ["концерт"]
+    assert matcher.match("концерт") == "Развлечения"
+
+def test_trigram_index_matches_typos():
+    """Тест нечеткого поиска по индексу триграмм"""
+    categories = {
+        "Продукты": ["молоко", "хлеб"],
+        "Транспорт": ["бензин", "такси"],
+    }
+    index = TrigramIndex(categories)
+
+    assert index.match("малоко", 0.3) == "Продукты"
+    assert index.match("бинзин", 0.3) == "Транспорт"
+    assert index.match("кино", 0.45) is None
+    assert index.match("", 0.0) is None
+
+    categories["Транспорт"].append("метро")
+    assert index.match("митро", 0.3) == "Транспорт"
@@ -0,0 +1,118 @@
+"""
+Тесты для файлового журнала расходов
+"""
+import csv
+import os
+from datetime import datetime, timezone
+from datetime import date
+from utils.ledger import (
+    append_expense, changes_file, compact_partition, count_expenses, find_expense, iter_expenses,
+    list_partitions, partition_file, remove_expense, update_expense, EXPENSE_FIELDNAMES
+)
+
+def test_append_expense_continues_existing_ids(tmp_path):
+    """Тест дозаписи расхода в существующий CSV"""
+    expenses_file = str(tmp_path / "expenses.csv")
+    with open(expenses_file, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=EXPENSE_FIELDNAMES)
+        writer.writeheader()
+        writer.writerow({'id': '7', 'amount': '100', 'description': 'хлеб',
+                         'category': 'Продукты', 'transaction_date': '2025-01-01T00:00:00+00:00'})
+
+    now = datetime.now(timezone.utc)
+    first = append_expense(expenses_file, 50.0, 'такси', 'Транспорт', now)
+    second = append_expense(expenses_file, 20.0, 'кофе', 'Кафе', now)
+
+    assert first['id'] == '8'
+    assert second['id'] == '9'
+    assert os.path.exists(expenses_file + ".seq")
+
+    rows = list(iter_expenses(expenses_file))
+    assert [row['id'] for row in rows] == ['7', '8', '9']
+    assert rows[-1]['description'] == 'кофе'
+
+    # Старый файл разложен по месяцам, в нем остался только заголовок
+    with open(expenses_file, 'r', encoding='utf-8') as f:
+        assert list(csv.DictReader(f)) == []
+    assert list_partitions(expenses_file)[0] == '2025-01'
+
+def test_append_expense_creates_file(tmp_path):
+    """Тест создания нового CSV с заголовком"""
+    expenses_file = str(tmp_path / "expenses.csv")
+    row = append_expense(expenses_file, 10, 'вода', 'Продукты', datetime.now(timezone.utc))
+
+    assert row['id'] == '1'
+    with open(expenses_file, 'r', encoding='utf-8') as f:
+        assert f.readline().strip() == ','.join(EXPENSE_FIELDNAMES)
+    assert count_expenses(expenses_file) == 1
+
+def test_partitions_limit_reads_and_edits(tmp_path):
+    """Тест чтения за период и правки только своего месяца"""
+    expenses_file = str(tmp_path / "expenses.csv")
+    append_expense(expenses_file, 100, 'хлеб', 'Продукты', '2025-01-15T10:00:00')
+    append_expense(expenses_file, 200, 'такси', 'Транспорт', '2025-02-03T10:00:00')
+    append_expense(expenses_file, 300, 'кино', 'Развлечения', '2025-02-20T10:00:00')
+
+    assert list_partitions(expenses_file, date(2025, 2, 1), date(2025, 2, 10)) == ['2025-02']
+    rows = list(iter_expenses(expenses_file, date(2025, 2, 1), date(2025, 2, 10)))
+    assert [row['id'] for row in rows] == ['2']
+
+    old_row, new_row = update_expense(expenses_file, 3, category='Кафе')
+    assert old_row['category'] == 'Развлечения'
+    assert find_expense(expenses_file, 3)['category'] == 'Кафе'
+
+    assert remove_expense(expenses_file, 1)['description'] == 'хлеб'
+    assert find_expense(expenses_file, 1) is None
+    assert remove_expense(expenses_file, 1) is None
+    assert count_expenses(expenses_file) == 2
+
+def test_changes_are_appended_and_compacted(tmp_path):
+    """Тест: правки и удаления пишутся в журнал изменений и сворачиваются уплотнением"""
+    expenses_file = str(tmp_path / "expenses.csv")
+    for amount in (10, 20, 30):
+        append_expense(expenses_file, amount, 'кофе', 'Кафе', '2025-05-01T09:00:00')
+    may = partition_file(expenses_file, '2025-05')
+    with open(may, 'rb') as f:
+        base = f.read()
+
+    update_expense(expenses_file, 2, amount=25)
+    remove_expense(expenses_file, 3)
+
+    # Файл месяца не переписан, изменения видны при чтении
+    with open(may, 'rb') as f:
+        assert f.read() == base
+    assert [(row['id'], row['amount']) for row in iter_expenses(expenses_file)] == [('1', '10'), ('2', '25')]
+
+    assert compact_partition(expenses_file, '2025-05')
+    assert not os.path.exists(changes_file(may))
+    with open(may, 'r', encoding='utf-8') as f:
+        assert [row['id'] for row in csv.DictReader(f)] == ['1', '2']
+    assert [(row['id'], row['amount']) for row in iter_expenses(expenses_file)] == [('1', '10'), ('2', '25')]
+
+def test_offset_index_finds_rows_without_scanning(tmp_path):
+    """Тест индекса смещений: дозапись, уплотнение и восстановление индекса"""
+    from utils.ledger import _index_get, _index_path
+
+    expenses_file = str(tmp_path / "expenses.csv")
+    append_expense(expenses_file, 10, 'чай, зеленый', 'Продукты', '2025-06-01T08:00:00')
+    append_expense(expenses_file, 20, 'автобус', 'Транспорт', '2025-07-01T08:00:00')
+    append_expense(expenses_file, 30, 'обед', 'Кафе', '2025-06-02T13:00:00')
+
+    assert _index_get(expenses_file, 3)[0] == '2025-06'
+    assert find_expense(expenses_file, 1)['description'] == 'чай, зеленый'
+    assert find_expense(expenses_file, 2)['category'] == 'Транспорт'
+
+    remove_expense(expenses_file, 1)
+    update_expense(expenses_file, 3, amount=35)
+    assert find_expense(expenses_file, 1) is None
+    assert find_expense(expenses_file, 3)['amount'] == '35'
+
+    # После уплотнения смещения пересчитаны, удаленный ID убран из индекса
+    compact_partition(expenses_file, '2025-06')
+    assert _index_get(expenses_file, 1) is None
+    assert find_expense(expenses_file, 3)['amount'] == '35'
+
+    # Потерянный индекс восстанавливается при первом поиске
+    os.remove(_index_path(expenses_file))
+    assert find_expense(expenses_file, 3)['amount'] == '35'
+    assert _index_get(expenses_file, 3) is not None
@@ -0,0 +1,81 @@
+"""
+Тесты для версионных миграций схемы
+"""
+import pytest
+
+from utils.migrations import MigrationRunner
+
+class FakeCursor:
+    """Курсор без сервера: запоминает SQL и хранит таблицу schema_version"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self._rows = []
+
+    def execute(self, sql, params=None):
+        sql = " ".join(sql.split())
+        self.conn.statements.append(sql)
+        if sql.startswith("SELECT version FROM schema_version"):
+            self._rows = [(version,) for version in self.conn.versions]
+        elif sql.startswith("INSERT INTO schema_version"):
+            self.conn.pending_versions.append(params[0])
+        elif sql.startswith("FAIL"):
+            raise RuntimeError("синтаксическая ошибка")
+
+    def fetchall(self):
+        return self._rows
+
+    def close(self):
+        pass
+
+class FakeConnection:
+    def __init__(self, versions=()):
+        self.versions = set(versions)
+        self.pending_versions = []
+        self.statements = []
+
+    def cursor(self, cursor_factory=None):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.versions.update(self.pending_versions)
+        self.pending_versions = []
+
+    def rollback(self):
+        self.pending_versions = []
+
+def test_runner_applies_only_missing_versions_under_lock():
+    """Тест: применяются только отсутствующие версии, по возрастанию, под advisory lock"""
+    runner = MigrationRunner(lock_key=1)
+
+    @runner.register(2, "вторая")
+    def second(cursor):
+        cursor.execute("CREATE TABLE b (id INT)")
+
+    @runner.register(1, "первая")
+    def first(cursor):
+        cursor.execute("CREATE TABLE a (id INT)")
+
+    conn = FakeConnection(versions={1})
+    assert runner.run(conn) == 1
+    assert conn.versions == {1, 2}
+    assert conn.statements[0].startswith("SELECT pg_advisory_lock")
+    assert conn.statements[-1].startswith("SELECT pg_advisory_unlock")
+    assert "CREATE TABLE a (id INT)" not in conn.statements
+
+    assert runner.run(conn) == 0
+
+def test_failed_migration_is_not_recorded():
+    """Тест: упавшая миграция не записывается и останавливает следующие"""
+    runner = MigrationRunner(lock_key=1)
+    runner.register(1, "ошибка")(lambda cursor: cursor.execute("FAIL"))
+    runner.register(2, "после ошибки")(lambda cursor: cursor.execute("CREATE TABLE c (id INT)"))
+
+    conn = FakeConnection()
+    with pytest.raises(RuntimeError):
+        runner.run(conn)
+    assert conn.versions == set()
+    assert conn.statements[-1].startswith("SELECT pg_advisory_unlock")
+
+    with pytest.raises(ValueError):
+        runner.register(1, "дубликат")(lambda cursor: None)
@@ -0,0 +1,60 @@
+"""
+Тесты для офлайн-журнала database.py
+"""
+import inspect
+from datetime import date, time
+
+import database
+from utils.offline_journal import OfflineJournal
+
+def test_journal_keeps_order_and_types_across_restart(tmp_path):
+    """Тест: операции читаются после перезапуска в том же порядке и с теми же типами"""
+    journal = OfflineJournal(str(tmp_path))
+    journal.record("add_reminder", telegram_id=1, title="аренда", reminder_date=date(2025, 3, 1), reminder_time=time(9, 30))
+    journal.record("save_user_setting", telegram_id=1, key="currency", value="RUB")
+    journal.record("delete_reminder", reminder_id=7)
+
+    restarted = OfflineJournal(str(tmp_path))
+    records = restarted.pending()
+    assert [record["op"] for record in records] == ["add_reminder", "save_user_setting", "delete_reminder"]
+    assert records[0]["args"]["reminder_date"] == date(2025, 3, 1)
+    assert records[0]["args"]["reminder_time"] == time(9, 30)
+
+    restarted.discard(2)
+    assert [record["op"] for record in OfflineJournal(str(tmp_path)).pending()] == ["delete_reminder"]
+
+def test_discard_keeps_tail_and_clears_drained_journal(tmp_path):
+    """Тест: применение пачки не переписывает хвост, полностью примененный журнал очищается"""
+    journal = OfflineJournal(str(tmp_path))
+    for reminder_id in range(5):
+        journal.record("delete_reminder", reminder_id=reminder_id)
+    with open(journal.path, 'rb') as f:
+        content = f.read()
+
+    journal.discard(2)
+    with open(journal.path, 'rb') as f:
+        assert f.read() == content
+    assert [record["args"]["reminder_id"] for record in OfflineJournal(str(tmp_path)).pending()] == [2, 3, 4]
+
+    journal.discard(3)
+    assert not journal.has_pending()
+    assert not (tmp_path / "journal.jsonl").exists()
+    # Номера операций продолжаются после перезапуска
+    restarted = OfflineJournal(str(tmp_path))
+    restarted.record("delete_reminder", reminder_id=9)
+    assert restarted.pending()[0]["seq"] == 6
+
+def test_writes_are_journaled_when_database_is_unavailable(tmp_path, monkeypatch):
+    """Тест: без настроек БД запись не теряется, а попадает в журнал"""
+    for name in ("DATABASE_HOST", "DATABASE_NAME", "DATABASE_USER", "DATABASE_PASSWORD"):
+        monkeypatch.delenv(name, raising=False)
+    journal = OfflineJournal(str(tmp_path))
+    monkeypatch.setattr(database, "offline_journal", journal)
+
+    assert database.add_expense(42, 3, 150.0, "обед", date(2025, 3, 2)) is True
+    assert database.save_user_setting(42, "currency", "RUB") is True
+
+    records = journal.pending()
+    assert [record["op"] for record in records] == ["add_expense", "save_user_setting"]
+    assert records[0]["args"]["expense_date"] == date(2025, 3, 2)
+    assert set(records[0]["args"]) <= set(inspect.signature(database.add_expense).parameters)
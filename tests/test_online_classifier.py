@@ -0,0 +1,38 @@
+"""
+Тесты для онлайн-классификатора
+"""
+from utils.online_classifier import OnlineClassifier
+
+def test_online_classifier_learns_correction():
+    """Тест дообучения на исправлении без полного переобучения"""
+    texts = ["хлеб", "молоко", "сыр", "бензин", "такси", "автобус"]
+    labels = ["Продукты", "Продукты", "Продукты", "Транспорт", "Транспорт", "Транспорт"]
+
+    model = OnlineClassifier()
+    model.fit(texts, labels, classes=["Продукты", "Транспорт", "Прочее"])
+    assert model.is_fitted
+    assert model.predict("молоко") == "Продукты"
+
+    assert model.learn("самокат кикшеринг", "Транспорт")
+    assert model.updates == 1
+    assert model.predict("самокат кикшеринг") == "Транспорт"
+
+    # Неизвестная категория требует полного переобучения
+    assert not model.learn("пицца", "Кафе")
+
+def test_correction_does_not_change_unrelated_predictions():
+    """Тест: после одного исправления ответ онлайн-модели берется только для похожих текстов"""
+    texts = ["хлеб", "молоко", "сыр", "бензин", "такси", "автобус"]
+    labels = ["Продукты", "Продукты", "Продукты", "Транспорт", "Транспорт", "Транспорт"]
+    model = OnlineClassifier()
+    model.fit(texts, labels, classes=["Продукты", "Транспорт", "Прочее"])
+
+    before = model.predict("метро")
+    assert model.learn("самокат кикшеринг", "Продукты")
+    # Сама онлайн-модель на незнакомом тексте сместилась к исправленной категории...
+    assert model.predict("метро") != before
+    # ...но неуверенный ответ вдали от исправлений не заменяет основную модель
+    assert model.trusted_prediction("метро") is None
+
+    assert model.trusted_prediction("самокат кикшеринг") == "Продукты"
+    assert model.trusted_prediction("самокат") == "Продукты"
@@ -0,0 +1,32 @@
+"""
+Тесты для кэша отчетов
+"""
+from utils.ledger import append_expense, bump_ledger_version, ledger_version
+from utils.report_cache import ReportArtifact, ReportCache
+
+def test_report_cache_follows_ledger_version(tmp_path):
+    """Тест: отчет отдается из кэша, пока журнал не изменился"""
+    expenses_file = str(tmp_path / "expenses.csv")
+    append_expense(expenses_file, 100, "хлеб", "Продукты", "2025-01-01")
+
+    cache = ReportCache()
+    report = ReportArtifact(b"png", b"xlsx", "сводка")
+    version = ledger_version(expenses_file)
+    cache.put("user_data/user_1", "месяц", version, report)
+    assert cache.get("user_data/user_1", "месяц", ledger_version(expenses_file)) == report
+
+    bump_ledger_version(expenses_file)
+    assert cache.get("user_data/user_1", "месяц", ledger_version(expenses_file)) is None
+
+    append_expense(expenses_file, 50, "такси", "Транспорт", "2025-01-02")
+    assert ledger_version(expenses_file) != version
+    assert cache.get_stats()["hits"] == 1
+
+def test_report_cache_evicts_oldest():
+    """Тест вытеснения самых старых отчетов"""
+    cache = ReportCache(max_entries=2)
+    report = ReportArtifact(b"", b"", "")
+    for folder in ("a", "b", "c"):
+        cache.put(folder, "год", 1, report)
+    assert cache.get("a", "год", 1) is None
+    assert cache.get("c", "год", 1) == report
@@ -0,0 +1,75 @@
+"""
+Тесты для построения отчетов в пуле процессов
+"""
+import asyncio
+from datetime import datetime, timezone
+
+from utils.report_renderer import ReportRenderer, summarize
+
+DATA = [
+    ("хлеб", "Продукты", 300.0, datetime(2025, 3, 1, 10, 0, tzinfo=timezone.utc)),
+    ("такси", "Транспорт", 1500.0, datetime(2025, 3, 2, 12, 0, tzinfo=timezone.utc)),
+    ("молоко", "Продукты", 450.0, datetime(2025, 3, 9, 9, 30, tzinfo=timezone.utc)),
+]
+
+def test_summarize_ranks_categories():
+    """Тест текстовой статистики отчета"""
+    summary = summarize(DATA)
+    assert summary["total"] == 2250.0
+    assert summary["transactions"] == 3
+    assert summary["categories"] == ["Транспорт", "Продукты"]
+    assert summary["amounts"] == [1500.0, 750.0]
+
+def test_render_returns_png_and_xlsx():
+    """Тест построения графика и Excel вне event loop"""
+    renderer = ReportRenderer(max_workers=2, max_pending=1)
+
+    async def run():
+        return await asyncio.gather(
+            renderer.render(DATA, "месяц"),
+            renderer.render(DATA, "год")
+        )
+
+    try:
+        results = asyncio.run(run())
+    finally:
+        renderer.shutdown()
+
+    for chart, excel in results:
+        assert chart.startswith(b"\x89PNG")
+        assert excel.startswith(b"PK")
+    assert renderer.waiting == 0
+
+def test_aggregate_rows_matches_columnar_store(tmp_path):
+    """Тест: агрегаты по строкам и по колоночному хранилищу совпадают"""
+    from utils.columnar import ColumnarStore
+    from utils.ledger import append_expense
+    from utils.report_renderer import aggregate_rows
+
+    expenses_file = str(tmp_path / "expenses.csv")
+    for description, category, amount, transaction_date in DATA:
+        append_expense(expenses_file, amount, description, category, transaction_date)
+
+    columnar = ColumnarStore().aggregate(expenses_file)
+    assert columnar == aggregate_rows(DATA)
+    assert columnar["weeks"] == [(9, 1800.0), (10, 450.0)]
+    assert columnar["months"] == [("Mar", 2250.0)]
+
+def test_render_reads_excel_rows_from_ledger(tmp_path):
+    """Тест: при отчете по журналу строки для Excel читаются в процессе пула"""
+    from utils.columnar import ColumnarStore
+    from utils.ledger import append_expense
+
+    expenses_file = str(tmp_path / "expenses.csv")
+    for description, category, amount, transaction_date in DATA:
+        append_expense(expenses_file, amount, description, category, transaction_date)
+    aggregates = ColumnarStore().aggregate(expenses_file)
+    renderer = ReportRenderer(max_workers=1)
+
+    try:
+        chart, excel = asyncio.run(renderer.render(None, "месяц", aggregates, ledger=(expenses_file, None, None)))
+    finally:
+        renderer.shutdown()
+
+    assert chart.startswith(b"\x89PNG")
+    assert excel.startswith(b"PK")
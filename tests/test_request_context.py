@@ -0,0 +1,105 @@
+"""
+Тесты для контекста обработки апдейта
+"""
+import asyncio
+import contextvars
+
+from utils.request_context import begin_request, get_request_context, invalidate_request_context, request_scoped
+
+def make_resolvers(groups, authorized):
+    """Функции разрешения пользователя со счетчиком обращений к хранилищу"""
+    lookups = []
+
+    @request_scoped
+    def get_user_group(user_id):
+        lookups.append(("group", user_id))
+        return groups.get(user_id)
+
+    @request_scoped
+    def get_user_folder_path(user_id):
+        lookups.append(("folder", user_id))
+        group = get_user_group(user_id)
+        return f"group_data/group_{group}" if group else f"user_data/{user_id}"
+
+    @request_scoped
+    def is_user_authorized(user_id):
+        lookups.append(("auth", user_id))
+        return user_id in authorized
+
+    return get_user_group, get_user_folder_path, is_user_authorized, lookups
+
+def test_values_are_resolved_once_per_update():
+    """Тест: в одном апдейте группа, папка и авторизация вычисляются один раз"""
+    get_user_group, get_user_folder_path, is_user_authorized, lookups = make_resolvers({1: 7}, {1})
+
+    def handle_update():
+        begin_request(1, update_id=100)
+        for _ in range(3):
+            assert get_user_folder_path(1) == "group_data/group_7"
+            assert get_user_group(1) == 7
+            assert is_user_authorized(1) is True
+        # Другой пользователь в том же апдейте не берется из контекста
+        assert get_user_group(2) is None
+        assert get_user_group(2) is None
+
+    contextvars.copy_context().run(handle_update)
+    assert sorted(lookups) == [("auth", 1), ("folder", 1), ("group", 1), ("group", 2), ("group", 2)]
+
+    # Вне апдейта значения не запоминаются
+    assert get_request_context() is None
+    get_user_group(1)
+    get_user_group(1)
+    assert lookups.count(("group", 1)) == 3
+
+def test_values_do_not_leak_between_updates():
+    """Тест: параллельные апдейты одного пользователя не видят значений друг друга"""
+    groups = {1: 7}
+    get_user_group, _, _, lookups = make_resolvers(groups, set())
+
+    async def handle_update(update_id, started, group_changed):
+        begin_request(1, update_id=update_id)
+        if update_id == 1:
+            assert get_user_group(1) == 7
+            started.set()
+            await group_changed.wait()
+            # Свой контекст: значение первого апдейта не поменялось
+            assert get_user_group(1) == 7
+        else:
+            await started.wait()
+            groups[1] = 8
+            group_changed.set()
+            # Значение первого апдейта в этот контекст не попало
+            assert get_user_group(1) == 8
+        return get_request_context().update_id
+
+    async def main():
+        started, group_changed = asyncio.Event(), asyncio.Event()
+        return await asyncio.gather(handle_update(1, started, group_changed),
+                                    handle_update(2, started, group_changed))
+
+    assert asyncio.run(main()) == [1, 2]
+    assert lookups == [("group", 1), ("group", 1)]
+
+def test_invalidate_forces_fresh_lookup_after_write():
+    """Тест: после записи группы или авторизации значения читаются заново"""
+    groups, authorized = {}, set()
+    get_user_group, get_user_folder_path, is_user_authorized, lookups = make_resolvers(groups, authorized)
+
+    def handle_update():
+        begin_request(5)
+        assert get_user_folder_path(5) == "user_data/5"
+        assert is_user_authorized(5) is False
+
+        # Пользователь вступил в группу и получил доступ в этом же апдейте
+        groups[5] = 3
+        authorized.add(5)
+        assert get_user_folder_path(5) == "user_data/5"
+        invalidate_request_context()
+
+        assert get_user_folder_path(5) == "group_data/group_3"
+        assert is_user_authorized(5) is True
+
+    contextvars.copy_context().run(handle_update)
+    assert lookups.count(("folder", 5)) == 2
+    assert lookups.count(("group", 5)) == 2
+    assert lookups.count(("auth", 5)) == 2
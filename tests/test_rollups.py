@@ -0,0 +1,71 @@
+"""
+Тесты для агрегатов расходов по категориям
+"""
+from datetime import date
+
+from utils.ledger import append_expense, update_expense
+from utils.rollups import ExpenseRollups, cover_range
+
+def test_cover_range_uses_largest_buckets():
+    """Тест покрытия периода месяцами, неделями и днями"""
+    keys = cover_range(date(2025, 2, 28), date(2025, 4, 14))
+    # 28.02 — день, март — месяц, 01-06.04 — дни, 07-13.04 — неделя, 14.04 — день
+    assert keys[0] == ("day", "2025-02-28")
+    assert keys[1] == ("month", "2025-03")
+    assert keys[-2] == ("week", "2025-W15")
+    assert keys[-1] == ("day", "2025-04-14")
+    assert len(keys) == 10
+
+def test_rollups_follow_ledger_changes(tmp_path):
+    """Тест обновления агрегатов при добавлении, правке и удалении"""
+    expenses_file = str(tmp_path / "expenses.csv")
+    rollups = ExpenseRollups()
+
+    first = append_expense(expenses_file, 100, "хлеб", "Продукты", "2025-03-01T10:00:00+00:00")
+    rollups.record_change(expenses_file, None, first)
+    second = append_expense(expenses_file, 500, "такси", "Транспорт", "2025-03-15T10:00:00")
+    rollups.record_change(expenses_file, None, second)
+
+    assert rollups.category_totals(expenses_file, date(2025, 3, 1), date(2025, 3, 31)) == [
+        ("Транспорт", 500.0, 1), ("Продукты", 100.0, 1)
+    ]
+    assert rollups.period_summary(expenses_file, date(2025, 3, 2), date(2025, 3, 31))["total"] == 500.0
+
+    # Правка категории
+    rollups.record_change(expenses_file, *update_expense(expenses_file, 2, category='Авто'))
+
+    totals = rollups.category_totals(expenses_file, date(2025, 3, 1), date(2025, 3, 31))
+    assert totals == [("Авто", 500.0, 1), ("Продукты", 100.0, 1)]
+
+    # Новый экземпляр читает сохраненные агрегаты и получает тот же результат
+    assert ExpenseRollups().category_totals(expenses_file, date(2025, 3, 1), date(2025, 3, 31)) == totals
+
+def test_change_counted_once_after_concurrent_rebuild(tmp_path):
+    """Тест: запрос между записью и record_change не приводит к двойному учету"""
+    expenses_file = str(tmp_path / "expenses.csv")
+    rollups = ExpenseRollups()
+    rollups.record_change(expenses_file, None, append_expense(expenses_file, 100, "хлеб", "Продукты", "2025-03-01"))
+
+    row = append_expense(expenses_file, 50, "молоко", "Продукты", "2025-03-02")
+    # Запрос видит новую отметку журнала и пересчитывает агрегаты с новой строкой
+    assert rollups.category_totals(expenses_file, date(2025, 3, 1), date(2025, 3, 31)) == [("Продукты", 150.0, 2)]
+    rollups.record_change(expenses_file, None, row)
+
+    assert rollups.category_totals(expenses_file, date(2025, 3, 1), date(2025, 3, 31)) == [("Продукты", 150.0, 2)]
+
+def test_interleaved_changes_are_not_lost(tmp_path):
+    """Тест: две записи в журнал до их record_change учитываются обе"""
+    expenses_file = str(tmp_path / "expenses.csv")
+    rollups = ExpenseRollups()
+    rollups.record_change(expenses_file, None, append_expense(expenses_file, 10, "обед", "Еда", "2025-03-01"))
+
+    added = append_expense(expenses_file, 5, "кофе", "Еда", "2025-03-02")
+    edited = update_expense(expenses_file, 1, category="Авто")
+    rollups.record_change(expenses_file, None, added)
+    rollups.record_change(expenses_file, *edited)
+    # Повторный вызов с тем же изменением ничего не меняет
+    rollups.record_change(expenses_file, *edited)
+
+    assert rollups.category_totals(expenses_file, date(2025, 3, 1), date(2025, 3, 31)) == [
+        ("Авто", 10.0, 1), ("Еда", 5.0, 1)
+    ]
@@ -0,0 +1,83 @@
+"""
+Тесты для журнала отложенной синхронизации с PostgreSQL
+"""
+import asyncio
+from datetime import date
+
+import pytest
+
+from utils.sync_spool import SyncSpool, coalesce
+
+def test_coalesce_keeps_last_change_per_entity():
+    """Тест: повторные удаления и планы одного месяца схлопываются"""
+    records = [
+        {"seq": 1, "user_id": 1, "data_type": "expense", "action": "add", "data": {"amount": 10}},
+        {"seq": 2, "user_id": 1, "data_type": "budget_plan", "action": "add", "data": {"plan_month": "2025-03-01", "total_amount": 100}},
+        {"seq": 3, "user_id": 1, "data_type": "expense", "action": "delete", "data": {"expense_id": 5}},
+        {"seq": 4, "user_id": 1, "data_type": "budget_plan", "action": "add", "data": {"plan_month": "2025-03-01", "total_amount": 200}},
+        {"seq": 5, "user_id": 1, "data_type": "expense", "action": "delete", "data": {"expense_id": 5}},
+        {"seq": 6, "user_id": 1, "data_type": "expense", "action": "add", "data": {"amount": 10}},
+    ]
+    assert [record["seq"] for record in coalesce(records)] == [1, 4, 5, 6]
+
+def test_spool_survives_failure_and_restart(tmp_path):
+    """Тест: при ошибке БД записи остаются в журнале и читаются после перезапуска"""
+    spool = SyncSpool(str(tmp_path))
+    spool.enqueue(1, "reminder", "add", {"title": "аренда", "start_date": date(2025, 3, 1)})
+    spool.enqueue_many([(1, "expense", "delete", {"expense_id": 7}), (2, "expense", "delete", {"expense_id": 7})])
+
+    def database_down(records):
+        raise ConnectionError("нет соединения")
+
+    spool._apply = database_down
+    with pytest.raises(ConnectionError):
+        spool.drain_once()
+
+    applied = []
+    restarted = SyncSpool(str(tmp_path))
+    restarted._apply = applied.extend
+    assert restarted.drain_once() == 3
+    assert applied[0]["data"]["start_date"] == "2025-03-01"
+    assert restarted.get_stats()["pending"] == 0
+    assert SyncSpool(str(tmp_path)).get_stats()["pending"] == 0
+
+def test_worker_drains_in_background(tmp_path):
+    """Тест: фоновая задача применяет изменения после enqueue"""
+    spool = SyncSpool(str(tmp_path))
+    applied = []
+
+    async def main():
+        spool.start(applied.extend)
+        spool.enqueue(1, "expense", "add", {"amount": 50})
+        for _ in range(50):
+            if applied:
+                break
+            await asyncio.sleep(0.01)
+        await spool.stop()
+
+    asyncio.run(main())
+    assert [record["data"]["amount"] for record in applied] == [50]
+
+def test_drain_deletes_applied_segments_without_rewriting(tmp_path):
+    """Тест: разбор журнала удаляет примененные сегменты и не переписывает хвост"""
+    spool = SyncSpool(str(tmp_path), batch_size=2, segment_records=3)
+    for amount in range(7):
+        spool.enqueue(1, "expense", "add", {"amount": amount})
+    segments = sorted(path.name for path in tmp_path.glob("pending-*.jsonl"))
+    assert len(segments) == 3
+    tail = (tmp_path / segments[-1]).read_bytes()
+
+    applied = []
+    spool._apply = applied.extend
+    assert spool.drain_once() == 2
+    assert spool.drain_once() == 2
+    assert sorted(path.name for path in tmp_path.glob("pending-*.jsonl")) == segments[1:]
+    assert (tmp_path / segments[-1]).read_bytes() == tail
+
+    restarted = SyncSpool(str(tmp_path), batch_size=10, segment_records=3)
+    restarted._apply = applied.extend
+    assert restarted.drain_once() == 3
+    assert [record["data"]["amount"] for record in applied] == list(range(7))
+    restarted.enqueue(1, "expense", "add", {"amount": 7})
+    assert restarted.get_stats()["pending"] == 1
+    assert SyncSpool(str(tmp_path)).get_stats()["pending"] == 1
@@ -0,0 +1,93 @@
+"""
+Тесты для инкрементального загрузчика обучающих данных
+"""
+from utils.ledger import append_expense, compact_partition, partition_file, remove_expense, update_expense
+from utils.training_loader import TrainingDataLoader
+
+def test_training_loader_reads_incrementally(tmp_path):
+    """Тест дочитывания новых строк, правки и перезаписи файла"""
+    folder = tmp_path / "user_data" / "user_1"
+    folder.mkdir(parents=True)
+    expenses_file = str(folder / "expenses.csv")
+    append_expense(expenses_file, 100, "хлеб", "Продукты", "2025-01-01")
+    append_expense(expenses_file, 200, "хлеб", "Продукты", "2025-01-02")
+
+    loader = TrainingDataLoader(roots=[str(tmp_path / "user_data")],
+                                state_path=str(tmp_path / "state.json"))
+    assert loader.refresh() == 2
+    assert sorted(loader.iter_pairs()) == [("хлеб", "Продукты", 2)]
+
+    # Повторная загрузка без изменений ничего не читает
+    assert loader.refresh() == 0
+
+    append_expense(expenses_file, 50, "такси", "Транспорт", "2025-01-03")
+    assert loader.refresh() == 1
+
+    # Состояние переживает перезапуск
+    restored = TrainingDataLoader(roots=[str(tmp_path / "user_data")],
+                                  state_path=str(tmp_path / "state.json"))
+    assert restored.total_count() == 3
+
+    january = partition_file(expenses_file, "2025-01")
+    restored.apply_change(january, 1, ("хлеб", "Продукты"), ("хлеб", "Кафе"))
+    assert sorted(restored.iter_pairs()) == [("такси", "Транспорт", 1), ("хлеб", "Кафе", 1), ("хлеб", "Продукты", 1)]
+
+    # Удаление уже прочитанной строки учитывается через apply_change,
+    # а после уплотнения месяц перечитывается с тем же результатом
+    removed = remove_expense(expenses_file, 2)
+    restored.apply_change(january, 2, (removed["description"], removed["category"]), None)
+    expected = [("такси", "Транспорт", 1), ("хлеб", "Кафе", 1)]
+    restored.refresh()
+    assert sorted(restored.iter_pairs()) == expected
+
+    update_expense(expenses_file, 1, category="Кафе")
+    compact_partition(expenses_file, "2025-01")
+    restored.refresh()
+    assert sorted(restored.iter_pairs()) == expected
+
+    # Правка строки, еще не прочитанной загрузчиком, применяется при чтении
+    append_expense(expenses_file, 70, "метро", "Продукты", "2025-01-05")
+    update_expense(expenses_file, 4, category="Транспорт")
+    restored.refresh()
+    assert ("метро", "Транспорт", 1) in list(restored.iter_pairs())
+
+def test_apply_change_is_saved_on_flush(tmp_path):
+    """Тест: правка не пересохраняет состояние сразу, flush сохраняет его"""
+    folder = tmp_path / "user_data" / "user_1"
+    folder.mkdir(parents=True)
+    expenses_file = str(folder / "expenses.csv")
+    append_expense(expenses_file, 100, "хлеб", "Продукты", "2025-01-01")
+    state_path = tmp_path / "state.json"
+
+    loader = TrainingDataLoader(roots=[str(tmp_path / "user_data")], state_path=str(state_path))
+    loader.refresh()
+    saved = state_path.read_text(encoding="utf-8")
+
+    loader.apply_change(partition_file(expenses_file, "2025-01"), 1, ("хлеб", "Продукты"), ("хлеб", "Кафе"))
+    assert state_path.read_text(encoding="utf-8") == saved
+
+    loader.flush()
+    restored = TrainingDataLoader(roots=[str(tmp_path / "user_data")], state_path=str(state_path))
+    assert list(restored.iter_pairs()) == [("хлеб", "Кафе", 1)]
+
+def test_apply_change_survives_crash_before_flush(tmp_path):
+    """Тест: правка без flush восстанавливается после перезапуска и не учитывается дважды"""
+    folder = tmp_path / "user_data" / "user_1"
+    folder.mkdir(parents=True)
+    expenses_file = str(folder / "expenses.csv")
+    append_expense(expenses_file, 100, "хлеб", "Продукты", "2025-01-01")
+    append_expense(expenses_file, 200, "хлеб", "Продукты", "2025-01-02")
+    state_path = str(tmp_path / "state.json")
+
+    loader = TrainingDataLoader(roots=[str(tmp_path / "user_data")], state_path=state_path)
+    loader.refresh()
+    january = partition_file(expenses_file, "2025-01")
+    loader.apply_change(january, 1, ("хлеб", "Продукты"), ("хлеб", "Кафе"))
+    expected = [("хлеб", "Кафе", 1), ("хлеб", "Продукты", 1)]
+
+    # Процесс упал до flush
+    crashed = TrainingDataLoader(roots=[str(tmp_path / "user_data")], state_path=state_path)
+    assert sorted(crashed.iter_pairs()) == expected
+
+    crashed.flush()
+    assert sorted(TrainingDataLoader(roots=[str(tmp_path / "user_data")], state_path=state_path).iter_pairs()) == expected
@@ -0,0 +1,30 @@
+"""
+Тесты для групповой записи расходов
+"""
+import asyncio
+
+from utils.ledger import iter_expenses
+from utils.write_coalescer import WriteCoalescer
+
+def test_concurrent_expenses_written_as_one_batch(tmp_path):
+    """Тест: расходы одного окна записываются одной пачкой и синхронизируются до ответа"""
+    folder = str(tmp_path / "group_1")
+    (tmp_path / "group_1").mkdir()
+    coalescer = WriteCoalescer(window_ms=20)
+    synced = []
+    coalescer.set_batch_sync(synced.append)
+
+    async def main():
+        rows = await asyncio.gather(*(
+            coalescer.append(folder, 100 + i, 10 * (i + 1), f"покупка {i}", "Продукты", f"2025-03-0{i + 1}")
+            for i in range(5)
+        ))
+        # Вызывающие получают ответ только после синхронизации пачки
+        assert len(synced) == 1
+        return rows
+
+    rows = asyncio.run(main())
+    assert [row['id'] for row in rows] == ['1', '2', '3', '4', '5']
+    assert [row['description'] for row in iter_expenses(f"{folder}/expenses.csv")] == [f"покупка {i}" for i in range(5)]
+    assert len(synced) == 1 and [user_id for user_id, _ in synced[0]] == [100, 101, 102, 103, 104]
+    assert coalescer.get_stats()["batches"] == 1
@@ -0,0 +1,116 @@
+"""
+Реестр авторизованных пользователей (authorized_users.json) с индексами в памяти
+"""
+import copy
+import json
+import os
+import threading
+import logging
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class AuthRegistry:
+    """
+    Загружает authorized_users.json один раз и держит индексы
+    по telegram_id и username. Запись атомарная (временный файл
+    и переименование), индексы перестраиваются сразу после записи.
+    """
+
+    def __init__(self, users_file: str, default_admin: Optional[int] = None):
+        self.users_file = users_file
+        self.default_admin = default_admin
+        self._lock = threading.RLock()
+        self._data: Optional[Dict[str, Any]] = None
+        self._by_telegram_id: Dict[Any, Dict[str, Any]] = {}
+        self._by_username: Dict[str, Dict[str, Any]] = {}
+
+    def _empty(self) -> Dict[str, Any]:
+        return {"users": [], "admin": self.default_admin}
+
+    def _index(self, data: Dict[str, Any]):
+        by_telegram_id = {}
+        by_username = {}
+        for user in data.get("users", []):
+            telegram_id = user.get("telegram_id")
+            if telegram_id is not None and telegram_id not in by_telegram_id:
+                by_telegram_id[telegram_id] = user
+            username = user.get("username")
+            if username is not None and username not in by_username:
+                by_username[username] = user
+        self._data = data
+        self._by_telegram_id = by_telegram_id
+        self._by_username = by_username
+
+    def _ensure_loaded(self):
+        if self._data is not None:
+            return
+        with self._lock:
+            if self._data is None:
+                self.reload()
+
+    def reload(self):
+        """Перечитывает файл и перестраивает индексы"""
+        with self._lock:
+            try:
+                if os.path.exists(self.users_file):
+                    with open(self.users_file, 'r', encoding='utf-8') as f:
+                        data = json.load(f)
+                else:
+                    data = self._empty()
+            except Exception as e:
+                logger.error(f"Ошибка при загрузке пользователей: {e}")
+                data = self._empty()
+            data.setdefault("users", [])
+            self._index(data)
+
+    def load(self) -> Dict[str, Any]:
+        """Возвращает копию данных, которую можно менять и передать в save()"""
+        self._ensure_loaded()
+        with self._lock:
+            return copy.deepcopy(self._data)
+
+    def save(self, data: Dict[str, Any]):
+        """Атомарно сохраняет данные в файл и обновляет индексы"""
+        snapshot = copy.deepcopy(data)
+        snapshot.setdefault("users", [])
+        with self._lock:
+            tmp_path = f"{self.users_file}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(snapshot, f, ensure_ascii=False, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.users_file)
+            self._index(snapshot)
+
+    def get_admin(self) -> Any:
+        """Возвращает telegram_id главного администратора"""
+        self._ensure_loaded()
+        return self._data.get("admin")
+
+    def get_by_telegram_id(self, telegram_id) -> Optional[Dict[str, Any]]:
+        """Возвращает запись пользователя по telegram_id"""
+        self._ensure_loaded()
+        user = self._by_telegram_id.get(telegram_id)
+        return dict(user) if user is not None else None
+
+    def get_by_username(self, username: str) -> Optional[Dict[str, Any]]:
+        """Возвращает запись пользователя по имени"""
+        self._ensure_loaded()
+        user = self._by_username.get(username)
+        return dict(user) if user is not None else None
+
+    def is_listed(self, telegram_id) -> bool:
+        """Проверяет, есть ли telegram_id среди админа и авторизованных пользователей"""
+        self._ensure_loaded()
+        return telegram_id == self._data.get("admin") or telegram_id in self._by_telegram_id
+
+    def get_stats(self) -> Dict[str, int]:
+        """Возвращает размер индексов"""
+        self._ensure_loaded()
+        return {
+            'users': len(self._data.get("users", [])),
+            'by_telegram_id': len(self._by_telegram_id),
+            'by_username': len(self._by_username)
+        }
@@ -0,0 +1,202 @@
+"""
+Колоночное представление журнала расходов для аналитики
+
+Для каждого месяца журнала рядом с CSV хранятся массивы NumPy:
+суммы (float64), даты в днях от 1970-01-01 (int32) и коды категорий
+(int16, словарь категорий общий для журнала). Массивы открываются через
+memory mapping и пересобираются только при изменении файла месяца или его
+журнала изменений, поэтому агрегаты за период считаются векторно, без
+разбора строк CSV. CSV остается источником данных и форматом экспорта.
+"""
+import calendar
+import json
+import os
+import threading
+import logging
+from datetime import date
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from utils.ledger import (
+    changes_file, list_partitions, parse_transaction_date, partition_file, partitions_dir, read_partition
+)
+
+logger = logging.getLogger(__name__)
+
+COLUMNS_DIR = "columns"
+CATEGORIES_NAME = "categories.json"
+COLUMNS_VERSION = 1
+
+EPOCH = date(1970, 1, 1)
+
+# Колонки месяца и их типы
+COLUMN_TYPES = {
+    "amount": np.float64,
+    "day": np.int32,
+    "category": np.int16
+}
+
+
+def day_number(day: date) -> int:
+    """Номер дня от 1970-01-01"""
+    return (day - EPOCH).days
+
+
+def iso_weeks(days: np.ndarray) -> np.ndarray:
+    """Номера ISO-недель для массива номеров дней"""
+    # 1970-01-01 — четверг; 0 = понедельник
+    weekday = (days + 3) % 7
+    thursday = (days - weekday + 3).astype('datetime64[D]')
+    year_start = thursday.astype('datetime64[Y]').astype('datetime64[D]')
+    return (thursday - year_start).astype(np.int64) // 7 + 1
+
+
+class ColumnarStore:
+    """Колоночные массивы журналов с пересборкой по отметке файла месяца"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+
+    # --- Пути и словарь категорий ---
+
+    def _columns_dir(self, expenses_file: str, key: Optional[str] = None) -> str:
+        base = os.path.join(partitions_dir(expenses_file), COLUMNS_DIR)
+        return os.path.join(base, key) if key else base
+
+    def _load_categories(self, expenses_file: str) -> List[str]:
+        path = os.path.join(self._columns_dir(expenses_file), CATEGORIES_NAME)
+        if not os.path.exists(path):
+            return []
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _save_categories(self, expenses_file: str, categories: List[str]):
+        directory = self._columns_dir(expenses_file)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, CATEGORIES_NAME)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(categories, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    # --- Сборка и чтение месяца ---
+
+    def _source_stamp(self, expenses_file: str, key: str) -> List[int]:
+        """Отметка файла месяца и его журнала изменений"""
+        path = partition_file(expenses_file, key)
+        stamp = [COLUMNS_VERSION]
+        for source in (path, changes_file(path)):
+            try:
+                stat = os.stat(source)
+                stamp += [stat.st_mtime_ns, stat.st_size]
+            except OSError:
+                stamp += [0, 0]
+        return stamp
+
+    def _build(self, expenses_file: str, key: str, categories: List[str], stamp: List[int]):
+        """Разбирает CSV месяца один раз и сохраняет колонки"""
+        codes = {name: code for code, name in enumerate(categories)}
+        amounts, days, category_codes = [], [], []
+        for row in read_partition(expenses_file, key):
+            day = parse_transaction_date(row.get('transaction_date'))
+            try:
+                amount = float(row.get('amount'))
+            except (TypeError, ValueError):
+                continue
+            if day is None:
+                continue
+            category = row.get('category') or ''
+            if category not in codes:
+                codes[category] = len(categories)
+                categories.append(category)
+            amounts.append(amount)
+            days.append(day_number(day))
+            category_codes.append(codes[category])
+
+        if len(categories) > np.iinfo(np.int16).max:
+            raise ValueError(f"Слишком много категорий для int16: {len(categories)}")
+        self._save_categories(expenses_file, categories)
+
+        directory = self._columns_dir(expenses_file, key)
+        os.makedirs(directory, exist_ok=True)
+        values = {"amount": amounts, "day": days, "category": category_codes}
+        for name, dtype in COLUMN_TYPES.items():
+            path = os.path.join(directory, f"{name}.npy")
+            tmp_path = os.path.join(directory, f"{name}.tmp.npy")
+            np.save(tmp_path, np.asarray(values[name], dtype=dtype))
+            os.replace(tmp_path, path)
+        with open(os.path.join(directory, "stamp.json"), 'w', encoding='utf-8') as f:
+            json.dump(stamp, f)
+
+    def _open_partition(self, expenses_file: str, key: str, categories: List[str]) -> Dict[str, np.ndarray]:
+        directory = self._columns_dir(expenses_file, key)
+        stamp = self._source_stamp(expenses_file, key)
+        stamp_path = os.path.join(directory, "stamp.json")
+        current = None
+        if os.path.exists(stamp_path):
+            with open(stamp_path, 'r', encoding='utf-8') as f:
+                current = json.load(f)
+        if current != stamp:
+            self._build(expenses_file, key, categories, stamp)
+        part = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode='r') for name in COLUMN_TYPES}
+        if len(part["category"]) and int(part["category"].max()) >= len(categories):
+            # Словарь категорий потерян или отстал — пересобираем месяц
+            self._build(expenses_file, key, categories, stamp)
+            part = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode='r') for name in COLUMN_TYPES}
+        return part
+
+    def load(self, expenses_file: str, start: Optional[date] = None,
+             end: Optional[date] = None) -> Tuple[Dict[str, np.ndarray], List[str]]:
+        """
+        Колонки журнала за период
+
+        Returns:
+            ({"amount", "day", "category"} -> массивы, словарь категорий по кодам)
+        """
+        with self._lock:
+            categories = self._load_categories(expenses_file)
+            parts = [self._open_partition(expenses_file, key, categories)
+                     for key in list_partitions(expenses_file, start, end)]
+        if not parts:
+            return {name: np.empty(0, dtype=dtype) for name, dtype in COLUMN_TYPES.items()}, categories
+
+        columns = {name: np.concatenate([part[name] for part in parts]) for name in COLUMN_TYPES}
+        mask = np.ones(len(columns["day"]), dtype=bool)
+        if start is not None:
+            mask &= columns["day"] >= day_number(start)
+        if end is not None:
+            mask &= columns["day"] <= day_number(end)
+        return {name: column[mask] for name, column in columns.items()}, categories
+
+    # --- Агрегаты ---
+
+    def aggregate(self, expenses_file: str, start: Optional[date] = None, end: Optional[date] = None) -> Dict[str, Any]:
+        """Агрегаты для графиков отчета в формате utils.report_renderer.aggregate_rows"""
+        columns, categories = self.load(expenses_file, start, end)
+        amounts, days = columns["amount"], columns["day"]
+
+        by_category = np.bincount(columns["category"], weights=amounts, minlength=len(categories))
+        present = np.bincount(columns["category"], minlength=len(categories)) > 0
+        order = [code for code in np.argsort(-by_category, kind='stable') if present[code]]
+
+        weeks = iso_weeks(days)
+        week_keys, week_index = np.unique(weeks, return_inverse=True)
+        week_sums = np.bincount(week_index, weights=amounts) if len(amounts) else np.empty(0)
+
+        months = days.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+        month_keys, month_index = np.unique(months, return_inverse=True)
+        month_sums = np.bincount(month_index, weights=amounts) if len(amounts) else np.empty(0)
+
+        return {
+            "categories": [categories[code] for code in order],
+            "amounts": [float(by_category[code]) for code in order],
+            "total": float(amounts.sum()),
+            "transactions": int(len(amounts)),
+            "weeks": [(int(week), float(amount)) for week, amount in zip(week_keys, week_sums)],
+            "months": [(calendar.month_abbr[int(month) % 12 + 1], float(amount)) for month, amount in zip(month_keys, month_sums)]
+        }
+
+
+# Глобальное колоночное хранилище
+columnar_store = ColumnarStore()
@@ -0,0 +1,236 @@
+"""
+Пул соединений PostgreSQL
+
+Раньше get_db_connection открывал новое TCP-соединение с авторизацией на
+каждую операцию. Пул держит ограниченное число соединений и выдает их
+повторно: close() у выданного соединения возвращает его в пул, поэтому
+существующий код вида `conn = get_db_connection() ... conn.close()`
+работает без изменений. Соединения, простоявшие дольше max_idle или
+прожившие дольше max_lifetime, закрываются; простоявшие дольше
+check_interval перед выдачей проверяются запросом SELECT 1.
+"""
+import threading
+import time
+import logging
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Deque, Dict, Iterator, Optional, Tuple
+
+import psycopg2
+from psycopg2 import extensions
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeoutError(Exception):
+    """Все соединения пула заняты дольше acquire_timeout"""
+
+
+class PooledConnection:
+    """Соединение из пула; close() возвращает его в пул, а не закрывает"""
+
+    def __init__(self, pool: "ConnectionPool", conn, created: float):
+        self._pool = pool
+        self._conn = conn
+        self._created = created
+
+    def __getattr__(self, name: str) -> Any:
+        if self._conn is None:
+            raise psycopg2.InterfaceError("connection already returned to pool")
+        return getattr(self._conn, name)
+
+    @property
+    def closed(self) -> int:
+        return 1 if self._conn is None else self._conn.closed
+
+    def close(self):
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            self._pool._release(conn, self._created)
+
+    def __enter__(self):
+        # Как у psycopg2: блок with — это транзакция, а не время жизни соединения
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
+    def __del__(self):
+        # Соединение, которое забыли закрыть (например, в ветке except),
+        # возвращается в пул, а не теряется до исчерпания пула
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class ConnectionPool:
+    """Ограниченный пул соединений psycopg2 с проверкой и обновлением"""
+
+    def __init__(self, dsn: Optional[str] = None, max_size: int = 10, acquire_timeout: float = 30.0,
+                 max_idle: float = 300.0, max_lifetime: float = 3600.0, check_interval: float = 30.0,
+                 connect: Optional[Callable[[str], Any]] = None):
+        self.dsn = dsn
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.check_interval = check_interval
+        self._connect = connect or psycopg2.connect
+        self._cond = threading.Condition()
+        # Свободные соединения: (соединение, время создания, время возврата)
+        self._idle: Deque[Tuple[Any, float, float]] = deque()
+        self._size = 0
+        self._stats = {"connects": 0, "reuses": 0, "recycled": 0, "failed_checks": 0, "waits": 0, "timeouts": 0,
+                       "wait_time": 0.0}
+
+    def configure(self, dsn: Optional[str], **options):
+        """Задает строку подключения и параметры пула (до первой выдачи)"""
+        with self._cond:
+            self.dsn = dsn
+            for name, value in options.items():
+                if not hasattr(self, name):
+                    raise AttributeError(f"Неизвестный параметр пула: {name}")
+                setattr(self, name, value)
+
+    # --- Выдача и возврат ---
+
+    def acquire(self, timeout: Optional[float] = None) -> PooledConnection:
+        """
+        Выдает соединение из пула или открывает новое
+
+        Raises:
+            PoolTimeoutError: все max_size соединений заняты дольше timeout
+        """
+        if not self.dsn:
+            raise psycopg2.OperationalError("Строка подключения к БД не настроена")
+        deadline = time.monotonic() + (self.acquire_timeout if timeout is None else timeout)
+        while True:
+            with self._cond:
+                item = None
+                while item is None:
+                    if self._idle:
+                        item = self._idle.pop()
+                    elif self._size < self.max_size:
+                        self._size += 1
+                        break
+                    else:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._stats["timeouts"] += 1
+                            raise PoolTimeoutError(f"Нет свободных соединений за {self.acquire_timeout} с")
+                        self._stats["waits"] += 1
+                        started = time.monotonic()
+                        self._cond.wait(remaining)
+                        self._stats["wait_time"] += time.monotonic() - started
+
+            if item is None:
+                return self._open()
+            conn, created, returned = item
+            if self._usable(conn, created, returned):
+                self._stats["reuses"] += 1
+                return PooledConnection(self, conn, created)
+            self._discard(conn)
+
+    def _open(self) -> PooledConnection:
+        """Открывает новое соединение; место в пуле уже занято вызывающим"""
+        try:
+            conn = self._connect(self.dsn)
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        self._stats["connects"] += 1
+        return PooledConnection(self, conn, time.monotonic())
+
+    def _usable(self, conn, created: float, returned: float) -> bool:
+        """Проверяет свободное соединение перед повторной выдачей"""
+        now = time.monotonic()
+        if conn.closed or now - returned > self.max_idle or now - created > self.max_lifetime:
+            self._stats["recycled"] += 1
+            return False
+        if now - returned > self.check_interval:
+            try:
+                cursor = conn.cursor()
+                cursor.execute("SELECT 1")
+                cursor.close()
+                conn.rollback()
+            except Exception as e:
+                logger.warning(f"Соединение из пула не прошло проверку: {e}")
+                self._stats["failed_checks"] += 1
+                return False
+        return True
+
+    def _release(self, conn, created: float):
+        """Возвращает соединение; незавершенная транзакция откатывается"""
+        try:
+            if not conn.closed and conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except Exception as e:
+            logger.warning(f"Не удалось откатить транзакцию при возврате в пул: {e}")
+            self._discard(conn)
+            return
+        if conn.closed:
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, created, time.monotonic()))
+            self._cond.notify()
+
+    def _discard(self, conn):
+        """Закрывает соединение и освобождает его место в пуле"""
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, timeout: Optional[float] = None) -> Iterator[PooledConnection]:
+        """
+        Соединение на время блока with
+
+        Ошибка внутри блока откатывает транзакцию; фиксирует ее вызывающий.
+        """
+        conn = self.acquire(timeout)
+        try:
+            yield conn
+        except Exception:
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+            raise
+        finally:
+            conn.close()
+
+    # --- Обслуживание ---
+
+    def close_all(self):
+        """Закрывает свободные соединения (при завершении бота)"""
+        with self._cond:
+            idle, self._idle = list(self._idle), deque()
+            self._size -= len(idle)
+        for conn, _, _ in idle:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Размер пула и счетчики выдачи"""
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update(size=self._size, idle=len(self._idle), in_use=self._size - len(self._idle),
+                         max_size=self.max_size)
+        return stats
+
+
+# Глобальный пул соединений PostgreSQL
+db_pool = ConnectionPool()
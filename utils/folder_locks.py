@@ -0,0 +1,119 @@
+"""
+Блокировки папок пользователей и групп
+
+Участники группы пишут в общие expenses.csv, reminders.json и
+budget_plans.json. Цикл "прочитать — изменить — записать" выполняется под
+блокировкой папки: asyncio.Lock упорядочивает обработчики в event loop,
+threading.RLock — потоки, а flock на файле .folder.lock — процессы бота.
+Файлы записываются во временный файл с последующим os.replace, поэтому сбой
+посреди записи не оставляет обрезанный файл.
+"""
+import asyncio
+import json
+import os
+import threading
+import logging
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator
+
+try:
+    import fcntl
+except ImportError:  # Windows: остается блокировка внутри процесса
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+LOCK_FILE_NAME = ".folder.lock"
+
+
+def write_json_atomic(path: str, data: Any):
+    """Записывает JSON через временный файл и переименование"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class _FolderLock:
+    """Блокировка одной папки: поток-владелец, глубина вложенности и файл flock"""
+
+    def __init__(self):
+        self.thread_lock = threading.RLock()
+        self.async_lock = None
+        self.depth = 0
+        self.handle = None
+
+
+class FolderLockManager:
+    """Блокировки папок для потоков, корутин и процессов"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._folders: Dict[str, _FolderLock] = {}
+
+    def _get(self, folder: str) -> _FolderLock:
+        key = os.path.normpath(folder)
+        with self._lock:
+            entry = self._folders.get(key)
+            if entry is None:
+                entry = self._folders[key] = _FolderLock()
+            return entry
+
+    @contextmanager
+    def lock(self, folder: str) -> Iterator[None]:
+        """
+        Монопольный доступ к папке для текущего потока
+
+        Блокировка реентерабельна: вложенные захваты в том же потоке не
+        открывают файл блокировки повторно.
+        """
+        entry = self._get(folder)
+        with entry.thread_lock:
+            if entry.depth == 0:
+                os.makedirs(folder, exist_ok=True)
+                handle = open(os.path.join(folder, LOCK_FILE_NAME), 'a')
+                if fcntl is not None:
+                    try:
+                        fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+                    except Exception:
+                        handle.close()
+                        raise
+                entry.handle = handle
+            entry.depth += 1
+            try:
+                yield
+            finally:
+                entry.depth -= 1
+                if entry.depth == 0:
+                    handle, entry.handle = entry.handle, None
+                    if fcntl is not None:
+                        fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
+                    handle.close()
+
+    def async_lock(self, folder: str) -> asyncio.Lock:
+        """asyncio.Lock папки для обработчиков бота"""
+        entry = self._get(folder)
+        with self._lock:
+            if entry.async_lock is None:
+                entry.async_lock = asyncio.Lock()
+            return entry.async_lock
+
+    async def run(self, folder: str, func: Callable, *args, **kwargs) -> Any:
+        """
+        Выполняет синхронную запись в папку вне event loop
+
+        Обработчики одной папки ждут друг друга на asyncio.Lock, не занимая
+        потоки пула; сама функция берет lock() для защиты от других процессов.
+        """
+        async with self.async_lock(folder):
+            return await asyncio.to_thread(func, *args, **kwargs)
+
+
+# Глобальный менеджер блокировок папок
+folder_locks = FolderLockManager()
@@ -0,0 +1,125 @@
+"""
+Индекс "пользователь → группа" в памяти процесса
+
+Строится один раз из group_data/groups_registry.json и members.json
+всех групп, далее обновляется теми же функциями, что меняют файлы.
+"""
+import json
+import os
+import threading
+import logging
+from typing import Any, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class GroupIndex:
+    """Обратный индекс участников групп"""
+
+    def __init__(self, group_data_dir: str = "group_data"):
+        self.group_data_dir = group_data_dir
+        self._lock = threading.RLock()
+        self._groups: Dict[int, Dict[str, Any]] = {}
+        self._members: Dict[Any, Tuple[int, Dict[str, Any]]] = {}
+        self._built = False
+
+    def build(self):
+        """Полностью перестраивает индекс по файлам групп"""
+        groups: Dict[int, Dict[str, Any]] = {}
+        members: Dict[Any, Tuple[int, Dict[str, Any]]] = {}
+
+        registry_file = os.path.join(self.group_data_dir, "groups_registry.json")
+        if os.path.exists(registry_file):
+            try:
+                with open(registry_file, 'r', encoding='utf-8') as f:
+                    for group in json.load(f).get("groups", []):
+                        if group.get("id") is not None:
+                            groups[group["id"]] = dict(group)
+            except Exception as e:
+                logger.error(f"Ошибка чтения реестра групп {registry_file}: {e}")
+
+        if os.path.isdir(self.group_data_dir):
+            for item in os.listdir(self.group_data_dir):
+                if not item.startswith("group_"):
+                    continue
+                try:
+                    group_id = int(item.replace("group_", ""))
+                except ValueError:
+                    continue
+                members_file = os.path.join(self.group_data_dir, item, "members.json")
+                if not os.path.exists(members_file):
+                    continue
+                try:
+                    with open(members_file, 'r', encoding='utf-8') as f:
+                        members_list = json.load(f).get("members", [])
+                except Exception as e:
+                    logger.error(f"Ошибка чтения участников {members_file}: {e}")
+                    continue
+                for member in members_list:
+                    user_id = member.get("user_id")
+                    # Как и при линейном поиске, побеждает первая найденная группа
+                    if user_id is not None and user_id not in members:
+                        members[user_id] = (group_id, dict(member))
+
+        with self._lock:
+            self._groups = groups
+            self._members = members
+            self._built = True
+        logger.info(f"Индекс групп построен: {len(groups)} групп, {len(members)} участников")
+
+    def _ensure_built(self):
+        if not self._built:
+            with self._lock:
+                if not self._built:
+                    self.build()
+
+    def get(self, user_id) -> Optional[Dict[str, Any]]:
+        """Возвращает информацию о группе пользователя или None"""
+        self._ensure_built()
+        with self._lock:
+            entry = self._members.get(user_id)
+            if entry is None:
+                return None
+            group_id, member = entry
+            group = self._groups.get(group_id, {})
+            return {
+                "id": group_id,
+                "name": group.get("name", f"Group {group_id}"),
+                "admin_user_id": group.get("admin_user_id", user_id),
+                "invitation_code": group.get("invitation_code", member.get("invitation_code", "")),
+                "role": member.get("role", "member")
+            }
+
+    def get_group_id(self, user_id) -> Optional[int]:
+        """Возвращает ID группы пользователя или None"""
+        self._ensure_built()
+        with self._lock:
+            entry = self._members.get(user_id)
+            return entry[0] if entry else None
+
+    def add_group(self, group: Dict[str, Any]):
+        """Добавляет или обновляет запись реестра групп"""
+        self._ensure_built()
+        with self._lock:
+            self._groups[group["id"]] = dict(group)
+
+    def add_member(self, group_id: int, member: Dict[str, Any]):
+        """Регистрирует участника группы"""
+        self._ensure_built()
+        with self._lock:
+            self._members[member["user_id"]] = (group_id, dict(member))
+
+    def remove_member(self, user_id):
+        """Удаляет участника из индекса"""
+        self._ensure_built()
+        with self._lock:
+            self._members.pop(user_id, None)
+
+    def get_stats(self) -> Dict[str, int]:
+        """Возвращает размер индекса"""
+        with self._lock:
+            return {'groups': len(self._groups), 'members': len(self._members)}
+
+
+# Глобальный индекс групп
+group_index = GroupIndex()
@@ -0,0 +1,196 @@
+"""
+Быстрый поиск категорий по словарю ключевых слов
+
+KeywordMatcher компилирует словарь {категория: [ключевые слова]} в автомат
+Ахо–Корасик и находит категорию за один проход по тексту.
+TrigramIndex — инвертированный индекс триграмм для нечеткого поиска.
+"""
+import threading
+import logging
+from collections import deque
+from typing import Dict, Hashable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Ранг "нет совпадения" (больше любого реального номера категории)
+_NO_MATCH = float("inf")
+
+
+def categories_signature(categories: Dict[str, List[str]]) -> Tuple[Hashable, ...]:
+    """
+    Дешевая подпись словаря категорий
+
+    Словарь в боте только пополняется (новые категории и новые слова в
+    конце списков), поэтому порядка категорий и длин списков достаточно,
+    чтобы заметить изменение.
+    """
+    return tuple((category, len(words)) for category, words in categories.items())
+
+
+class _Automaton:
+    """Автомат Ахо–Корасик, хранящий для каждого состояния минимальный ранг категории"""
+
+    def __init__(self, categories: Dict[str, List[str]]):
+        self.category_names: List[str] = list(categories.keys())
+        self.goto: List[Dict[str, int]] = [{}]
+        self.rank: List[float] = [_NO_MATCH]
+
+        for rank, words in enumerate(categories.values()):
+            for word in words:
+                if word is None:
+                    continue
+                state = 0
+                for ch in word:
+                    next_state = self.goto[state].get(ch)
+                    if next_state is None:
+                        next_state = len(self.goto)
+                        self.goto[state][ch] = next_state
+                        self.goto.append({})
+                        self.rank.append(_NO_MATCH)
+                    state = next_state
+                if rank < self.rank[state]:
+                    self.rank[state] = rank
+
+        # Суффиксные ссылки строим обходом в ширину; ранг состояния
+        # объединяется с рангом его суффиксной ссылки, поэтому при проходе
+        # по тексту достаточно смотреть только на текущее состояние.
+        self.fail: List[int] = [0] * len(self.goto)
+        queue = deque()
+        for next_state in self.goto[0].values():
+            queue.append(next_state)
+            if self.rank[0] < self.rank[next_state]:
+                self.rank[next_state] = self.rank[0]
+        while queue:
+            state = queue.popleft()
+            for ch, next_state in self.goto[state].items():
+                fallback = self.fail[state]
+                while fallback and ch not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                link = self.goto[fallback].get(ch, 0)
+                self.fail[next_state] = link if link != next_state else 0
+                if self.rank[self.fail[next_state]] < self.rank[next_state]:
+                    self.rank[next_state] = self.rank[self.fail[next_state]]
+                queue.append(next_state)
+
+    def match(self, text: str) -> Optional[str]:
+        goto, fail, rank = self.goto, self.fail, self.rank
+        best = rank[0]
+        state = 0
+        for ch in text:
+            if best == 0:
+                break
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if rank[state] < best:
+                best = rank[state]
+        if best == _NO_MATCH:
+            return None
+        return self.category_names[int(best)]
+
+
+class KeywordMatcher:
+    """
+    Поиск первой (в порядке словаря) категории, ключевое слово которой
+    входит в текст как подстрока. Автомат перестраивается при изменении словаря.
+    """
+
+    def __init__(self, categories: Dict[str, List[str]]):
+        self.categories = categories
+        self._lock = threading.Lock()
+        self._signature = None
+        self._automaton: Optional[_Automaton] = None
+
+    def _current(self) -> _Automaton:
+        signature = categories_signature(self.categories)
+        automaton = self._automaton
+        if automaton is None or signature != self._signature:
+            with self._lock:
+                if self._automaton is None or signature != self._signature:
+                    self._automaton = _Automaton(self.categories)
+                    self._signature = signature
+                    logger.debug(f"Автомат ключевых слов перестроен: {len(self._automaton.goto)} состояний")
+                automaton = self._automaton
+        return automaton
+
+    def match(self, text: str) -> Optional[str]:
+        """Возвращает категорию или None"""
+        return self._current().match(text or "")
+
+
+def trigram_set(s: str) -> set:
+    """Множество символьных триграмм строки (с пробелами по краям)"""
+    s = f"  {s}  "
+    return {s[i:i+3] for i in range(len(s)-2)}
+
+
+class _TrigramPostings:
+    """Инвертированный индекс триграмма → позиции ключевых слов"""
+
+    def __init__(self, categories: Dict[str, List[str]]):
+        self.word_category: List[str] = []
+        self.word_size: List[int] = []
+        self.postings: Dict[str, List[int]] = {}
+
+        for category, words in categories.items():
+            for word in words:
+                position = len(self.word_category)
+                trigrams = trigram_set(word)
+                self.word_category.append(category)
+                self.word_size.append(len(trigrams))
+                for trigram in trigrams:
+                    self.postings.setdefault(trigram, []).append(position)
+
+    def best(self, text_norm: str) -> Tuple[Optional[str], float]:
+        tset = trigram_set(text_norm)
+        overlap: Dict[int, int] = {}
+        for trigram in tset:
+            for position in self.postings.get(trigram, ()):
+                overlap[position] = overlap.get(position, 0) + 1
+
+        text_size = len(tset)
+        best_position, best_score = None, 0.0
+        for position, inter in overlap.items():
+            union = text_size + self.word_size[position] - inter
+            score = inter / union if union else 0.0
+            # При равенстве выигрывает слово, стоящее раньше в словаре
+            if score > best_score or (score == best_score and best_position is not None and position < best_position):
+                best_position, best_score = position, score
+        if best_position is None:
+            return None, 0.0
+        return self.word_category[best_position], best_score
+
+
+class TrigramIndex:
+    """
+    Нечеткий поиск категории по мере Жаккара над триграммами
+
+    Оценивается только то подмножество ключевых слов, у которых есть
+    хотя бы одна общая триграмма с текстом. Индекс перестраивается
+    при изменении словаря.
+    """
+
+    def __init__(self, categories: Dict[str, List[str]]):
+        self.categories = categories
+        self._lock = threading.Lock()
+        self._signature = None
+        self._postings: Optional[_TrigramPostings] = None
+
+    def _current(self) -> _TrigramPostings:
+        signature = categories_signature(self.categories)
+        postings = self._postings
+        if postings is None or signature != self._signature:
+            with self._lock:
+                if self._postings is None or signature != self._signature:
+                    self._postings = _TrigramPostings(self.categories)
+                    self._signature = signature
+                    logger.debug(f"Индекс триграмм перестроен: {len(self._postings.postings)} триграмм")
+                postings = self._postings
+        return postings
+
+    def match(self, text_norm: str, threshold: float) -> Optional[str]:
+        """Возвращает лучшую категорию, если ее оценка не ниже порога"""
+        if not text_norm:
+            return None
+        category, score = self._current().best(text_norm)
+        return category if score >= threshold else None
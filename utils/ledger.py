@@ -0,0 +1,709 @@
+"""
+Файловый журнал расходов с разбиением по месяцам
+
+Путь `<папка>/expenses.csv` остается именем журнала (и маркером того, что
+журнал существует), а сами строки хранятся в помесячных файлах
+`<папка>/expenses/2025-10.csv`. Манифест `expenses/manifest.json` хранит
+для каждого месяца количество строк, сумму и диапазон ID, поэтому чтение
+за период открывает только пересекающиеся месяцы, а старые месяцы можно
+сжимать или архивировать по отдельности.
+
+Старый единый expenses.csv при первом обращении раскладывается по месяцам,
+в нем остается только заголовок.
+
+Правки и удаления не переписывают файл месяца: они дописываются в журнал
+изменений `expenses/2025-10.changes.jsonl` и применяются при чтении.
+Фоновый уплотнитель сворачивает изменения в файл месяца, когда журнал
+изменений превышает порог.
+
+Индекс `expenses/offsets.idx` хранит для каждого ID месяц и смещение строки
+в байтах (записи фиксированной длины по позиции ID), поэтому поиск расхода
+по ID — это одно чтение индекса и разбор одной строки.
+"""
+import csv
+import io
+import json
+import os
+import queue
+import struct
+import threading
+import logging
+from datetime import date, datetime, timedelta
+from typing import Dict, Any, Iterable, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+EXPENSE_FIELDNAMES = ['id', 'amount', 'description', 'category', 'transaction_date']
+
+# Суффикс файла-счетчика идентификаторов рядом с expenses.csv
+SEQ_SUFFIX = ".seq"
+
+# Каталог помесячных файлов и манифест
+PARTITIONS_DIR = "expenses"
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 1
+
+# Месяц для строк с нераспознанной датой
+UNDATED_PARTITION = "undated"
+
+# Журнал изменений месяца и порог его уплотнения
+CHANGES_SUFFIX = ".changes.jsonl"
+COMPACT_THRESHOLD_BYTES = int(os.environ.get("LEDGER_COMPACT_THRESHOLD_BYTES", 64 * 1024))
+
+# Индекс смещений: запись (месяц YYYYMM, смещение) для ID на позиции (ID - 1);
+# месяц 0 — записи нет, -1 — строки без даты
+INDEX_NAME = "offsets.idx"
+_INDEX_RECORD = struct.Struct('<iq')
+
+# Номер изменения в строках, возвращаемых записью в журнал: монотонный
+# счетчик журнала (manifest["seq"]), по нему агрегаты учитывают каждую
+# запись ровно один раз
+CHANGE_SEQ_FIELD = "_seq"
+
+# Изменения манифеста и перезапись месяцев выполняются под одной блокировкой
+_lock = threading.RLock()
+
+# Счетчики изменений журналов в памяти процесса
+_versions: Dict[str, int] = {}
+_versions_lock = threading.Lock()
+
+
+def _write_atomic(path: str, content: str):
+    """Записывает файл через временный файл и переименование"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def parse_transaction_date(value: Any) -> Optional[date]:
+    """Дата расхода из строки журнала (ISO с временем и без, с 'Z')"""
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(str(value).strip().replace('Z', '+00:00')).date()
+    except ValueError:
+        return None
+
+
+def partition_key(transaction_date: Any) -> str:
+    """Ключ месяца ('2025-10') для даты расхода"""
+    day = parse_transaction_date(transaction_date)
+    return f"{day.year}-{day.month:02d}" if day else UNDATED_PARTITION
+
+
+def _partition_bounds(key: str) -> Optional[Tuple[date, date]]:
+    """Первый и последний день месяца по ключу"""
+    if key == UNDATED_PARTITION:
+        return None
+    year, month = (int(part) for part in key.split('-'))
+    first = date(year, month, 1)
+    last = date(year + month // 12, month % 12 + 1, 1) - timedelta(days=1)
+    return first, last
+
+
+def partitions_dir(expenses_file: str) -> str:
+    """Каталог помесячных файлов журнала"""
+    return os.path.join(os.path.dirname(expenses_file), PARTITIONS_DIR)
+
+
+def partition_file(expenses_file: str, key: str) -> str:
+    """Путь к файлу месяца"""
+    return os.path.join(partitions_dir(expenses_file), f"{key}.csv")
+
+
+def changes_file(partition_path: str) -> str:
+    """Путь к журналу изменений файла месяца"""
+    return partition_path[:-len(".csv")] + CHANGES_SUFFIX
+
+
+def _manifest_path(expenses_file: str) -> str:
+    return os.path.join(partitions_dir(expenses_file), MANIFEST_NAME)
+
+
+def _rows_to_csv(rows: List[Dict[str, Any]]) -> str:
+    return _rows_to_csv_with_offsets(rows)[0]
+
+
+def _rows_to_csv_with_offsets(rows: List[Dict[str, Any]]) -> Tuple[str, List[Tuple[int, int]]]:
+    """CSV с заголовком и смещения строк в байтах: [(ID, смещение)]"""
+    # Каждая строка пишется в свой маленький буфер: длина строки в байтах
+    # считается без повторного копирования всего накопленного CSV
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=EXPENSE_FIELDNAMES, extrasaction='ignore')
+    writer.writeheader()
+    lines = [buf.getvalue()]
+    offset = len(lines[0].encode('utf-8'))
+    offsets = []
+    for row in rows:
+        buf.seek(0)
+        buf.truncate()
+        writer.writerow(row)
+        line = buf.getvalue()
+        lines.append(line)
+        expense_id = str(row.get('id') or '').strip()
+        if expense_id.isdigit():
+            offsets.append((int(expense_id), offset))
+        offset += len(line.encode('utf-8'))
+    return ''.join(lines), offsets
+
+
+# --- Индекс смещений ---
+
+def _index_path(expenses_file: str) -> str:
+    return os.path.join(partitions_dir(expenses_file), INDEX_NAME)
+
+
+def _partition_code(key: str) -> int:
+    return -1 if key == UNDATED_PARTITION else int(key.replace('-', ''))
+
+
+def _code_partition(code: int) -> Optional[str]:
+    if code == 0:
+        return None
+    if code == -1:
+        return UNDATED_PARTITION
+    return f"{code // 100}-{code % 100:02d}"
+
+
+def _index_put(expenses_file: str, key: Optional[str], offsets: Iterable[Tuple[int, int]]):
+    """Записывает смещения строк; key=None стирает записи"""
+    path = _index_path(expenses_file)
+    code = _partition_code(key) if key else 0
+    with open(path, 'r+b' if os.path.exists(path) else 'w+b') as f:
+        for expense_id, offset in offsets:
+            if expense_id <= 0:
+                continue
+            f.seek((expense_id - 1) * _INDEX_RECORD.size)
+            f.write(_INDEX_RECORD.pack(code, offset if key else 0))
+
+
+def _index_get(expenses_file: str, expense_id: int) -> Optional[Tuple[str, int]]:
+    """Месяц и смещение строки по индексу или None"""
+    path = _index_path(expenses_file)
+    if expense_id <= 0 or not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        f.seek((expense_id - 1) * _INDEX_RECORD.size)
+        record = f.read(_INDEX_RECORD.size)
+    if len(record) < _INDEX_RECORD.size:
+        return None
+    code, offset = _INDEX_RECORD.unpack(record)
+    key = _code_partition(code)
+    return (key, offset) if key else None
+
+
+def _row_at(path: str, offset: int) -> Optional[Dict[str, Any]]:
+    """Разбирает одну строку CSV по смещению"""
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as raw:
+        raw.seek(offset)
+        values = next(csv.reader(io.TextIOWrapper(raw, encoding='utf-8', newline='')), None)
+    if not values or len(values) != len(EXPENSE_FIELDNAMES):
+        return None
+    return dict(zip(EXPENSE_FIELDNAMES, values))
+
+
+def _partition_stats(rows: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Количество строк, сумма и диапазон ID месяца"""
+    ids = [int(row['id']) for row in rows if str(row.get('id') or '').strip().isdigit()]
+    total = 0.0
+    for row in rows:
+        try:
+            total += float(row.get('amount') or 0)
+        except ValueError:
+            pass
+    return {
+        "rows": len(rows),
+        "total": round(total, 2),
+        "min_id": min(ids) if ids else 0,
+        "max_id": max(ids) if ids else 0
+    }
+
+
+def _save_manifest(expenses_file: str, manifest: Dict[str, Any]):
+    _write_atomic(_manifest_path(expenses_file), json.dumps(manifest, ensure_ascii=False, indent=2))
+
+
+def _migrate_legacy(expenses_file: str) -> Dict[str, Any]:
+    """Раскладывает старый единый expenses.csv по месяцам"""
+    partitions: Dict[str, List[Dict[str, Any]]] = {}
+    with open(expenses_file, 'r', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            partitions.setdefault(partition_key(row.get('transaction_date')), []).append(row)
+
+    os.makedirs(partitions_dir(expenses_file), exist_ok=True)
+    manifest = {"version": MANIFEST_VERSION, "partitions": {}}
+    for key, rows in partitions.items():
+        content, offsets = _rows_to_csv_with_offsets(rows)
+        _write_atomic(partition_file(expenses_file, key), content)
+        _index_put(expenses_file, key, offsets)
+        manifest["partitions"][key] = _partition_stats(rows)
+    # Сначала манифест, потом очистка старого файла: после сбоя между ними
+    # данные уже читаются из месяцев, а старые строки просто игнорируются
+    _save_manifest(expenses_file, manifest)
+    _write_atomic(expenses_file, _rows_to_csv([]))
+    logger.info(f"Журнал {expenses_file} разложен по месяцам: {len(partitions)} файлов, "
+                f"{sum(len(rows) for rows in partitions.values())} строк")
+    return manifest
+
+
+def load_manifest(expenses_file: str) -> Dict[str, Any]:
+    """
+    Манифест журнала: {"partitions": {месяц: {rows, total, min_id, max_id}}}
+
+    Старый единый expenses.csv с данными при этом раскладывается по месяцам.
+    """
+    with _lock:
+        path = _manifest_path(expenses_file)
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        if os.path.exists(expenses_file) and os.path.getsize(expenses_file) > 0:
+            with open(expenses_file, 'r', encoding='utf-8') as f:
+                f.readline()
+                has_rows = bool(f.readline().strip())
+            if has_rows:
+                return _migrate_legacy(expenses_file)
+        return {"version": MANIFEST_VERSION, "partitions": {}}
+
+
+def list_partitions(expenses_file: str, start: Optional[date] = None, end: Optional[date] = None) -> List[str]:
+    """
+    Месяцы журнала по возрастанию; при заданном периоде — только пересекающиеся
+
+    Строки без даты (UNDATED_PARTITION) попадают только в выборку без периода.
+    """
+    keys = []
+    for key in sorted(load_manifest(expenses_file)["partitions"]):
+        bounds = _partition_bounds(key)
+        if start is None and end is None:
+            keys.append(key)
+        elif bounds and (end is None or bounds[0] <= end) and (start is None or bounds[1] >= start):
+            keys.append(key)
+    return keys
+
+
+def partition_files(expenses_file: str) -> List[str]:
+    """Файлы всех месяцев журнала"""
+    return [partition_file(expenses_file, key) for key in list_partitions(expenses_file)]
+
+
+def load_changes(partition_path: str) -> Dict[str, Optional[Dict[str, str]]]:
+    """
+    Изменения месяца: ID -> измененные поля или None для удаленной строки
+
+    Недописанная последняя запись (сбой во время записи) пропускается.
+    """
+    path = changes_file(partition_path)
+    changes: Dict[str, Optional[Dict[str, str]]] = {}
+    if not os.path.exists(path):
+        return changes
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            expense_id = str(record["id"])
+            if record["op"] == "delete":
+                changes[expense_id] = None
+            elif changes.get(expense_id, {}) is not None:
+                changes.setdefault(expense_id, {}).update(record["fields"])
+    return changes
+
+
+def apply_changes(rows: List[Dict[str, Any]], changes: Dict[str, Optional[Dict[str, str]]]) -> List[Dict[str, Any]]:
+    """Применяет изменения к строкам месяца"""
+    if not changes:
+        return rows
+    result = []
+    for row in rows:
+        expense_id = str(row.get('id')).strip()
+        if expense_id in changes:
+            if changes[expense_id] is None:
+                continue
+            row = {**row, **changes[expense_id]}
+        result.append(row)
+    return result
+
+
+def read_partition(expenses_file: str, key: str) -> List[Dict[str, Any]]:
+    """Строки одного месяца с примененными изменениями"""
+    path = partition_file(expenses_file, key)
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r', encoding='utf-8') as f:
+        rows = list(csv.DictReader(f))
+    return apply_changes(rows, load_changes(path))
+
+
+def iter_expenses(expenses_file: str, start: Optional[date] = None, end: Optional[date] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Строки журнала (словари с полями EXPENSE_FIELDNAMES)
+
+    При заданном периоде открываются только пересекающиеся месяцы, а строки
+    дополнительно фильтруются по дате.
+    """
+    for key in list_partitions(expenses_file, start, end):
+        for row in read_partition(expenses_file, key):
+            if start is not None or end is not None:
+                day = parse_transaction_date(row.get('transaction_date'))
+                if day is None or (start and day < start) or (end and day > end):
+                    continue
+            yield row
+
+
+def count_expenses(expenses_file: str) -> int:
+    """Количество расходов по манифесту, без чтения строк"""
+    return sum(item["rows"] for item in load_manifest(expenses_file)["partitions"].values())
+
+
+def _scan_max_id(expenses_file: str) -> int:
+    """Максимальный ID по манифесту (выполняется один раз при инициализации счетчика)"""
+    partitions = load_manifest(expenses_file)["partitions"].values()
+    return max((item["max_id"] for item in partitions), default=0)
+
+
+def next_expense_id(expenses_file: str, count: int = 1) -> int:
+    """
+    Выдает следующий ID расхода из файла-счетчика
+
+    Счетчик хранится в `expenses.csv.seq`. Если его нет, он
+    инициализируется максимальным ID журнала. При count > 1 резервируются
+    count идущих подряд ID и возвращается первый из них.
+    """
+    seq_file = expenses_file + SEQ_SUFFIX
+    last_id = None
+    if os.path.exists(seq_file):
+        try:
+            with open(seq_file, 'r', encoding='utf-8') as f:
+                last_id = int(f.read().strip())
+        except (ValueError, OSError) as e:
+            logger.warning(f"Поврежден счетчик ID {seq_file}: {e}, пересчитываем")
+    if last_id is None:
+        last_id = _scan_max_id(expenses_file)
+
+    new_id = last_id + 1
+    _write_atomic(seq_file, str(last_id + count))
+    return new_id
+
+
+def bump_ledger_version(expenses_file: str) -> int:
+    """Отмечает изменение журнала (добавление, правка или удаление расхода)"""
+    key = os.path.normpath(expenses_file)
+    with _versions_lock:
+        _versions[key] = _versions.get(key, 0) + 1
+        return _versions[key]
+
+
+def ledger_stamp(expenses_file: str) -> Tuple[int, int]:
+    """Время модификации и размер манифеста: меняются при любой записи в журнал"""
+    try:
+        stat = os.stat(_manifest_path(expenses_file))
+        return stat.st_mtime_ns, stat.st_size
+    except OSError:
+        return 0, 0
+
+
+def ledger_state(expenses_file: str) -> Tuple[int, Tuple[int, int]]:
+    """Номер последнего изменения журнала и отметка манифеста, прочитанные согласованно"""
+    with _lock:
+        return load_manifest(expenses_file).get("seq", 0), ledger_stamp(expenses_file)
+
+
+def ledger_version(expenses_file: str) -> Tuple[int, int, int]:
+    """
+    Версия журнала для ключей кэша
+
+    Счетчик изменений дополняется отметкой манифеста, поэтому изменения
+    в обход этого процесса (или до перезапуска) тоже меняют версию.
+    """
+    key = os.path.normpath(expenses_file)
+    with _versions_lock:
+        counter = _versions.get(key, 0)
+    return (counter,) + ledger_stamp(expenses_file)
+
+
+def _ensure_header(path: str):
+    """Создает CSV с заголовком, если файла нет или он пустой"""
+    if os.path.exists(path) and os.path.getsize(path) > 0:
+        # Если последняя строка без перевода строки, дописываем его
+        with open(path, 'rb+') as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) not in (b'\n', b'\r'):
+                f.write(b'\r\n')
+        return
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        csv.DictWriter(f, fieldnames=EXPENSE_FIELDNAMES).writeheader()
+
+
+def append_expense(expenses_file: str, amount, description: str, category: str, transaction_date) -> Dict[str, Any]:
+    """
+    Дописывает один расход в конец файла его месяца за O(1)
+
+    Returns:
+        Записанная строка (словарь с полями EXPENSE_FIELDNAMES)
+    """
+    return append_expenses(expenses_file, [{
+        'amount': amount,
+        'description': description,
+        'category': category,
+        'transaction_date': transaction_date
+    }])[0]
+
+
+def append_expenses(expenses_file: str, expenses: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Дописывает пачку расходов: одна запись и один fsync на файл месяца,
+    одно обновление счетчика ID, индекса и манифеста
+
+    Args:
+        expenses: Словари с ключами amount, description, category, transaction_date
+
+    Returns:
+        Записанные строки в порядке expenses; у всех один номер изменения
+        (CHANGE_SEQ_FIELD)
+    """
+    if not expenses:
+        return []
+    with _lock:
+        manifest = load_manifest(expenses_file)
+        seq = manifest.get("seq", 0) + 1
+        # Маркер журнала: остальной код проверяет существование expenses.csv
+        _ensure_header(expenses_file)
+        first_id = next_expense_id(expenses_file, len(expenses))
+
+        rows = []
+        by_partition: Dict[str, List[Dict[str, Any]]] = {}
+        for new_id, expense in enumerate(expenses, start=first_id):
+            transaction_date = expense['transaction_date']
+            row = {
+                'id': str(new_id),
+                'amount': str(expense['amount']),
+                'description': expense['description'],
+                'category': expense['category'],
+                'transaction_date': transaction_date.isoformat() if hasattr(transaction_date, 'isoformat') else str(transaction_date)
+            }
+            rows.append(row)
+            by_partition.setdefault(partition_key(row['transaction_date']), []).append(row)
+
+        os.makedirs(partitions_dir(expenses_file), exist_ok=True)
+        for key, partition_rows in by_partition.items():
+            path = partition_file(expenses_file, key)
+            _ensure_header(path)
+            offset = os.path.getsize(path)
+            content, offsets = _rows_to_csv_with_offsets(partition_rows)
+            header_size = offsets[0][1]
+            with open(path, 'ab') as f:
+                f.write(content.encode('utf-8')[header_size:])
+                f.flush()
+                os.fsync(f.fileno())
+            _index_put(expenses_file, key, [(expense_id, offset + row_offset - header_size)
+                                            for expense_id, row_offset in offsets])
+
+            for row in partition_rows:
+                new_id = int(row['id'])
+                stats = manifest["partitions"].setdefault(key, {"rows": 0, "total": 0.0, "min_id": new_id, "max_id": new_id})
+                stats["rows"] += 1
+                stats["total"] = round(stats["total"] + float(row['amount']), 2)
+                stats["min_id"] = min(stats["min_id"] or new_id, new_id)
+                stats["max_id"] = max(stats["max_id"], new_id)
+        manifest["seq"] = seq
+        _save_manifest(expenses_file, manifest)
+    bump_ledger_version(expenses_file)
+    return [{**row, CHANGE_SEQ_FIELD: seq} for row in rows]
+
+
+def _candidate_partitions(manifest: Dict[str, Any], expense_id: int) -> List[str]:
+    """Месяцы, в диапазон ID которых попадает expense_id (новые первыми)"""
+    return [key for key, stats in sorted(manifest["partitions"].items(), reverse=True)
+            if stats["min_id"] <= expense_id <= stats["max_id"]]
+
+
+def _locate(expenses_file: str, expense_id: int) -> Optional[Tuple[str, Dict[str, Any]]]:
+    """
+    Месяц и актуальная строка расхода
+
+    Сначала индекс смещений (одно чтение и разбор одной строки); если записи
+    нет или она устарела, просматриваются месяцы с подходящим диапазоном ID,
+    а найденное смещение записывается в индекс.
+    """
+    located = _index_get(expenses_file, expense_id)
+    if located:
+        key, offset = located
+        path = partition_file(expenses_file, key)
+        row = _row_at(path, offset)
+        if row and row['id'].strip() == str(expense_id):
+            changes = load_changes(path)
+            rows = apply_changes([row], {str(expense_id): changes[str(expense_id)]} if str(expense_id) in changes else {})
+            return (key, rows[0]) if rows else None
+
+    for key in _candidate_partitions(load_manifest(expenses_file), expense_id):
+        path = partition_file(expenses_file, key)
+        if not os.path.exists(path):
+            continue
+        with open(path, 'r', encoding='utf-8', newline='') as f:
+            content = f.read()
+        rows = list(csv.DictReader(io.StringIO(content)))
+        for row in rows:
+            if str(row.get('id')).strip() != str(expense_id):
+                continue
+            # Восстанавливаем запись индекса, если файл в нашем формате
+            content_check, offsets = _rows_to_csv_with_offsets(rows)
+            if content_check == content:
+                _index_put(expenses_file, key, offsets)
+            found = apply_changes([row], load_changes(path))
+            return (key, found[0]) if found else None
+    return None
+
+
+def find_expense(expenses_file: str, expense_id: int) -> Optional[Dict[str, Any]]:
+    """Находит расход по ID через индекс смещений"""
+    located = _locate(expenses_file, expense_id)
+    return located[1] if located else None
+
+
+def _record_change(expenses_file: str, expense_id: int, changes: Optional[Dict[str, Any]]):
+    """
+    Дописывает изменение (changes) или удаление (changes=None) строки в журнал
+    изменений ее месяца; файл месяца не переписывается
+
+    Обе возвращаемые строки несут номер изменения (CHANGE_SEQ_FIELD).
+    """
+    with _lock:
+        located = _locate(expenses_file, expense_id)
+        if not located:
+            return None
+        key, row = located
+        old_row = dict(row)
+        if changes is None:
+            record = {"id": expense_id, "op": "delete"}
+            new_row = None
+        else:
+            fields = {field: str(value) for field, value in changes.items()}
+            record = {"id": expense_id, "op": "update", "fields": fields}
+            new_row = {**row, **fields}
+
+        path = changes_file(partition_file(expenses_file, key))
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+        manifest = load_manifest(expenses_file)
+        stats = manifest["partitions"][key]
+        old_amount = float(old_row.get('amount') or 0)
+        new_amount = float(new_row.get('amount') or 0) if new_row else 0.0
+        stats["total"] = round(stats["total"] - old_amount + new_amount, 2)
+        if new_row is None:
+            stats["rows"] -= 1
+        manifest["seq"] = manifest.get("seq", 0) + 1
+        _save_manifest(expenses_file, manifest)
+        bump_ledger_version(expenses_file)
+        old_row[CHANGE_SEQ_FIELD] = manifest["seq"]
+        if new_row is not None:
+            new_row[CHANGE_SEQ_FIELD] = manifest["seq"]
+
+        if os.path.getsize(path) >= COMPACT_THRESHOLD_BYTES:
+            ledger_compactor.schedule(expenses_file, key)
+        return old_row, new_row
+
+
+def compact_partition(expenses_file: str, key: str) -> bool:
+    """
+    Сворачивает журнал изменений в файл месяца
+
+    Содержимое журнала не меняется, поэтому манифест и версия журнала
+    остаются прежними. Изменения идемпотентны: сбой между заменой файла
+    месяца и удалением журнала изменений безопасен.
+    """
+    with _lock:
+        path = partition_file(expenses_file, key)
+        changes_path = changes_file(path)
+        if not os.path.exists(changes_path):
+            return False
+        deleted = [int(expense_id) for expense_id, fields in load_changes(path).items()
+                   if fields is None and expense_id.isdigit()]
+        rows = read_partition(expenses_file, key)
+        content, offsets = _rows_to_csv_with_offsets(rows)
+        _write_atomic(path, content)
+        # Смещения строк изменились; удаленные ID убираются из индекса
+        _index_put(expenses_file, key, offsets)
+        _index_put(expenses_file, None, [(expense_id, 0) for expense_id in deleted])
+        os.remove(changes_path)
+    logger.info(f"Месяц {key} журнала {expenses_file} уплотнен: {len(rows)} строк")
+    return True
+
+
+class LedgerCompactor:
+    """Фоновый поток, сворачивающий журналы изменений месяцев"""
+
+    def __init__(self):
+        self._queue: "queue.Queue[Tuple[str, str]]" = queue.Queue()
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def schedule(self, expenses_file: str, key: str):
+        """Ставит месяц в очередь на уплотнение (повторные запросы схлопываются)"""
+        with self._pending_lock:
+            if (expenses_file, key) in self._pending:
+                return
+            self._pending.add((expenses_file, key))
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="ledger-compactor", daemon=True)
+                self._thread.start()
+        self._queue.put((expenses_file, key))
+
+    def _run(self):
+        while True:
+            expenses_file, key = self._queue.get()
+            try:
+                compact_partition(expenses_file, key)
+            except Exception as e:
+                logger.error(f"Ошибка уплотнения месяца {key} журнала {expenses_file}: {e}")
+            finally:
+                with self._pending_lock:
+                    self._pending.discard((expenses_file, key))
+                self._queue.task_done()
+
+    def wait(self):
+        """Ждет завершения всех запланированных уплотнений"""
+        self._queue.join()
+
+
+# Глобальный фоновый уплотнитель журналов
+ledger_compactor = LedgerCompactor()
+
+
+def update_expense(expenses_file: str, expense_id: int, **changes) -> Optional[Tuple[Dict[str, Any], Dict[str, Any]]]:
+    """
+    Обновляет поля расхода (amount, description, category)
+
+    Дата не меняется, поэтому строка остается в своем месяце.
+
+    Returns:
+        (строка до изменения, строка после) или None, если расход не найден
+    """
+    if 'transaction_date' in changes or 'id' in changes:
+        raise ValueError("Нельзя менять дату или ID расхода")
+    return _record_change(expenses_file, expense_id, changes)
+
+
+def remove_expense(expenses_file: str, expense_id: int) -> Optional[Dict[str, Any]]:
+    """
+    Удаляет расход
+
+    Returns:
+        Удаленная строка или None, если расход не найден
+    """
+    result = _record_change(expenses_file, expense_id, None)
+    return result[0] if result else None
@@ -0,0 +1,118 @@
+"""
+Версионные миграции схемы PostgreSQL
+
+Раньше таблицы создавались запросами CREATE TABLE IF NOT EXISTS при каждом
+запуске бота и даже внутри функций записи. Теперь каждое изменение схемы —
+миграция с номером версии; примененные версии хранятся в таблице
+schema_version. Миграции выполняются один раз при запуске под
+pg_advisory_lock, поэтому два процесса бота не применяют их одновременно,
+а на пути запросов DDL больше нет.
+
+Миграции регистрируются там, где описаны их таблицы:
+
+    @schema_migrations.register(1, "Таблицы расходов")
+    def _create_expenses(cursor):
+        cursor.execute("CREATE TABLE ...")
+"""
+import logging
+from typing import Callable, Dict, List, NamedTuple, Set
+
+from psycopg2 import extensions
+
+logger = logging.getLogger(__name__)
+
+# Ключ advisory lock миграций (произвольная константа приложения)
+MIGRATION_LOCK_KEY = 7253101
+
+VERSION_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        name VARCHAR(255) NOT NULL,
+        applied_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+    )
+"""
+
+
+class Migration(NamedTuple):
+    """Одна миграция: версия, описание и функция, выполняющая SQL через курсор"""
+    version: int
+    name: str
+    apply: Callable
+
+
+class MigrationRunner:
+    """Реестр миграций и их применение под advisory lock"""
+
+    def __init__(self, lock_key: int = MIGRATION_LOCK_KEY):
+        self.lock_key = lock_key
+        self._migrations: Dict[int, Migration] = {}
+
+    def register(self, version: int, name: str):
+        """Декоратор регистрации миграции"""
+        def decorator(func: Callable) -> Callable:
+            if version in self._migrations:
+                raise ValueError(f"Миграция версии {version} уже зарегистрирована: "
+                                 f"{self._migrations[version].name}")
+            self._migrations[version] = Migration(version, name, func)
+            return func
+        return decorator
+
+    @property
+    def migrations(self) -> List[Migration]:
+        return [self._migrations[version] for version in sorted(self._migrations)]
+
+    def applied_versions(self, cursor) -> Set[int]:
+        cursor.execute("SELECT version FROM schema_version")
+        return {row[0] for row in cursor.fetchall()}
+
+    def run(self, conn) -> int:
+        """
+        Применяет недостающие миграции по возрастанию версии
+
+        Миграции регистрируются в разных модулях, и процесс, импортировавший
+        только часть из них, не должен помешать применить остальные позже,
+        поэтому сравнивается множество примененных версий, а не максимум.
+        Каждая миграция выполняется в своей транзакции вместе с записью
+        в schema_version. Ошибка откатывает миграцию и пробрасывается:
+        следующие версии не применяются.
+
+        Returns:
+            Количество примененных миграций
+        """
+        cursor = conn.cursor(cursor_factory=extensions.cursor)
+        cursor.execute("SELECT pg_advisory_lock(%s)", (self.lock_key,))
+        try:
+            cursor.execute(VERSION_TABLE_SQL)
+            conn.commit()
+            # Версии читаем уже под блокировкой: другой процесс мог успеть применить миграции
+            applied_versions = self.applied_versions(cursor)
+            conn.commit()
+            applied = 0
+            for migration in self.migrations:
+                if migration.version in applied_versions:
+                    continue
+                try:
+                    migration.apply(cursor)
+                    cursor.execute("INSERT INTO schema_version (version, name) VALUES (%s, %s)",
+                                   (migration.version, migration.name))
+                    conn.commit()
+                except Exception as e:
+                    conn.rollback()
+                    logger.error(f"Ошибка миграции схемы {migration.version} ({migration.name}): {e}")
+                    raise
+                applied += 1
+                logger.info(f"Применена миграция схемы {migration.version}: {migration.name}")
+            if not applied:
+                logger.info(f"Схема БД актуальна (версий применено: {len(applied_versions)})")
+            return applied
+        finally:
+            try:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", (self.lock_key,))
+                conn.commit()
+            except Exception as e:
+                logger.warning(f"Не удалось снять блокировку миграций: {e}")
+            cursor.close()
+
+
+# Глобальный реестр миграций схемы
+schema_migrations = MigrationRunner()
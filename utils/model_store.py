@@ -0,0 +1,99 @@
+"""
+Хранилище обученных артефактов классификатора расходов
+
+Векторизатор и классификатор сохраняются вместе с версией формата и
+отпечатком обучающих данных. При старте артефакт загружается, только если
+отпечаток совпадает, иначе модель обучается заново.
+"""
+import hashlib
+import os
+import pickle
+import logging
+from datetime import datetime
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+import sklearn
+
+logger = logging.getLogger(__name__)
+
+# Версия формата артефакта; увеличивать при изменении пайплайна классификации
+MODEL_FORMAT_VERSION = 2
+
+DEFAULT_ARTIFACT_PATH = os.environ.get("MODEL_ARTIFACT_PATH", "model_cache/expense_classifier.pkl")
+
+
+def training_fingerprint(samples: Iterable[Tuple[str, str]], *params: Any) -> str:
+    """
+    Отпечаток обучающих данных и параметров модели
+
+    Args:
+        samples: Пары (описание, категория) в порядке обучения
+        params: Параметры векторизатора/классификатора, влияющие на результат
+    """
+    digest = hashlib.sha256()
+    digest.update(f"v{MODEL_FORMAT_VERSION}|sklearn={sklearn.__version__}".encode('utf-8'))
+    for param in params:
+        digest.update(b"\x1e")
+        digest.update(repr(sorted(param.items()) if isinstance(param, dict) else param).encode('utf-8'))
+    for description, category in samples:
+        digest.update(b"\x1f")
+        digest.update(str(description).encode('utf-8'))
+        digest.update(b"\x1d")
+        digest.update(str(category).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class ModelStore:
+    """Файловое хранилище артефактов классификатора"""
+
+    def __init__(self, path: str = DEFAULT_ARTIFACT_PATH):
+        self.path = path
+
+    def load(self, fingerprint: str) -> Optional[Tuple[Any, Any, Any]]:
+        """Возвращает (vectorizer, classifier, online_model), если артефакт подходит к отпечатку"""
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, 'rb') as f:
+                artifact = pickle.load(f)
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать артефакт модели {self.path}: {e}")
+            return None
+
+        if artifact.get("version") != MODEL_FORMAT_VERSION:
+            logger.info(f"Артефакт модели устарел (версия {artifact.get('version')}), нужно обучение")
+            return None
+        if artifact.get("fingerprint") != fingerprint:
+            logger.info("Обучающие данные изменились, артефакт модели не используется")
+            return None
+
+        logger.info(f"Модель загружена из {self.path} (обучена {artifact.get('trained_at')}, {artifact.get('samples')} записей)")
+        return artifact["vectorizer"], artifact["classifier"], artifact.get("online_model")
+
+    def save(self, fingerprint: str, vectorizer: Any, classifier: Any, samples: int = 0, online_model: Any = None):
+        """Атомарно сохраняет артефакт (временный файл и переименование)"""
+        artifact: Dict[str, Any] = {
+            "version": MODEL_FORMAT_VERSION,
+            "fingerprint": fingerprint,
+            "sklearn_version": sklearn.__version__,
+            "trained_at": datetime.now().isoformat(),
+            "samples": samples,
+            "vectorizer": vectorizer,
+            "classifier": classifier,
+            "online_model": online_model
+        }
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(artifact, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.path)
+            logger.info(f"Артефакт модели сохранен: {self.path}")
+        except Exception as e:
+            logger.error(f"Ошибка сохранения артефакта модели: {e}")
+
+
+# Глобальное хранилище артефактов
+model_store = ModelStore()
@@ -0,0 +1,152 @@
+"""
+Офлайн-журнал записей в базу данных
+
+Когда DatabaseManager работает в режиме совместимости (БД не настроена или
+недоступна), функции записи database.py раньше просто возвращали False, и
+данные в БД не попадали. Теперь вызов записывается в journal.jsonl (одна
+JSON-строка на операцию, с fsync), а после восстановления соединения журнал
+повторяется по порядку пачками. Журнал хранит только имя операции и ее
+аргументы; как применять операции, решает вызывающий код.
+
+Журнал только дописывается: номер последней примененной операции хранится
+в consumed.json, а сам файл очищается, когда применены все операции.
+Повтор пачки не перезаписывает оставшийся хвост.
+"""
+import itertools
+import json
+import os
+import threading
+import logging
+from collections import deque
+from datetime import date, datetime, time
+from typing import Any, Deque, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_DIR = os.environ.get("OFFLINE_JOURNAL_DIR", "offline_journal")
+JOURNAL_NAME = "journal.jsonl"
+CONSUMED_NAME = "consumed.json"
+
+# Типы аргументов, которые JSON не хранит сам
+_TYPES = {"datetime": datetime, "date": date, "time": time}
+
+
+def _encode(value: Any) -> Any:
+    for name, cls in _TYPES.items():
+        if isinstance(value, cls):
+            return {"__type__": name, "value": value.isoformat()}
+    raise TypeError(f"Тип {type(value).__name__} нельзя записать в офлайн-журнал")
+
+
+def _decode(obj: Dict[str, Any]) -> Any:
+    cls = _TYPES.get(obj.get("__type__")) if len(obj) == 2 and "value" in obj else None
+    return cls.fromisoformat(obj["value"]) if cls else obj
+
+
+class OfflineJournal:
+    """Упорядоченный журнал операций, отложенных до появления БД"""
+
+    def __init__(self, journal_dir: str = JOURNAL_DIR):
+        self.path = os.path.join(journal_dir, JOURNAL_NAME)
+        self.consumed_path = os.path.join(journal_dir, CONSUMED_NAME)
+        self._lock = threading.Lock()
+        self._records: Optional[Deque[Dict[str, Any]]] = None
+        self._seq = 0
+
+    def _read_consumed(self) -> int:
+        try:
+            with open(self.consumed_path, 'r', encoding='utf-8') as f:
+                return int(json.load(f)["seq"])
+        except FileNotFoundError:
+            return 0
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать отметку офлайн-журнала {self.consumed_path}: {e}")
+            return 0
+
+    def _write_consumed(self, seq: int):
+        """Сохраняет номер последней примененной операции (маленький файл, с fsync)"""
+        os.makedirs(os.path.dirname(self.consumed_path) or ".", exist_ok=True)
+        tmp_path = f"{self.consumed_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"seq": seq}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.consumed_path)
+
+    def _load(self) -> Deque[Dict[str, Any]]:
+        """Еще не примененные записи журнала в памяти; читаются с диска один раз (под self._lock)"""
+        if self._records is None:
+            self._records = deque()
+            consumed = self._read_consumed()
+            self._seq = consumed
+            if os.path.exists(self.path):
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line, object_hook=_decode)
+                        except json.JSONDecodeError:
+                            # Оборванная последняя строка после сбоя
+                            logger.warning(f"Пропущена поврежденная запись офлайн-журнала {self.path}")
+                            continue
+                        self._seq = max(self._seq, record.get("seq", 0))
+                        if record.get("seq", 0) > consumed:
+                            self._records.append(record)
+                if self._records:
+                    logger.info(f"В офлайн-журнале {len(self._records)} операций ждут базу данных")
+        return self._records
+
+    def record(self, op: str, **args) -> bool:
+        """
+        Дописывает операцию в журнал
+
+        Returns:
+            True — операция сохранена и будет применена после восстановления БД
+        """
+        with self._lock:
+            records = self._load()
+            self._seq += 1
+            record = {"seq": self._seq, "op": op, "args": args}
+            line = json.dumps(record, ensure_ascii=False, default=_encode)
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            records.append(json.loads(line, object_hook=_decode))
+        return True
+
+    def has_pending(self) -> bool:
+        with self._lock:
+            return bool(self._load())
+
+    def pending(self, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Первые limit операций в порядке записи"""
+        with self._lock:
+            records = self._load()
+            return list(records if limit is None else itertools.islice(records, limit))
+
+    def discard(self, count: int):
+        """
+        Отмечает первые count операций примененными
+
+        Записывается только номер последней примененной операции; файл
+        журнала очищается, когда применены все операции.
+        """
+        if count <= 0:
+            return
+        with self._lock:
+            records = self._load()
+            count = min(count, len(records))
+            if not count:
+                return
+            last_seq = records[count - 1]["seq"]
+            self._write_consumed(last_seq)
+            for _ in range(count):
+                records.popleft()
+            if not records and os.path.exists(self.path):
+                # Отметка уже сохранена: сбой до очистки безопасен
+                os.remove(self.path)
+
+
+# Глобальный офлайн-журнал database.py
+offline_journal = OfflineJournal()
@@ -0,0 +1,138 @@
+"""
+Онлайн-классификатор расходов для дообучения на исправлениях
+
+HashingVectorizer не требует обучения словаря, а SGDClassifier умеет
+partial_fit, поэтому одно исправление категории обновляет модель за
+O(число признаков) без полного переобучения.
+
+Онлайн-модель точнее основной только на текстах, похожих на исправленные;
+на остальных она хуже, поэтому classify_expense берет ее ответ лишь через
+trusted_prediction.
+"""
+import random
+import logging
+from typing import Iterable, List, Optional, Sequence
+
+from scipy.sparse import vstack
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.linear_model import SGDClassifier
+
+logger = logging.getLogger(__name__)
+
+HASHING_PARAMS = dict(
+    analyzer="char_wb",
+    ngram_range=(3, 5),
+    n_features=2 ** 18,
+    alternate_sign=False
+)
+
+SGD_PARAMS = dict(
+    loss="log_loss",
+    alpha=1e-5,
+    random_state=42
+)
+
+# Ответ онлайн-модели берется вместо основной, если она настолько уверена
+MIN_CONFIDENCE = 0.9
+# ...или текст настолько похож (косинус n-грамм) на одно из исправлений
+MIN_SIMILARITY = 0.5
+# Сколько последних исправлений помнится для сравнения
+MAX_CORRECTIONS = 1000
+
+
+class OnlineClassifier:
+    """Линейная модель на хешированных char n-граммах с partial_fit"""
+
+    def __init__(self):
+        self.vectorizer = HashingVectorizer(**HASHING_PARAMS)
+        self.model = SGDClassifier(**SGD_PARAMS)
+        self.classes: List[str] = []
+        self.updates = 0
+        # Векторы исправленных текстов с последнего fit
+        self.corrections = []
+
+    def __setstate__(self, state):
+        # Модели, сохраненные до появления списка исправлений
+        state.setdefault("corrections", [])
+        self.__dict__.update(state)
+
+    @property
+    def is_fitted(self) -> bool:
+        return bool(self.classes) and hasattr(self.model, "coef_")
+
+    def fit(self, texts: Sequence[str], labels: Sequence[str], classes: Optional[Iterable[str]] = None,
+            epochs: int = 5, weights: Optional[Sequence[float]] = None):
+        """
+        Начальное обучение несколькими проходами partial_fit
+
+        Args:
+            classes: Полный список категорий; partial_fit не умеет добавлять
+                новые классы, поэтому сюда передаются все известные категории
+            weights: Веса примеров (например, количество повторов)
+        """
+        self.classes = sorted(set(classes or []) | set(labels))
+        if len(self.classes) < 2 or not texts:
+            return
+        order = list(range(len(texts)))
+        rng = random.Random(42)
+        for _ in range(epochs):
+            rng.shuffle(order)
+            X = self.vectorizer.transform([texts[i] for i in order])
+            y = [labels[i] for i in order]
+            sample_weight = [weights[i] for i in order] if weights is not None else None
+            self.model.partial_fit(X, y, classes=self.classes, sample_weight=sample_weight)
+        self.updates = 0
+        self.corrections = []
+
+    def learn(self, text: str, label: str, repeats: int = 3) -> bool:
+        """
+        Дообучает модель на одном исправлении
+
+        Returns:
+            False, если категория неизвестна модели (нужно полное переобучение)
+        """
+        if not self.is_fitted or label not in self.classes or not text:
+            return False
+        X = self.vectorizer.transform([text])
+        for _ in range(repeats):
+            self.model.partial_fit(X, [label])
+        self.updates += 1
+        self.corrections = self.corrections[-(MAX_CORRECTIONS - 1):] + [X]
+        return True
+
+    def predict(self, text: str) -> Optional[str]:
+        """Возвращает категорию или None, если модель не обучена"""
+        if not self.is_fitted:
+            return None
+        return self.model.predict(self.vectorizer.transform([text]))[0]
+
+    def predict_with_confidence(self, text: str):
+        """Возвращает (категория, вероятность) или (None, 0.0)"""
+        if not self.is_fitted:
+            return None, 0.0
+        probabilities = self.model.predict_proba(self.vectorizer.transform([text]))[0]
+        best = probabilities.argmax()
+        return self.model.classes_[best], float(probabilities[best])
+
+    def similarity(self, text: str) -> float:
+        """Наибольшее сходство текста с исправленными (векторы нормированы, косинус = скалярное произведение)"""
+        if not self.corrections or not text:
+            return 0.0
+        X = self.vectorizer.transform([text])
+        return float((vstack(self.corrections) @ X.T).max())
+
+    def trusted_prediction(self, text: str, min_confidence: float = MIN_CONFIDENCE,
+                           min_similarity: float = MIN_SIMILARITY) -> Optional[str]:
+        """
+        Категория онлайн-модели, если ей можно доверять больше основной
+
+        Returns:
+            Категория, если текст похож на исправленный или модель уверена
+            в ответе; иначе None (решает основная модель)
+        """
+        category, confidence = self.predict_with_confidence(text)
+        if category is None:
+            return None
+        if confidence >= min_confidence or self.similarity(text) >= min_similarity:
+            return category
+        return None
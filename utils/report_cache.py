@@ -0,0 +1,73 @@
+"""
+Кэш готовых отчетов за период
+
+Отчет (PNG, xlsx и текст сводки) хранится по ключу (папка, период) вместе
+с версией журнала расходов. Повторный запрос без новых данных отдается из
+кэша без чтения CSV и построения графика; любое добавление, правка или
+удаление расхода меняет версию, и старый отчет больше не используется.
+"""
+import threading
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class ReportArtifact(NamedTuple):
+    """Готовый отчет"""
+    chart: bytes
+    excel: bytes
+    summary_text: str
+
+
+class ReportCache:
+    """LRU-кэш отчетов; на пару (папка, период) хранится только последняя версия"""
+
+    def __init__(self, max_entries: int = 128):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[str, Hashable], Tuple[Any, ReportArtifact]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, folder: str, period: Hashable, version: Any) -> Optional[ReportArtifact]:
+        """Возвращает отчет, если он построен по той же версии журнала"""
+        key = (folder, period)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, folder: str, period: Hashable, version: Any, artifact: ReportArtifact):
+        """Сохраняет отчет, вытесняя устаревшую версию и самые старые записи"""
+        key = (folder, period)
+        with self._lock:
+            self._entries[key] = (version, artifact)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, folder: str):
+        """Удаляет все отчеты папки"""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == folder]:
+                del self._entries[key]
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Статистика кэша"""
+        total = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total * 100, 2) if total else 0
+        }
+
+
+# Глобальный кэш отчетов
+report_cache = ReportCache()
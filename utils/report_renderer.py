@@ -0,0 +1,406 @@
+"""
+Построение отчетов за период вне event loop
+
+Графики matplotlib и Excel-файл строятся в ограниченном пуле процессов:
+обработчик только ждет готовые байты, а годовой отчет одного пользователя
+не останавливает остальные чаты. График и Excel одного отчета строятся
+параллельно.
+"""
+import asyncio
+import calendar
+import io
+import multiprocessing
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import matplotlib
+import matplotlib.pyplot as plt
+import pandas as pd
+
+from utils.ledger import iter_expenses
+
+logger = logging.getLogger(__name__)
+
+# Настройки matplotlib для высокого качества (как в основном процессе бота)
+RC_PARAMS = {
+    'figure.dpi': 300,
+    'savefig.dpi': 300,
+    'font.size': 12,
+    'axes.titlesize': 14,
+    'axes.labelsize': 12,
+    'xtick.labelsize': 10,
+    'ytick.labelsize': 10,
+    'legend.fontsize': 10,
+    'figure.titlesize': 16
+}
+
+# Строка отчета: (описание, категория, сумма, дата транзакции)
+ReportRow = Tuple[str, str, float, Any]
+
+COLUMNS = ['Описание', 'Категория', 'Сумма', 'Дата транзакции']
+
+
+def _init_worker():
+    """Инициализация процесса пула: без GUI-бэкенда, с настройками бота"""
+    matplotlib.use("Agg")
+    plt.rcParams.update(RC_PARAMS)
+
+
+def create_today_report(df, grouped_by_category, categories, amounts, total):
+    """Создание отчета за сегодня - красивый пирог с понятными тегами"""
+    fig, ax = plt.subplots(figsize=(12, 8))
+    fig.patch.set_facecolor('#1a1a1a')
+    
+    # Цветовая палитра
+    colors = ['#6B8E23', '#4682B4', '#CD853F', '#20B2AA', '#8A2BE2', '#32CD32', '#FF8C00', '#DC143C', '#1E90FF', '#9370DB']
+    
+    # Создаем красивый пирог
+    wedges, texts, autotexts = ax.pie(amounts, labels=categories, autopct='%1.1f%%', 
+                                      startangle=90, colors=colors[:len(amounts)],
+                                      textprops={'fontsize': 14, 'fontweight': 'bold', 'color': 'white'},
+                                      shadow=True, explode=[0.05] * len(amounts))
+    
+    # Настройка процентов
+    for autotext in autotexts:
+        autotext.set_color('white')
+        autotext.set_fontweight('bold')
+        autotext.set_fontsize(13)
+    
+    # Центральный текст
+    ax.text(0, 0, f'ОБЩИЕ\nРАСХОДЫ\n{total:.0f} Тг', ha='center', va='center', 
+            fontsize=20, fontweight='bold', color='white')
+    
+    ax.set_title('РАСХОДЫ ЗА СЕГОДНЯ', color='white', fontsize=22, fontweight='bold', pad=30)
+    
+    # Легенда справа
+    legend_labels = [f"{cat} — {amt:.0f} Тг" for cat, amt in zip(categories, amounts)]
+    ax.legend(wedges, legend_labels, title="Категории", loc="center left", 
+             bbox_to_anchor=(1.1, 0.5), fontsize=13, title_fontsize=15)
+    
+    return fig
+
+def create_week_report(df, grouped_by_category, categories, amounts, total):
+    """Создание отчета за неделю - только пирог категорий"""
+    fig = plt.figure(figsize=(12, 8))
+    fig.patch.set_facecolor('#1a1a1a')
+    
+    # Цветовая палитра
+    colors = ['#6B8E23', '#4682B4', '#CD853F', '#20B2AA', '#8A2BE2', '#32CD32', '#FF8C00', '#DC143C', '#1E90FF', '#9370DB']
+    
+    # Пирог категорий (полная ширина)
+    ax1 = fig.add_subplot(1, 1, 1)
+    wedges, texts, autotexts = ax1.pie(amounts, labels=None, autopct='%1.1f%%', 
+                                       startangle=90, colors=colors[:len(amounts)],
+                                       shadow=True, explode=[0.05] * len(amounts))
+    
+    # Настройка процентов
+    for autotext in autotexts:
+        autotext.set_color('white')
+        autotext.set_fontweight('bold')
+        autotext.set_fontsize(13)
+    
+    # Центральный текст
+    ax1.text(0, 0, f'ОБЩИЕ\nРАСХОДЫ\n{total:.0f} Тг', ha='center', va='center', 
+            fontsize=18, fontweight='bold', color='white')
+    
+    ax1.set_title('РАСХОДЫ ПО КАТЕГОРИЯМ', color='white', fontsize=18, fontweight='bold', pad=20)
+    
+    # Легенда для пирога
+    legend_labels = [f"{cat} — {amt:.0f} Тг" for cat, amt in zip(categories, amounts)]
+    ax1.legend(wedges, legend_labels, title="Категории", loc="center left", 
+              bbox_to_anchor=(1.0, 0.5), fontsize=12, title_fontsize=14)
+    
+    fig.suptitle('ОТЧЕТ ЗА НЕДЕЛЮ', color='white', fontsize=22, fontweight='bold', y=0.95)
+    
+    return fig
+
+def create_month_report(df, grouped_by_category, grouped_by_week, categories, amounts, total):
+    """Создание отчета за месяц - пирог и сравнение недель"""
+    fig = plt.figure(figsize=(16, 8))
+    fig.patch.set_facecolor('#1a1a1a')
+    
+    # Цветовая палитра
+    colors = ['#6B8E23', '#4682B4', '#CD853F', '#20B2AA', '#8A2BE2', '#32CD32', '#FF8C00', '#DC143C', '#1E90FF', '#9370DB']
+    
+    # 1. Пирог категорий (левая часть)
+    ax1 = fig.add_subplot(1, 2, 1)
+    wedges, texts, autotexts = ax1.pie(amounts, labels=None, autopct='%1.1f%%', 
+                                       startangle=90, colors=colors[:len(amounts)],
+                                       shadow=True, explode=[0.05] * len(amounts))
+    
+    for autotext in autotexts:
+        autotext.set_color('white')
+        autotext.set_fontweight('bold')
+        autotext.set_fontsize(13)
+    
+    ax1.text(0, 0, f'ОБЩИЕ\nРАСХОДЫ\n{total:.0f} Тг', ha='center', va='center', 
+            fontsize=16, fontweight='bold', color='white')
+    
+    ax1.set_title('РАСХОДЫ ПО КАТЕГОРИЯМ', color='white', fontsize=16, fontweight='bold', pad=20)
+    
+    # 2. Сравнение недель (правая часть)
+    ax2 = fig.add_subplot(1, 2, 2)
+    weeks = grouped_by_week['Неделя'].tolist()
+    week_amounts = grouped_by_week['Сумма'].tolist()
+    
+    bars = ax2.bar(weeks, week_amounts, color=colors[:len(weeks)], alpha=0.8)
+    ax2.set_title('СРАВНЕНИЕ НЕДЕЛЬ', color='white', fontsize=16, fontweight='bold', pad=20)
+    ax2.set_ylabel('Сумма (Тг)', color='white', fontsize=14)
+    ax2.set_xlabel('Номер недели', color='white', fontsize=14)
+    ax2.tick_params(colors='white')
+    ax2.grid(True, alpha=0.2, linestyle='--', linewidth=0.5)
+    
+    # Добавляем значения на столбцы
+    for bar, amount in zip(bars, week_amounts):
+        height = bar.get_height()
+        ax2.text(bar.get_x() + bar.get_width()/2., height + max(week_amounts)*0.01,
+                 f'{amount:.0f}', ha='center', va='bottom', color='white', fontweight='bold', fontsize=12)
+    
+    # Легенда для пирога
+    legend_labels = [f"{cat} — {amt:.0f} Тг" for cat, amt in zip(categories, amounts)]
+    ax1.legend(wedges, legend_labels, title="Категории", loc="upper left", 
+              bbox_to_anchor=(-0.1, 1.0), fontsize=11, title_fontsize=13)
+    
+    fig.suptitle('ОТЧЕТ ЗА МЕСЯЦ', color='white', fontsize=22, fontweight='bold', y=0.95)
+    
+    return fig
+
+def create_year_report(df, grouped_by_category, grouped_by_month, categories, amounts, total):
+    """Создание отчета за год - пирог и сравнение месяцев"""
+    fig = plt.figure(figsize=(16, 8))
+    fig.patch.set_facecolor('#1a1a1a')
+    
+    # Цветовая палитра
+    colors = ['#6B8E23', '#4682B4', '#CD853F', '#20B2AA', '#8A2BE2', '#32CD32', '#FF8C00', '#DC143C', '#1E90FF', '#9370DB']
+    
+    # 1. Пирог категорий (левая часть)
+    ax1 = fig.add_subplot(1, 2, 1)
+    wedges, texts, autotexts = ax1.pie(amounts, labels=None, autopct='%1.1f%%', 
+                                       startangle=90, colors=colors[:len(amounts)],
+                                       shadow=True, explode=[0.05] * len(amounts))
+    
+    for autotext in autotexts:
+        autotext.set_color('white')
+        autotext.set_fontweight('bold')
+        autotext.set_fontsize(13)
+    
+    ax1.text(0, 0, f'ОБЩИЕ\nРАСХОДЫ\n{total:.0f} Тг', ha='center', va='center', 
+            fontsize=16, fontweight='bold', color='white')
+    
+    ax1.set_title('РАСХОДЫ ПО КАТЕГОРИЯМ', color='white', fontsize=16, fontweight='bold', pad=20)
+    
+    # 2. Сравнение месяцев (правая часть)
+    ax2 = fig.add_subplot(1, 2, 2)
+    months = grouped_by_month['Месяц'].tolist()
+    month_amounts = grouped_by_month['Сумма'].tolist()
+    
+    bars = ax2.bar(months, month_amounts, color=colors[:len(months)], alpha=0.8)
+    ax2.set_title('СРАВНЕНИЕ МЕСЯЦЕВ', color='white', fontsize=16, fontweight='bold', pad=20)
+    ax2.set_ylabel('Сумма (Тг)', color='white', fontsize=14)
+    ax2.set_xlabel('Месяц', color='white', fontsize=14)
+    ax2.tick_params(colors='white')
+    ax2.grid(True, alpha=0.2, linestyle='--', linewidth=0.5)
+    
+    # Добавляем значения на столбцы
+    for bar, amount in zip(bars, month_amounts):
+        height = bar.get_height()
+        ax2.text(bar.get_x() + bar.get_width()/2., height + max(month_amounts)*0.01,
+                 f'{amount:.0f}', ha='center', va='bottom', color='white', fontweight='bold', fontsize=12)
+    
+    # Легенда для пирога
+    legend_labels = [f"{cat} — {amt:.0f} Тг" for cat, amt in zip(categories, amounts)]
+    ax1.legend(wedges, legend_labels, title="Категории", loc="upper left", 
+              bbox_to_anchor=(-0.1, 1.0), fontsize=11, title_fontsize=13)
+    
+    fig.suptitle('ОТЧЕТ ЗА ГОД', color='white', fontsize=22, fontweight='bold', y=0.95)
+    
+    return fig
+
+
+def build_frame(data: Sequence[ReportRow]) -> pd.DataFrame:
+    """DataFrame отчета с производными колонками месяца, дня недели и недели"""
+    df = pd.DataFrame(list(data), columns=COLUMNS)
+    dates = pd.to_datetime(df['Дата транзакции'])
+    df['Месяц'] = dates.dt.strftime('%b')
+    df['День недели'] = dates.dt.strftime('%a')
+    df['Неделя'] = dates.dt.isocalendar().week
+    return df
+
+
+def aggregate_rows(data: Sequence[ReportRow]) -> Dict[str, Any]:
+    """
+    Агрегаты для графиков по строкам отчета
+
+    Формат совпадает с utils.columnar.ColumnarStore.aggregate: категории и
+    суммы по убыванию, суммы по ISO-неделям и по месяцам (по порядку).
+    """
+    by_category: Dict[str, float] = {}
+    by_week: Dict[int, float] = {}
+    by_month: Dict[Tuple[int, int], float] = {}
+    for _, category, amount, transaction_date in data:
+        by_category[category] = by_category.get(category, 0.0) + amount
+        week = transaction_date.isocalendar()[1]
+        by_week[week] = by_week.get(week, 0.0) + amount
+        month = (transaction_date.year, transaction_date.month)
+        by_month[month] = by_month.get(month, 0.0) + amount
+    ranked = sorted(by_category.items(), key=lambda item: item[1], reverse=True)
+    return {
+        "categories": [category for category, _ in ranked],
+        "amounts": [amount for _, amount in ranked],
+        "total": sum(by_category.values()),
+        "transactions": len(data),
+        "weeks": sorted(by_week.items()),
+        "months": [(calendar.month_abbr[month], amount) for (_, month), amount in sorted(by_month.items())]
+    }
+
+
+def render_chart(aggregates: Dict[str, Any], period_text: str) -> bytes:
+    """Строит график отчета за период по агрегатам и возвращает PNG"""
+    categories = aggregates['categories']
+    amounts = aggregates['amounts']
+    total = aggregates['total']
+    grouped_by_category = pd.DataFrame({'Категория': categories, 'Сумма': amounts})
+
+    if 'сегодня' in period_text:
+        fig = create_today_report(None, grouped_by_category, categories, amounts, total)
+    elif 'неделя' in period_text:
+        fig = create_week_report(None, grouped_by_category, categories, amounts, total)
+    elif 'месяц' in period_text:
+        grouped_by_week = pd.DataFrame(aggregates['weeks'], columns=['Неделя', 'Сумма'])
+        fig = create_month_report(None, grouped_by_category, grouped_by_week, categories, amounts, total)
+    elif 'год' in period_text:
+        grouped_by_month = pd.DataFrame(aggregates['months'], columns=['Месяц', 'Сумма'])
+        fig = create_year_report(None, grouped_by_category, grouped_by_month, categories, amounts, total)
+    else:
+        # Fallback для неизвестных периодов
+        fig = create_today_report(None, grouped_by_category, categories, amounts, total)
+
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', bbox_inches='tight', dpi=150,
+                facecolor='#1a1a1a', edgecolor='none')
+    plt.close(fig)
+    return buf.getvalue()
+
+
+def render_chart_for_rows(data: Sequence[ReportRow], period_text: str) -> bytes:
+    """Строит график по строкам отчета (агрегаты считаются в процессе пула)"""
+    return render_chart(aggregate_rows(data), period_text)
+
+
+def render_excel(data: Sequence[ReportRow]) -> bytes:
+    """Строит Excel-файл с полными данными отчета"""
+    df = build_frame(data)
+    # Убираем timezone из datetime для совместимости с Excel
+    df['Дата транзакции'] = pd.to_datetime(df['Дата транзакции']).dt.strftime('%Y-%m-%d %H:%M:%S')
+    buf = io.BytesIO()
+    df.to_excel(buf, index=False, engine='xlsxwriter')
+    return buf.getvalue()
+
+
+def render_excel_from_ledger(expenses_file: str, start: Optional[date], end: Optional[date]) -> bytes:
+    """
+    Строит Excel по журналу за период
+
+    CSV журнала нужен только для экспорта (описания расходов), поэтому
+    строки разбираются здесь, в процессе пула, а не в обработчике.
+    """
+    data = [
+        (
+            row['description'],
+            row['category'],
+            float(row['amount']),
+            datetime.fromisoformat(row['transaction_date'].replace('Z', '+00:00'))
+        )
+        for row in iter_expenses(expenses_file, start, end)
+    ]
+    return render_excel(data)
+
+
+def summarize(data: Sequence[ReportRow]) -> Dict[str, Any]:
+    """Текстовая статистика отчета без pandas (дешево, считается в обработчике)"""
+    by_category: Dict[str, float] = {}
+    total = 0.0
+    for _, category, amount, _ in data:
+        by_category[category] = by_category.get(category, 0.0) + amount
+        total += amount
+    ranked = sorted(by_category.items(), key=lambda item: item[1], reverse=True)
+    return {
+        "total": total,
+        "average": total / len(data) if data else 0.0,
+        "transactions": len(data),
+        "categories": [category for category, _ in ranked],
+        "amounts": [amount for _, amount in ranked]
+    }
+
+
+class ReportRenderer:
+    """Ограниченный пул процессов с очередью запросов на построение отчетов"""
+
+    def __init__(self, max_workers: int = 2, max_pending: int = 8):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self.waiting = 0
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn: дочерний процесс не наследует потоки и соединения бота
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker
+            )
+        return self._executor
+
+    async def render(self, data: Optional[List[ReportRow]], period_text: str,
+                     aggregates: Optional[Dict[str, Any]] = None,
+                     ledger: Optional[Tuple[str, Optional[date], Optional[date]]] = None) -> Tuple[bytes, bytes]:
+        """
+        Строит график и Excel параллельно в пуле процессов
+
+        aggregates — готовые агрегаты для графика (например, из колоночного
+        хранилища); если не переданы, считаются по строкам отчета.
+        ledger — (журнал, начало, конец): строки для Excel читаются из
+        журнала в процессе пула, data тогда не нужен.
+
+        Не более max_pending отчетов находятся в пуле одновременно,
+        остальные запросы ждут своей очереди, не занимая event loop.
+
+        Returns:
+            (PNG графика, xlsx)
+        """
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_pending)
+        self.waiting += 1
+        acquired = False
+        try:
+            await self._slots.acquire()
+            acquired = True
+            self.waiting -= 1
+            loop = asyncio.get_running_loop()
+            executor = self._get_executor()
+            chart, excel = await asyncio.gather(
+                loop.run_in_executor(executor, render_chart, aggregates, period_text) if aggregates
+                else loop.run_in_executor(executor, render_chart_for_rows, data, period_text),
+                loop.run_in_executor(executor, render_excel_from_ledger, *ledger) if ledger
+                else loop.run_in_executor(executor, render_excel, data)
+            )
+            return chart, excel
+        finally:
+            if acquired:
+                self._slots.release()
+            else:
+                self.waiting -= 1
+
+    def shutdown(self):
+        """Останавливает пул процессов"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+# Глобальный пул построения отчетов
+report_renderer = ReportRenderer()
@@ -0,0 +1,77 @@
+"""
+Контекст обработки одного Telegram-апдейта
+
+Хранит результаты разрешения пользователя (группа, путь к папке,
+авторизация), чтобы в рамках одного апдейта они вычислялись один раз.
+"""
+import functools
+import logging
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class RequestContext:
+    """Результаты разрешения для пользователя в рамках одного апдейта"""
+
+    def __init__(self, user_id: Optional[int], update_id: Optional[int] = None):
+        self.user_id = user_id
+        self.update_id = update_id
+        self._values: Dict[str, Any] = {}
+
+    def get_or_resolve(self, key: str, resolver: Callable[[], Any]) -> Any:
+        """Возвращает сохраненное значение или вычисляет и сохраняет его"""
+        value = self._values.get(key, _MISSING)
+        if value is _MISSING:
+            value = resolver()
+            self._values[key] = value
+        return value
+
+    def invalidate(self, key: Optional[str] = None):
+        """Сбрасывает одно или все сохраненные значения"""
+        if key is None:
+            self._values.clear()
+        else:
+            self._values.pop(key, None)
+
+
+_current_context: ContextVar[Optional[RequestContext]] = ContextVar("finbot_request_context", default=None)
+
+
+def begin_request(user_id: Optional[int], update_id: Optional[int] = None) -> RequestContext:
+    """Создает новый контекст для апдейта и делает его текущим"""
+    context = RequestContext(user_id, update_id)
+    _current_context.set(context)
+    return context
+
+
+def get_request_context() -> Optional[RequestContext]:
+    """Возвращает контекст текущего апдейта (или None вне обработки апдейта)"""
+    return _current_context.get()
+
+
+def invalidate_request_context():
+    """Сбрасывает сохраненные значения после изменения групп или авторизации"""
+    context = _current_context.get()
+    if context is not None:
+        context.invalidate()
+
+
+def request_scoped(func: Callable) -> Callable:
+    """
+    Декоратор для функций вида f(user_id) -> значение
+
+    Если функция вызвана для пользователя текущего апдейта, результат
+    берется из контекста; для остальных пользователей вызов проходит как есть.
+    """
+    @functools.wraps(func)
+    def wrapper(user_id, *args, **kwargs):
+        context = _current_context.get()
+        if context is None or args or kwargs or context.user_id != user_id:
+            return func(user_id, *args, **kwargs)
+        return context.get_or_resolve(func.__name__, lambda: func(user_id))
+
+    return wrapper
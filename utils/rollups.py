@@ -0,0 +1,271 @@
+"""
+Инкрементальные агрегаты расходов по категориям
+
+Рядом с каждым журналом хранится expenses.csv.rollup.json с суммой и
+количеством расходов по корзинам день/неделя/месяц × категория. Корзины
+обновляются при добавлении, правке и удалении расхода, поэтому итоги за
+период считаются по числу корзин, а не по числу строк журнала.
+
+Каждая запись в журнал получает монотонный номер изменения; агрегаты
+помнят, какие номера уже учтены, поэтому изменение не теряется и не
+учитывается дважды при любом порядке вызовов record_change и пересчетов.
+"""
+import json
+import os
+import threading
+import logging
+from datetime import date, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from utils.ledger import CHANGE_SEQ_FIELD, iter_expenses, ledger_state, parse_transaction_date
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_SUFFIX = ".rollup.json"
+ROLLUP_VERSION = 2
+
+GRANULARITIES = ("day", "week", "month")
+
+# Корзина: категория -> [сумма, количество]
+Bucket = Dict[str, List[float]]
+
+
+def bucket_keys(day: date) -> Dict[str, str]:
+    """Ключи корзин дня, ISO-недели и месяца"""
+    iso_year, iso_week, _ = day.isocalendar()
+    return {
+        "day": day.isoformat(),
+        "week": f"{iso_year}-W{iso_week:02d}",
+        "month": f"{day.year}-{day.month:02d}"
+    }
+
+
+def _next_month(day: date) -> date:
+    return date(day.year + 1, 1, 1) if day.month == 12 else date(day.year, day.month + 1, 1)
+
+
+def cover_range(start: date, end: date) -> List[Tuple[str, str]]:
+    """
+    Покрывает интервал [start, end] минимальным набором корзин
+
+    Полные месяцы берутся целиком, затем полные ISO-недели, остаток — днями.
+    """
+    keys = []
+    current = start
+    while current <= end:
+        month_end = _next_month(current) - timedelta(days=1)
+        if current.day == 1 and month_end <= end:
+            keys.append(("month", bucket_keys(current)["month"]))
+            current = month_end + timedelta(days=1)
+        elif current.weekday() == 0 and current + timedelta(days=6) <= end:
+            keys.append(("week", bucket_keys(current)["week"]))
+            current += timedelta(days=7)
+        else:
+            keys.append(("day", current.isoformat()))
+            current += timedelta(days=1)
+    return keys
+
+
+class _Rollup:
+    """
+    Агрегаты одного журнала
+
+    applied_seq — все изменения с номерами до него учтены; applied_above —
+    учтенные номера после него (record_change пришли не по порядку);
+    source — отметка манифеста на момент, когда учтены все изменения.
+    """
+
+    def __init__(self, buckets: Optional[Dict[str, Dict[str, Bucket]]] = None, source: Tuple[int, int] = (0, 0),
+                 applied_seq: int = 0, applied_above: Iterable[int] = ()):
+        self.buckets: Dict[str, Dict[str, Bucket]] = buckets or {granularity: {} for granularity in GRANULARITIES}
+        self.source = source
+        self.applied_seq = applied_seq
+        self.applied_above = set(applied_above)
+
+    def is_applied(self, seq: int) -> bool:
+        return seq <= self.applied_seq or seq in self.applied_above
+
+    def mark_applied(self, seq: int):
+        self.applied_above.add(seq)
+        while self.applied_seq + 1 in self.applied_above:
+            self.applied_seq += 1
+            self.applied_above.discard(self.applied_seq)
+
+    def add(self, day: date, category: str, amount: float, sign: int):
+        for granularity, key in bucket_keys(day).items():
+            bucket = self.buckets[granularity].setdefault(key, {})
+            totals = bucket.setdefault(category, [0.0, 0])
+            totals[0] = round(totals[0] + sign * amount, 2)
+            totals[1] += sign
+            if totals[1] <= 0:
+                del bucket[category]
+                if not bucket:
+                    del self.buckets[granularity][key]
+
+
+def _row_parts(row: Dict[str, Any]) -> Optional[Tuple[date, str, float]]:
+    day = parse_transaction_date(row.get('transaction_date'))
+    category = row.get('category')
+    try:
+        amount = float(row.get('amount'))
+    except (TypeError, ValueError):
+        return None
+    if day is None or not category:
+        return None
+    return day, category, amount
+
+
+class ExpenseRollups:
+    """Агрегаты расходов по журналам пользователей и групп"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._rollups: Dict[str, _Rollup] = {}
+
+    # --- Хранение ---
+
+    def _path(self, expenses_file: str) -> str:
+        return expenses_file + ROLLUP_SUFFIX
+
+    def _rebuild(self, expenses_file: str) -> _Rollup:
+        """
+        Пересчитывает агрегаты полным проходом по журналу
+
+        Если во время прохода журнал изменился, проход повторяется: номер
+        изменения агрегатов должен точно соответствовать прочитанным строкам.
+        """
+        while True:
+            seq, stamp = ledger_state(expenses_file)
+            rollup = _Rollup(source=stamp, applied_seq=seq)
+            for row in iter_expenses(expenses_file):
+                parts = _row_parts(row)
+                if parts:
+                    rollup.add(*parts, sign=1)
+            if ledger_state(expenses_file) == (seq, stamp):
+                break
+        self._save(expenses_file, rollup)
+        logger.info(f"Агрегаты расходов пересчитаны: {expenses_file}")
+        return rollup
+
+    def _save(self, expenses_file: str, rollup: _Rollup):
+        path = self._path(expenses_file)
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({"version": ROLLUP_VERSION, "source": list(rollup.source),
+                           "applied_seq": rollup.applied_seq, "applied_above": sorted(rollup.applied_above),
+                           "buckets": rollup.buckets}, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения агрегатов {path}: {e}")
+
+    def _load(self, expenses_file: str) -> Optional[_Rollup]:
+        path = self._path(expenses_file)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get("version") != ROLLUP_VERSION:
+                return None
+            return _Rollup(data["buckets"], tuple(data["source"]), data["applied_seq"], data["applied_above"])
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать агрегаты {path}: {e}")
+            return None
+
+    def _get(self, expenses_file: str) -> _Rollup:
+        """
+        Актуальные агрегаты
+
+        Пересчитываются, если учтены не все изменения журнала (запись еще не
+        дошла до record_change или record_change не случился) или журнал
+        изменен в обход бота.
+        """
+        key = os.path.normpath(expenses_file)
+        rollup = self._rollups.get(key) or self._load(expenses_file)
+        if rollup is None or (rollup.applied_seq, rollup.source) != ledger_state(expenses_file):
+            rollup = self._rebuild(expenses_file)
+        self._rollups[key] = rollup
+        return rollup
+
+    # --- Обновление ---
+
+    def record_change(self, expenses_file: str, old_row: Optional[Dict[str, Any]], new_row: Optional[Dict[str, Any]]):
+        """
+        Учитывает запись в журнал, уже выполненную вызывающим кодом
+
+        Добавление: old_row=None; удаление: new_row=None; правка суммы или
+        категории: обе строки.
+        """
+        self.record_changes(expenses_file, [(old_row, new_row)])
+
+    def record_changes(self, expenses_file: str,
+                       changes: List[Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]]):
+        """
+        Учитывает пачку изменений [(old_row, new_row)] с одним сохранением агрегатов
+
+        Строки несут номер изменения журнала (CHANGE_SEQ_FIELD); изменение,
+        уже учтенное пересчетом или повторным вызовом, пропускается.
+        """
+        with self._lock:
+            key = os.path.normpath(expenses_file)
+            rollup = self._rollups.get(key) or self._load(expenses_file)
+            if rollup is None:
+                # Агрегатов еще нет — полный проход уже учтет изменение
+                self._rollups[key] = self._rebuild(expenses_file)
+                return
+            applied = set()
+            for old_row, new_row in changes:
+                seq = (new_row or old_row or {}).get(CHANGE_SEQ_FIELD)
+                if seq is not None and rollup.is_applied(seq):
+                    continue
+                for row, sign in ((old_row, -1), (new_row, 1)):
+                    parts = _row_parts(row) if row else None
+                    if parts:
+                        rollup.add(*parts, sign=sign)
+                if seq is not None:
+                    applied.add(seq)
+            for seq in applied:
+                rollup.mark_applied(seq)
+            current_seq, stamp = ledger_state(expenses_file)
+            if rollup.applied_seq == current_seq:
+                rollup.source = stamp
+            self._rollups[key] = rollup
+            self._save(expenses_file, rollup)
+
+    # --- Запросы ---
+
+    def category_totals(self, expenses_file: str, start: date, end: date) -> List[Tuple[str, float, int]]:
+        """
+        Суммы и количество расходов по категориям за период
+
+        Returns:
+            [(категория, сумма, количество)] по убыванию суммы
+        """
+        with self._lock:
+            rollup = self._get(expenses_file)
+            totals: Dict[str, List[float]] = {}
+            for granularity, key in cover_range(start, end):
+                for category, (amount, count) in rollup.buckets[granularity].get(key, {}).items():
+                    item = totals.setdefault(category, [0.0, 0])
+                    item[0] += amount
+                    item[1] += count
+        ranked = sorted(totals.items(), key=lambda item: item[1][0], reverse=True)
+        return [(category, round(amount, 2), int(count)) for category, (amount, count) in ranked]
+
+    def period_summary(self, expenses_file: str, start: date, end: date) -> Dict[str, Any]:
+        """Итоги за период в формате utils.report_renderer.summarize"""
+        totals = self.category_totals(expenses_file, start, end)
+        total = sum(amount for _, amount, _ in totals)
+        transactions = sum(count for _, _, count in totals)
+        return {
+            "total": total,
+            "average": total / transactions if transactions else 0.0,
+            "transactions": transactions,
+            "categories": [category for category, _, _ in totals],
+            "amounts": [amount for _, amount, _ in totals]
+        }
+
+
+# Глобальные агрегаты расходов
+expense_rollups = ExpenseRollups()
@@ -0,0 +1,307 @@
+"""
+Отложенная синхронизация изменений в PostgreSQL
+
+Файлы пользователя — основное хранилище, PostgreSQL — копия. Раньше каждая
+запись в файл сразу вызывала sync_to_database: соединение, один запрос и
+commit на пути ответа пользователю. Теперь изменение дописывается в
+локальный журнал sync_spool/ (с fsync, поэтому переживает перезапуск), а
+фоновая задача забирает записи пачками и применяет их одной транзакцией.
+Повторные изменения одной сущности схлопываются, при недоступной БД пачка
+повторяется с растущей паузой.
+
+Журнал только дописывается: записи лежат в сегментах pending-NNNNNN.jsonl,
+а номер последней примененной записи хранится в consumed.json. Разбор
+журнала не перезаписывает оставшийся хвост — полностью примененные
+сегменты просто удаляются.
+"""
+import asyncio
+import glob
+import json
+import os
+import threading
+import time
+import logging
+from datetime import date, datetime
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+SPOOL_DIR = os.environ.get("SYNC_SPOOL_DIR", "sync_spool")
+SEGMENT_PREFIX = "pending-"
+# Единый файл журнала прежних версий; дочитывается как первый сегмент
+LEGACY_NAME = "pending.jsonl"
+CONSUMED_NAME = "consumed.json"
+# Записей в одном сегменте журнала
+SEGMENT_RECORDS = 10000
+BATCH_SIZE = 100
+IDLE_INTERVAL = 5.0
+MIN_BACKOFF = 1.0
+MAX_BACKOFF = 300.0
+
+
+def _json_default(value: Any) -> Any:
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return str(value)
+
+
+def entity_key(record: Dict[str, Any]) -> Optional[str]:
+    """
+    Ключ сущности для схлопывания повторных изменений
+
+    Удаления схлопываются по ID сущности, план бюджета — по месяцу
+    (_apply_sync_change в bot.py пишет его через ON CONFLICT (plan_month)
+    DO UPDATE, поэтому важно только последнее значение). Добавления расходов, напоминаний и
+    статей не имеют общего ID с БД и не схлопываются.
+    """
+    data = record.get("data") or {}
+    prefix = f"{record['data_type']}:{record.get('user_id')}"
+    if record["action"] == "delete":
+        ids = [f"{name}={data[name]}" for name in sorted(data) if name.endswith("_id")]
+        return f"{prefix}:delete:{','.join(ids)}" if ids else None
+    if record["data_type"] == "budget_plan" and record["action"] == "add":
+        return f"{prefix}:month:{data.get('plan_month')}"
+    return None
+
+
+def coalesce(records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Оставляет последнее изменение каждой сущности, сохраняя порядок"""
+    last = {}
+    for index, record in enumerate(records):
+        key = entity_key(record)
+        if key is not None:
+            last[key] = index
+    return [record for index, record in enumerate(records)
+            if (key := entity_key(record)) is None or last[key] == index]
+
+
+class SyncSpool:
+    """Журнал изменений для PostgreSQL и фоновая задача, которая его разбирает"""
+
+    def __init__(self, spool_dir: str = SPOOL_DIR, batch_size: int = BATCH_SIZE,
+                 segment_records: int = SEGMENT_RECORDS):
+        self.spool_dir = spool_dir
+        self.batch_size = batch_size
+        self.segment_records = segment_records
+        # _lock — очередь в памяти и дописывание сегмента (его берет enqueue);
+        # _drain_lock — отметка применения и удаление сегментов
+        self._lock = threading.Lock()
+        self._drain_lock = threading.Lock()
+        self._pending: Optional[Deque[Dict[str, Any]]] = None
+        # Сегменты по порядку: [путь, seq последней записи, число записей]
+        self._segments: List[list] = []
+        self._next_segment = 1
+        self._seq = 0
+        self._consumed = 0
+        self._apply: Optional[Callable[[List[Dict[str, Any]]], Any]] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stats = {"enqueued": 0, "applied": 0, "coalesced": 0, "batches": 0, "failures": 0}
+
+    # --- Журнал ---
+
+    def _segment_path(self, number: int) -> str:
+        return os.path.join(self.spool_dir, f"{SEGMENT_PREFIX}{number:06d}.jsonl")
+
+    def _read_consumed(self) -> int:
+        path = os.path.join(self.spool_dir, CONSUMED_NAME)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return int(json.load(f)["seq"])
+        except FileNotFoundError:
+            return 0
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать отметку журнала синхронизации {path}: {e}")
+            return 0
+
+    def _write_consumed(self, seq: int):
+        """Сохраняет номер последней примененной записи (маленький файл, с fsync)"""
+        os.makedirs(self.spool_dir, exist_ok=True)
+        path = os.path.join(self.spool_dir, CONSUMED_NAME)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"seq": seq}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _load(self) -> Deque[Dict[str, Any]]:
+        """Еще не примененные записи, в том числе с прошлого запуска (под self._lock)"""
+        if self._pending is None:
+            self._pending = deque()
+            self._consumed = self._read_consumed()
+            self._seq = self._consumed
+            finished = []
+            paths = sorted(glob.glob(os.path.join(self.spool_dir, f"{SEGMENT_PREFIX}*.jsonl")))
+            if paths:
+                self._next_segment = int(os.path.basename(paths[-1])[len(SEGMENT_PREFIX):-len(".jsonl")]) + 1
+            legacy_path = os.path.join(self.spool_dir, LEGACY_NAME)
+            if os.path.exists(legacy_path):
+                paths.insert(0, legacy_path)
+            for path in paths:
+                last_seq, count = 0, 0
+                with open(path, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except json.JSONDecodeError:
+                            # Оборванная последняя строка после сбоя
+                            logger.warning(f"Пропущена поврежденная запись журнала синхронизации {path}")
+                            continue
+                        last_seq = max(last_seq, record.get("seq", 0))
+                        count += 1
+                        if record.get("seq", 0) > self._consumed:
+                            self._pending.append(record)
+                self._seq = max(self._seq, last_seq)
+                if last_seq <= self._consumed:
+                    finished.append(path)
+                else:
+                    self._segments.append([path, last_seq, count])
+            for path in finished:
+                os.remove(path)
+            if self._pending:
+                logger.info(f"В журнале синхронизации {len(self._pending)} неотправленных изменений")
+        return self._pending
+
+    def enqueue(self, user_id: Any, data_type: str, action: str, data: Optional[Dict[str, Any]] = None):
+        """Добавляет изменение в журнал; БД не трогается"""
+        self.enqueue_many([(user_id, data_type, action, data)])
+
+    def enqueue_many(self, changes: List[tuple]):
+        """Добавляет пачку изменений [(user_id, data_type, action, data)] одной записью в файл"""
+        if not changes:
+            return
+        with self._lock:
+            pending = self._load()
+            records = []
+            for user_id, data_type, action, data in changes:
+                self._seq += 1
+                records.append({
+                    "seq": self._seq,
+                    "user_id": user_id,
+                    "data_type": data_type,
+                    "action": action,
+                    "data": json.loads(json.dumps(data or {}, ensure_ascii=False, default=_json_default)),
+                    "queued_at": time.time()
+                })
+            if (not self._segments or self._segments[-1][2] >= self.segment_records
+                    or self._segments[-1][0].endswith(LEGACY_NAME)):
+                self._segments.append([self._segment_path(self._next_segment), 0, 0])
+                self._next_segment += 1
+            segment = self._segments[-1]
+            os.makedirs(self.spool_dir, exist_ok=True)
+            with open(segment[0], 'a', encoding='utf-8') as f:
+                for record in records:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            segment[1] = self._seq
+            segment[2] += len(records)
+            pending.extend(records)
+            self._stats["enqueued"] += len(records)
+        self._notify()
+
+    def _notify(self):
+        loop, wakeup = self._loop, self._wakeup
+        if loop is not None and wakeup is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(wakeup.set)
+
+    # --- Применение ---
+
+    def drain_once(self) -> int:
+        """
+        Применяет одну пачку (выполняется в потоке)
+
+        Returns:
+            Количество примененных записей; исключение — пачка осталась в журнале
+        """
+        with self._drain_lock:
+            with self._lock:
+                pending = self._load()
+                batch = [pending[index] for index in range(min(self.batch_size, len(pending)))]
+            if not batch or self._apply is None:
+                return 0
+            merged = coalesce(batch)
+            self._apply(merged)
+            # Отметка пишется без self._lock: enqueue не ждет fsync разбора
+            self._write_consumed(batch[-1]["seq"])
+            with self._lock:
+                self._consumed = batch[-1]["seq"]
+                for _ in batch:
+                    self._pending.popleft()
+                # Полностью примененные сегменты, кроме текущего (в него еще дописывают)
+                finished = []
+                while len(self._segments) > 1 and self._segments[0][1] <= self._consumed:
+                    finished.append(self._segments.pop(0)[0])
+                self._stats["applied"] += len(merged)
+                self._stats["coalesced"] += len(batch) - len(merged)
+                self._stats["batches"] += 1
+            for path in finished:
+                os.remove(path)
+        return len(merged)
+
+    def start(self, apply_batch: Callable[[List[Dict[str, Any]]], Any]):
+        """
+        Запускает фоновую задачу в текущем event loop
+
+        Args:
+            apply_batch: Применяет список записей одной транзакцией; при
+                ошибке соединения должна бросить исключение
+        """
+        self._apply = apply_batch
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        backoff = MIN_BACKOFF
+        while True:
+            try:
+                applied = await asyncio.to_thread(self.drain_once)
+                backoff = MIN_BACKOFF
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._stats["failures"] += 1
+                logger.warning(f"Синхронизация с PostgreSQL не удалась, повтор через {backoff:.0f} с: {e}")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, MAX_BACKOFF)
+                continue
+            if applied:
+                # Возможно, в журнале есть еще записи — берем следующую пачку сразу
+                continue
+            self._wakeup.clear()
+            with self._lock:
+                has_pending = bool(self._load())
+            if has_pending:
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=IDLE_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def stop(self):
+        """Останавливает фоновую задачу; неотправленные записи остаются в журнале"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._loop = None
+        self._wakeup = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Статистика журнала синхронизации"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["pending"] = len(self._load())
+        return stats
+
+
+# Глобальный журнал синхронизации с PostgreSQL
+sync_spool = SyncSpool()
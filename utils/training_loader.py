@@ -0,0 +1,336 @@
+"""
+Инкрементальная загрузка обучающих данных (описание, категория)
+
+Помесячные файлы журналов пользователей и групп читаются параллельно и потоково,
+пары дедуплицируются со счетчиками. Для каждого файла хранится водяной
+знак (смещение в байтах и последний ID), поэтому повторная загрузка
+читает только строки, добавленные после прошлого запуска.
+
+Правки уже прочитанных строк (apply_change) не пересохраняют все состояние:
+каждая дописывается в маленький журнал рядом с ним (.deltas.jsonl, с
+fsync) и при запуске накладывается на сохраненное состояние.
+"""
+import csv
+import json
+import os
+import threading
+import logging
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from utils.ledger import load_changes, partition_files, partitions_dir
+
+logger = logging.getLogger(__name__)
+
+STATE_VERSION = 1
+DELTAS_SUFFIX = ".deltas.jsonl"
+
+Pair = Tuple[str, str]
+
+# Функция инкрементального чтения из БД: last_id -> [(описание, категория, количество, max_id)]
+DbFetcher = Callable[[int], Sequence[Tuple[str, str, int, int]]]
+
+
+class _SourceState:
+    """Водяной знак и счетчики пар одного файла расходов"""
+
+    def __init__(self, offset: int = 0, last_id: int = 0, counts: Optional[Counter] = None, tail: str = ""):
+        self.offset = offset
+        self.last_id = last_id
+        self.counts: Counter = counts if counts is not None else Counter()
+        # Последняя прочитанная строка: по ней видно, что файл был переписан
+        self.tail = tail
+
+    def to_json(self) -> dict:
+        return {
+            "offset": self.offset,
+            "last_id": self.last_id,
+            "tail": self.tail,
+            "counts": [[description, category, count] for (description, category), count in self.counts.items()]
+        }
+
+    @classmethod
+    def from_json(cls, data: dict) -> "_SourceState":
+        counts = Counter({(description, category): count for description, category, count in data.get("counts", [])})
+        return cls(data.get("offset", 0), data.get("last_id", 0), counts, data.get("tail", ""))
+
+
+def _iter_lines(f, consumed: List[int], last_line: List[bytes]) -> Iterator[str]:
+    """Отдает только завершенные строки файла и считает прочитанные байты"""
+    for raw in f:
+        if not raw.endswith(b"\n"):
+            # Строка еще дописывается — прочитаем ее в следующий раз
+            return
+        consumed[0] += len(raw)
+        last_line[0] = raw
+        yield raw.decode("utf-8")
+
+
+def _watermark_valid(f, state: _SourceState, size: int) -> bool:
+    """Проверяет, что строки до водяного знака не сдвинулись (файл только дописывался)"""
+    if state.offset == 0:
+        return True
+    if size < state.offset:
+        return False
+    tail = state.tail.encode("utf-8")
+    if not tail:
+        return True
+    f.seek(state.offset - len(tail))
+    return f.read(len(tail)) == tail
+
+
+def _read_source(path: str, state: Optional[_SourceState]) -> _SourceState:
+    """
+    Дочитывает файл расходов от водяного знака
+
+    К новым строкам применяются правки и удаления из журнала изменений месяца;
+    строки до водяного знака поправляются через TrainingDataLoader.apply_change.
+    """
+    size = os.path.getsize(path)
+    changes = load_changes(path)
+
+    with open(path, "rb") as f:
+        if state is None or not _watermark_valid(f, state, size):
+            # Новый файл или файл переписан — читаем заново
+            state = _SourceState()
+        f.seek(0)
+        header_line = f.readline()
+        if not header_line.endswith(b"\n"):
+            return state
+        fieldnames = next(csv.reader([header_line.decode("utf-8-sig")]))
+        offset = max(state.offset, len(header_line))
+        f.seek(offset)
+
+        consumed = [offset]
+        last_line = [state.tail.encode("utf-8")]
+        new_offset = offset
+        reader = csv.DictReader(_iter_lines(f, consumed, last_line), fieldnames=fieldnames)
+        for row in reader:
+            new_offset = consumed[0]
+            state.tail = last_line[0].decode("utf-8")
+            row_id = (row.get("id") or "").strip()
+            if row_id in changes:
+                if changes[row_id] is None:
+                    row = {}
+                else:
+                    row = {**row, **changes[row_id]}
+            description, category = row.get("description"), row.get("category")
+            if description and category:
+                state.counts[(description, category)] += 1
+            if row_id.isdigit():
+                state.last_id = max(state.last_id, int(row_id))
+        state.offset = new_offset
+    return state
+
+
+class TrainingDataLoader:
+    """Загрузчик обучающих данных с водяными знаками по источникам"""
+
+    def __init__(self, roots: Sequence[str] = ("users", "user_data", "group_data"),
+                 state_path: str = "model_cache/training_state.json", max_workers: int = 4):
+        self.roots = tuple(roots)
+        self.state_path = state_path
+        self.max_workers = max_workers
+        self._lock = threading.RLock()
+        self._sources: Optional[Dict[str, _SourceState]] = None
+        self._db_state = _SourceState()
+        self.deltas_path = state_path + DELTAS_SUFFIX
+        # Номер последней правки apply_change; сохраненное состояние помнит,
+        # до какого номера правки в нем уже учтены
+        self._delta_seq = 0
+        # Правки после последнего сохранения (сохраняются в refresh или flush)
+        self._dirty = False
+
+    # --- Состояние ---
+
+    def _load_state(self):
+        if self._sources is not None:
+            return
+        self._sources = {}
+        if os.path.exists(self.state_path):
+            try:
+                with open(self.state_path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                if data.get("version") == STATE_VERSION:
+                    self._sources = {path: _SourceState.from_json(item)
+                                     for path, item in data.get("sources", {}).items()}
+                    self._db_state = _SourceState.from_json(data.get("database", {}))
+                    self._delta_seq = data.get("delta_seq", 0)
+            except Exception as e:
+                logger.warning(f"Не удалось прочитать состояние загрузчика {self.state_path}: {e}")
+                self._sources = {}
+        self._replay_deltas()
+
+    def _replay_deltas(self):
+        """Накладывает правки, не вошедшие в сохраненное состояние (после сбоя)"""
+        if not os.path.exists(self.deltas_path):
+            return
+        saved_seq, replayed = self._delta_seq, 0
+        with open(self.deltas_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    delta = json.loads(line)
+                except json.JSONDecodeError:
+                    # Оборванная последняя строка после сбоя
+                    continue
+                self._delta_seq = max(self._delta_seq, delta["seq"])
+                state = self._sources.get(delta["path"])
+                if delta["seq"] <= saved_seq or state is None:
+                    continue
+                self._apply_delta(state, tuple(delta["old"]) if delta["old"] else None,
+                                  tuple(delta["new"]) if delta["new"] else None)
+                replayed += 1
+        if replayed:
+            self._dirty = True
+            logger.info(f"Загрузчик обучающих данных: восстановлено {replayed} правок из {self.deltas_path}")
+
+    def _save_state(self):
+        self._dirty = False
+        data = {
+            "version": STATE_VERSION,
+            "sources": {path: state.to_json() for path, state in self._sources.items()},
+            "database": self._db_state.to_json(),
+            "delta_seq": self._delta_seq
+        }
+        directory = os.path.dirname(self.state_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.state_path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.state_path)
+            # Правки вошли в состояние; сбой до удаления журнала безопасен (delta_seq)
+            if os.path.exists(self.deltas_path):
+                os.remove(self.deltas_path)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения состояния загрузчика: {e}")
+
+    # --- Загрузка ---
+
+    def discover_sources(self) -> List[str]:
+        """Находит помесячные файлы журналов в папках пользователей и групп"""
+        sources = []
+        for root in self.roots:
+            if not os.path.isdir(root):
+                continue
+            for entry in os.scandir(root):
+                if entry.is_dir():
+                    expenses_file = os.path.join(entry.path, "expenses.csv")
+                    if os.path.exists(expenses_file) or os.path.isdir(partitions_dir(expenses_file)):
+                        sources.extend(partition_files(expenses_file))
+        return sources
+
+    def _read_database(self, db_fetcher: DbFetcher):
+        try:
+            rows = db_fetcher(self._db_state.last_id)
+        except Exception as e:
+            logger.error(f"Ошибка при получении данных из PostgreSQL для обучения: {e}")
+            return
+        for description, category, count, max_id in rows:
+            if description and category:
+                self._db_state.counts[(description, category)] += int(count)
+            if max_id is not None:
+                self._db_state.last_id = max(self._db_state.last_id, int(max_id))
+        if rows:
+            logger.info(f"Добавлено {len(rows)} уникальных пар из PostgreSQL для обучения")
+
+    def refresh(self, db_fetcher: Optional[DbFetcher] = None) -> int:
+        """
+        Дочитывает новые строки из всех источников параллельно
+
+        Returns:
+            Количество новых (прочитанных в этот раз) записей
+        """
+        with self._lock:
+            self._load_state()
+            sources = self.discover_sources()
+            before = self.total_count()
+
+            def read(path: str) -> Tuple[str, Optional[_SourceState]]:
+                try:
+                    return path, _read_source(path, self._sources.get(path))
+                except Exception as e:
+                    logger.error(f"Ошибка при чтении файла расходов {path}: {e}")
+                    return path, self._sources.get(path)
+
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                db_future = executor.submit(self._read_database, db_fetcher) if db_fetcher else None
+                results = list(executor.map(read, sources))
+                if db_future:
+                    db_future.result()
+
+            current = set(sources)
+            self._sources = {path: state for path, state in results if state is not None}
+            # Удаленные папки больше не участвуют в обучении
+            for path in list(self._sources):
+                if path not in current:
+                    del self._sources[path]
+
+            self._save_state()
+            added = self.total_count() - before
+            logger.info(f"Загрузчик обучающих данных: {len(sources)} файлов, новых записей: {added}")
+            return added
+
+    def apply_change(self, path: str, expense_id: int, old_pair: Optional[Pair], new_pair: Optional[Pair]):
+        """
+        Учитывает изменение или удаление уже прочитанной строки
+
+        Строки после водяного знака будут прочитаны при следующем refresh
+        уже в новом виде, поэтому для них ничего не делается. Правка сразу
+        дописывается в журнал правок, а все состояние сохраняется на диск
+        при следующем refresh или flush.
+        """
+        with self._lock:
+            self._load_state()
+            state = self._sources.get(path)
+            if state is None or expense_id is None or int(expense_id) > state.last_id:
+                return
+            self._apply_delta(state, old_pair, new_pair)
+            self._delta_seq += 1
+            delta = {"seq": self._delta_seq, "path": path, "old": old_pair, "new": new_pair}
+            try:
+                with open(self.deltas_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(delta, ensure_ascii=False) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+            except Exception as e:
+                logger.error(f"Ошибка записи правки загрузчика в {self.deltas_path}: {e}")
+            # Состояние всех файлов не пересохраняется на каждую правку
+            self._dirty = True
+
+    @staticmethod
+    def _apply_delta(state: _SourceState, old_pair: Optional[Pair], new_pair: Optional[Pair]):
+        if old_pair and old_pair[0] and old_pair[1] and state.counts.get(old_pair, 0) > 0:
+            state.counts[old_pair] -= 1
+            if state.counts[old_pair] <= 0:
+                del state.counts[old_pair]
+        if new_pair and new_pair[0] and new_pair[1]:
+            state.counts[new_pair] += 1
+
+    def flush(self):
+        """Сохраняет состояние, если после сохранения были правки (при завершении бота)"""
+        with self._lock:
+            if self._dirty:
+                self._save_state()
+
+    def iter_pairs(self) -> Iterator[Tuple[str, str, int]]:
+        """Отдает уникальные пары (описание, категория, количество)"""
+        with self._lock:
+            self._load_state()
+            merged = Counter(self._db_state.counts)
+            for state in self._sources.values():
+                merged.update(state.counts)
+        for (description, category), count in merged.items():
+            if count > 0:
+                yield description, category, count
+
+    def total_count(self) -> int:
+        """Общее количество записей во всех источниках"""
+        self._load_state()
+        return sum(self._db_state.counts.values()) + sum(sum(state.counts.values()) for state in self._sources.values())
+
+
+# Глобальный загрузчик обучающих данных
+training_loader = TrainingDataLoader()
@@ -0,0 +1,88 @@
+"""
+Обучение классификатора расходов в отдельном процессе
+
+Обучение sklearn-модели занимает секунды и блокирует event loop, поэтому
+обработчики бота отправляют его в пул процессов и только ждут результат.
+"""
+import asyncio
+import multiprocessing
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.linear_model import LogisticRegression
+
+from utils.online_classifier import OnlineClassifier
+
+logger = logging.getLogger(__name__)
+
+
+def fit_models(descriptions: List[str], categories: List[str],
+               vectorizer_params: Dict[str, Any], classifier_params: Dict[str, Any],
+               online_classes: Optional[List[str]] = None,
+               weights: Optional[List[float]] = None) -> Tuple[Any, Any, Optional[OnlineClassifier]]:
+    """
+    Обучает векторизатор и классификатор (выполняется в дочернем процессе)
+
+    Если передан online_classes, на тех же данных обучается и онлайн-модель,
+    которую потом можно дообучать на исправлениях. weights — веса примеров
+    (количество повторов пары описание/категория).
+    """
+    vectorizer = TfidfVectorizer(**vectorizer_params)
+    classifier = LogisticRegression(**classifier_params)
+    X = vectorizer.fit_transform(descriptions)
+    classifier.fit(X, categories, sample_weight=weights)
+
+    online_model = None
+    if online_classes is not None:
+        online_model = OnlineClassifier()
+        online_model.fit(descriptions, categories, classes=online_classes, weights=weights)
+    return vectorizer, classifier, online_model
+
+
+class ModelTrainer:
+    """Пул из одного процесса для обучения; одновременно выполняется одно обучение"""
+
+    def __init__(self, max_workers: int = 1):
+        self.max_workers = max_workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock: Optional[asyncio.Lock] = None
+        self.running = False
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn: дочерний процесс не наследует потоки и соединения бота
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._executor
+
+    async def fit(self, descriptions: List[str], categories: List[str],
+                  vectorizer_params: Dict[str, Any], classifier_params: Dict[str, Any],
+                  online_classes: Optional[List[str]] = None,
+                  weights: Optional[List[float]] = None) -> Tuple[Any, Any, Optional[OnlineClassifier]]:
+        """Обучает модель в пуле процессов, не блокируя event loop"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            self.running = True
+            try:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(
+                    self._get_executor(), fit_models,
+                    descriptions, categories, vectorizer_params, classifier_params, online_classes, weights
+                )
+            finally:
+                self.running = False
+
+    def shutdown(self):
+        """Останавливает пул процессов"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+# Глобальный пул обучения модели
+model_trainer = ModelTrainer()
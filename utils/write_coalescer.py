@@ -0,0 +1,122 @@
+"""
+Групповая запись расходов
+
+Когда несколько участников группы добавляют расходы в одну секунду, каждый
+расход отдельно дописывался в журнал (со своим fsync) и отдельно открывал
+соединение с PostgreSQL. Коалесцер собирает расходы одной папки за короткое
+окно (EXPENSE_BATCH_WINDOW_MS, по умолчанию 30 мс) и записывает их одной
+пачкой: одна запись в файл месяца, одно обновление агрегатов и одна пачка
+в БД. Каждый вызывающий получает свою строку журнала, как только пачка
+надежно записана на диск и поставлена в синхронизацию с БД.
+"""
+import asyncio
+import os
+import logging
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from utils.folder_locks import folder_locks
+from utils.ledger import append_expenses
+from utils.rollups import expense_rollups
+
+logger = logging.getLogger(__name__)
+
+BATCH_WINDOW_MS = int(os.environ.get("EXPENSE_BATCH_WINDOW_MS", 30))
+MAX_BATCH_SIZE = 100
+
+# Ожидающая запись: (user_id, расход, future вызывающего)
+_Pending = Tuple[Any, Dict[str, Any], asyncio.Future]
+
+
+class WriteCoalescer:
+    """Пачки расходов по папкам с окном ожидания"""
+
+    def __init__(self, window_ms: int = BATCH_WINDOW_MS, max_batch: int = MAX_BATCH_SIZE):
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self._pending: Dict[str, List[_Pending]] = {}
+        self._flushers: Dict[str, asyncio.Task] = {}
+        self._batch_sync: Optional[Callable[[List[Tuple[Any, Dict[str, Any]]]], Any]] = None
+        self._stats = {"batches": 0, "writes": 0, "largest_batch": 0}
+
+    def set_batch_sync(self, func: Callable[[List[Tuple[Any, Dict[str, Any]]]], Any]):
+        """Функция синхронизации пачки [(user_id, строка журнала)] в БД"""
+        self._batch_sync = func
+
+    async def append(self, folder: str, user_id: Any, amount, description: str, category: str,
+                     transaction_date) -> Dict[str, Any]:
+        """
+        Добавляет расход в пачку папки и ждет ее записи
+
+        Returns:
+            Записанная строка журнала (с присвоенным ID)
+        """
+        future = asyncio.get_running_loop().create_future()
+        expense = {
+            'amount': amount,
+            'description': description,
+            'category': category,
+            'transaction_date': transaction_date
+        }
+        pending = self._pending.setdefault(folder, [])
+        pending.append((user_id, expense, future))
+        if folder not in self._flushers:
+            self._flushers[folder] = asyncio.create_task(self._flush_later(folder))
+        elif len(pending) >= self.max_batch:
+            # Пачка заполнена — записываем, не дожидаясь конца окна
+            self._flushers[folder].cancel()
+            self._flushers[folder] = asyncio.create_task(self._flush_later(folder, delay=0))
+        return await future
+
+    async def _flush_later(self, folder: str, delay: Optional[float] = None):
+        try:
+            await asyncio.sleep(self.window if delay is None else delay)
+        except asyncio.CancelledError:
+            return
+        async with folder_locks.async_lock(folder):
+            # Расходы, пришедшие пока ждали блокировку, попадают в эту же пачку
+            batch = self._pending.pop(folder, [])
+            if self._flushers.get(folder) is asyncio.current_task():
+                del self._flushers[folder]
+            if not batch:
+                return
+            try:
+                rows = await asyncio.to_thread(self._commit, folder, [expense for _, expense, _ in batch])
+            except Exception as e:
+                logger.error(f"Ошибка групповой записи расходов в {folder}: {e}")
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+            # Синхронизация (постановка пачки в журнал БД) — до ответа вызывающим:
+            # расход считается записанным только после нее
+            if self._batch_sync is not None:
+                try:
+                    await asyncio.to_thread(self._batch_sync, [(user_id, row) for (user_id, _, _), row in zip(batch, rows)])
+                except Exception as e:
+                    logger.error(f"Ошибка синхронизации пачки расходов {folder}: {e}")
+            self._stats["batches"] += 1
+            self._stats["writes"] += len(batch)
+            self._stats["largest_batch"] = max(self._stats["largest_batch"], len(batch))
+            for (_, _, future), row in zip(batch, rows):
+                if not future.done():
+                    future.set_result(row)
+
+    def _commit(self, folder: str, expenses: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Записывает пачку в журнал папки (выполняется в потоке)"""
+        expenses_file = f"{folder}/expenses.csv"
+        with folder_locks.lock(folder):
+            rows = append_expenses(expenses_file, expenses)
+            expense_rollups.record_changes(expenses_file, [(None, row) for row in rows])
+        if len(rows) > 1:
+            logger.info(f"Пачка из {len(rows)} расходов записана в {expenses_file}")
+        return rows
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Статистика пачек"""
+        stats = dict(self._stats)
+        stats["average_batch"] = round(stats["writes"] / stats["batches"], 2) if stats["batches"] else 0.0
+        return stats
+
+
+# Глобальный коалесцер записи расходов
+write_coalescer = WriteCoalescer()